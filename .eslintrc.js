@@ -364,6 +364,8 @@ module.exports = {
         "MarkdownTestSuite" : "readonly",
         // chart.js
         "Chart" : "readonly",
+        // Generated by build.py for pages with deferred scripts (see deps.json)
+        "loadDeferred" : "readonly",
         // eslintrc
         "module" : "readonly",
     },
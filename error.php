@@ -75,8 +75,8 @@ switch($err)
 	<meta http-equiv="Content-Type" content="text/html; charset=utf-8" />
 	<meta name="viewport" content="width=device-width, initial-scale=1">
 	<meta name="theme-color" content="#220202" />
-    <link rel="icon" type="image/svg+xml" href="/plex/favicon.svg">
-    <link rel="alternate icon" href="/plex/favicon.png">
+    <link rel="icon" type="image/svg+xml" href="/plex/<?php asset("favicon.svg") ?>">
+    <link rel="alternate icon" href="/plex/<?php asset("favicon.png") ?>">
 	<title>Error <?php print($error_code . " - " . $description); ?></title>
 	<style>
 	* {
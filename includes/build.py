@@ -2,25 +2,51 @@
 Checks source files (js, css, svg) for changes and copies them to their respective
 directories. Also bundles and minifies javascript files by going through all the php
 files in the plex directory looking for build_js statements. When it find one, it
-creates a temporary js file that combines all the necessary includes, then runs terser
-on it. This allows for maximally minized javascript that's contained to a single file per page
+bundles all the necessary includes in memory, then streams the bundle through terser.
+This allows for maximally minized javascript that's contained to a single file per page.
+
+Running this file builds everything (see print_help). Other tools can import it and use
+Builder instead, which keeps its caches warm between builds, and -serve starts a local
+server that builds each bundle when it's requested (see DevServer)
 '''
 
-import glob
+import atexit
+import base64
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
+import bisect
+import contextlib
+import difflib
+import gzip
 import hashlib
+import http.server
 import json
+import mimetypes
 import os
-from pathlib import Path
 import platform
+import queue
 import re
 import shutil
 import subprocess
 import sys
+import threading
+import time
+import urllib.parse
+
+try:
+    # Optional, used by -watch to avoid polling on Linux
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+try:
+    # Optional, falls back to the brotli CLI if available
+    import brotli
+except ImportError:
+    brotli = None
 
 def process():
-    '''Main entrypoint into the program'''
-
-    clean_tmp()
+    '''Main entrypoint into the program. Parses the command line and hands it off to a Builder'''
 
     args_lower = [arg.lower() for arg in sys.argv]
     if len(args_lower) > 1:
@@ -29,16 +55,12 @@ def process():
              print_help()
              return
 
-    force = "-force" in args_lower or '-f' in args_lower
-    babel = '-babel' in args_lower or '-b' in args_lower
-    ultra = '-ultra' in args_lower or '-u' in args_lower
     quiet = '-quiet' in args_lower or '-q' in args_lower
     noicon = '-noicon' in args_lower
     onlyicon = '-icononly' in args_lower
     nocss = '-nocss' in args_lower
     onlycss = '-cssonly' in args_lower
-    cleancss = '-cleancss' in args_lower
-    compare = '-cmp' in args_lower
+    report = '-report' in args_lower or '-cmp' in args_lower
     single = '-s' in args_lower
     rem_log = 1 if '-notmi' in args_lower else 0
     if '-nolog' in args_lower:
@@ -49,65 +71,906 @@ def process():
     if not verify_structure():
         return
 
-    if single:
-        files = [args_lower[args_lower.index('-s') + 1]]
-    else:
-        files = glob.glob("*.php")
+    if '-stack' in args_lower:
+        trace = get_arg_value('-stack', '-')
+        print(decode_stack_trace(sys.stdin.read() if trace == '-' or trace.startswith('-') else get_lines(trace)))
+        return
 
-    # First, check for changes to svg icons
-    if not noicon and not onlycss and not single:
-        process_svg_icons(force, quiet)
-    if onlyicon:
+    trace = None
+    if '-profile' in args_lower:
+        trace = get_arg_value('-profile', '')
+        trace = trace if trace.endswith('.json') else 'includes/cache/build_trace.json'
+    builder = Builder(
+        dev='-dev' in args_lower,
+        force='-force' in args_lower or '-f' in args_lower,
+        quiet=quiet,
+        jobs=get_jobs(args_lower),
+        babel='-babel' in args_lower or '-b' in args_lower,
+        ultra='-ultra' in args_lower or '-u' in args_lower,
+        rem_log=rem_log,
+        shake='-shake' in args_lower,
+        shared=int(get_arg_value('-shared', 0)),
+        csso='-cleancss' not in args_lower,
+        prune='-prune' in args_lower,
+        sprite=get_arg_value('-sprite', 'global') if '-sprite' in args_lower else None,
+        inline_icons=int(get_arg_value('-inlineicons', 0)),
+        compress='-nocompress' not in args_lower,
+        daemon='echo' if '-daemonecho' in args_lower else 'node' if '-daemon' in args_lower else None,
+        cache='-nocache' not in args_lower,
+        cache_path=get_arg_value('-cache', None),
+        cache_size=int(get_arg_value('-cachesize', ArtifactCache.DEFAULT_SIZE_MB)),
+        profile=trace)
+
+    if '-serve' in args_lower:
+        port = get_arg_value('-serve', '')
+        builder.serve(int(port) if port.isdigit() else DevServer.PORT)
         return
-    
-    deps = json.loads(get_lines('includes' + os.sep + 'deps.json'))
 
-    if not nocss and not onlyicon:
-        process_css(files, deps, force, quiet, not cleancss)
-    if onlycss:
+    files = [args_lower[args_lower.index('-s') + 1]] if single else builder.pages()
+    try:
+        failures = builder.build(files, icons=not noicon and not onlycss and not single, css=not nocss and not onlyicon, assets=not onlyicon and not single, js=not onlyicon and not onlycss)
+    except DependencyError as ex:
+        print('ERROR:', ex)
+        finish_build(1)
+        return
+    if onlyicon or onlycss:
+        finish_build(failures)
         return
 
-    modified_dates = get_modified_dates('script/*.js')
+    if not builder.dev:
+        failures += check_size_budgets(files)
 
-    comparisons = {}
-    if ultra and compare:
-        for file in files:
-            process_file(file, modified_dates, deps, force, 0, False, quiet)
-
-        print('Generating non-ultra for comparison')
-        minify(babel, True)
-        noultra = glob.glob('min/*.min.js')
-        for file in noultra:
-            cleanFile = file[file.rfind('/') + 1:]
-            cleanFile = cleanFile[:file.find('.')]
-            comparisons[cleanFile] = { 'noultra' : Path(file).stat().st_size, 'ultra' : 0 }
-        clean_tmp()
+    if '-checklong' in args_lower:
+        check_long_words(get_arg_value('-checklong', 15))
+
+    if report:
+        path = get_arg_value('-report', '')
+        report_bundle_sizes(files, path if path.endswith('.json') else SIZE_REPORT, quiet)
+
+    if '-watch' in args_lower:
+        builder.publish()
+        builder.watch(files, icons=not noicon and not single, css=not nocss)
+    finish_build(failures)
+
+
+class Builder:
+    '''
+    Builds the site's icons, stylesheets, and scripts with the given options, which mirror the
+    command line flags of the same name (see print_help). For example, to bundle everything
+    without minifying it, then point the site at the new files:
+
+        builder = Builder(dev=True, quiet=True)
+        failures = builder.build()
+        builder.publish()
+
+    Paths are relative to the project root, so that has to be the current directory. The file
+    index, build manifest, caches, and parsed deps.json are kept between builds, but they live in
+    module globals, so there should only be one Builder per process
+    '''
+
+    def __init__(self, dev=False, force=False, quiet=False, jobs=None, babel=False, ultra=False, rem_log=0, shake=False,
+                 shared=0, csso=True, prune=False, sprite=None, inline_icons=0, compress=True, daemon=None, cache=True,
+                 cache_path=None, cache_size=None, profile=None):
+        if shared and ultra:
+            # Ultra mode renames things across the whole bundle, which isn't safe once the bundle is split
+            print('WARN: -shared is not compatible with -ultra, building self-contained bundles')
+            shared = 0
+
+        self.dev = dev
+        self.force = force
+        self.quiet = quiet
+        self.jobs = max(1, jobs or os.cpu_count() or 1)
+        self.babel = babel
+        self.ultra = ultra
+        self.rem_log = rem_log
+        self.shake = shake
+        self.shared = shared
+        self.csso = csso
+        self.prune = prune
+        self.lock = threading.Lock()
+        self.deps = None
+        self.chunks = []
+        self.watcher = None
+        self.icons_stale = True
+
+        global g_dev, g_compressor, g_sprite_mode, g_inline_icons, g_profiler
+        g_dev = dev
+        g_profiler = None if profile is None else Profiler(profile)
+        g_sprite_mode = None if sprite is None else 'page' if sprite.lower() == 'page' else 'global'
+        g_inline_icons = inline_icons
+        g_compressor = Compressor(self.jobs, quiet) if compress and not dev else None
+        if daemon is not None:
+            start_minify_server(self.jobs, daemon == 'echo')
+
+        global g_index, g_manifest, g_artifacts, g_preprocess
+        g_index = FileIndex()
+        g_manifest = BuildManifest(g_index)
+        g_preprocess = PreprocessCache(cache)
+        g_artifacts = ArtifactCache(cache_path or ArtifactCache.default_path(), cache_size or ArtifactCache.DEFAULT_SIZE_MB) if cache else None
+
+    def pages(self):
+        '''Returns every page (php file in the root directory)'''
+        return g_index.find('.', suffix='.php')
+
+    def load_deps(self):
+        '''(Re)loads deps.json and plans shared chunks if needed. Raises a DependencyError if it's invalid'''
+        with profile('resolve'):
+            self.deps = load_deps()
+        self.chunks = plan_shared_chunks(get_page_deps(self.pages(), self.deps), self.deps, self.shared) if self.shared else []
+
+    def build(self, files=None, icons=True, css=True, assets=True, js=True):
+        '''
+        Builds the given stages for the given pages (all of them by default), skipping anything
+        that's up to date. Returns the number of tasks that failed. Raises a DependencyError if
+        deps.json is invalid
+        '''
+        with self.lock:
+            if self.deps is None:
+                self.load_deps()
+            files = self.pages() if files is None else files
+
+            # Icons, styles, and scripts are all built at once. Only the icon map's bundle (and
+            # pruned stylesheets of pages that use it) have to wait for the icons to be processed
+            graph = TaskGraph(self.jobs)
+            icon_task = None
+            if icons:
+                icon_task = add_icon_tasks(graph, self.force, self.quiet, self.deps)
+                self.icons_stale = False
+            styles = []
+            if css:
+                styles = add_css_tasks(graph, files, self.deps, self.force, self.quiet, self.csso, self.prune, icon_task)
+            if assets:
+                # Stylesheets record the assets they reference once they've been built
+                graph.add('assets', 'static', lambda: process_static_assets(files), styles)
+            if js:
+                add_js_tasks(graph, files, self.deps, self.chunks, self.force, self.rem_log, self.ultra, self.babel, self.quiet, self.shake, icon_task)
+            return graph.run()
+
+    def build_bundle(self, kind, name):
+        '''
+        Builds a single bundle if it's out of date, where kind is 'style' or 'script', and name is a
+        page, or for scripts, any chunk a page loads (e.g. 'iconMap' or 'index_deferred'). Nothing else
+        is built, other than the icons if the icon map is requested after their sources changed. The
+        bundle is published if it changed. Returns the path of the bundle, or None if there's no such
+        bundle or it failed to build. Raises a DependencyError if deps.json is invalid
+        '''
+        with self.lock:
+            self.refresh()
+            graph = TaskGraph(self.jobs)
+            if kind == 'style':
+                if not g_index.exists(name + '.php'):
+                    return None
+                add_css_tasks(graph, [name + '.php'], self.deps, False, self.quiet, self.csso, self.prune)
+            elif name == ICON_MAP:
+                wait = []
+                if self.icons_stale:
+                    wait.append(add_icon_tasks(graph, False, self.quiet, self.deps))
+                    self.icons_stale = False
+                add_chunk_task(graph, ICON_MAP, [ICON_MAP], False, self.rem_log, self.babel, self.quiet, [], wait)
+            elif any(chunk[0] == name for chunk in self.chunks):
+                modules = next(chunk[1] for chunk in self.chunks if chunk[0] == name)
+                add_chunk_task(graph, name, modules, False, self.rem_log, self.babel, self.quiet, [])
+            else:
+                page = name[:-len('_deferred')] if name.endswith('_deferred') else name
+                if not g_index.exists(page + '.php'):
+                    return None
+                add_page_task(graph, page + '.php', self.deps, self.chunks, False, self.rem_log, self.ultra, self.babel, self.quiet, [], self.shake)
+
+            key = kind + '/' + name
+            output = g_manifest.output(key)
+            if graph.run() != 0:
+                return None
+            if g_manifest.output(key) != output:
+                self.publish()
+            return g_manifest.output(key)
+
+    def refresh(self):
+        '''
+        Picks up sources that changed since the last refresh, reloading deps.json if needed. Only
+        needed by build_bundle, since full builds check everything anyway
+        '''
+        if self.watcher is None:
+            self.watcher = SourceWatcher()
+            changed = set()
+        else:
+            changed = self.watcher.diff()
+        for path in changed:
+            if os.path.exists(path):
+                g_index.add(path)
+            else:
+                g_index.remove(path)
+        if self.deps is None or 'includes/deps.json' in changed:
+            self.load_deps()
+
+        # Scripts and styles determine which icon variants and sprites are needed
+        if any(path.startswith(('icon/', 'script/', 'style/')) and path != 'script/iconMap.js' for path in changed):
+            self.icons_stale = True
+
+    def publish(self):
+        '''Points the site at everything that's been built, and removes what it replaced'''
+        with profile('publish'):
+            publish_build()
+
+    def watch(self, files=None, icons=True, css=True):
+        '''Rebuilds the bundles affected by each change to the given pages' sources until interrupted'''
+        files = self.pages() if files is None else files
+        watch_sources(files, self.deps, self.shared, icons, css, self.rem_log, self.ultra, self.babel, self.csso, self.quiet, self.jobs, self.shake, self.prune)
+
+    def serve(self, port=None):
+        '''Runs a DevServer until interrupted'''
+        port = port or DevServer.PORT
+        with DevServer(self, port) as server:
+            print(f'Serving min/ at http://localhost:{port}/min/. Press Ctrl+C to stop')
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                print()
+                print('Stopped serving')
+        finish_build(0)
+
+
+class DevServer(http.server.ThreadingHTTPServer):
+    '''
+    Local server that serves min/, building each stylesheet and script bundle when it's requested
+    instead of building everything up front, so only the pages being worked on are ever built.
+    The web server should proxy min/ to it, e.g. 'ProxyPass /min/ http://localhost:8000/min/'.
+
+    Pages link to the bundles listed in the asset manifest, which may be out of date by the time
+    they're requested, so bundles are matched by name and the current build is always returned
+    '''
+
+    PORT = 8000
+    BUNDLE_REGEX = re.compile(r'(?:^|/)min/(script|style)/(\w+)\.[0-9a-f]+\.min\.(?:js|css)(\.map)?$')
+
+    def __init__(self, builder, port):
+        super().__init__(('localhost', port), DevRequestHandler)
+        self.builder = builder
+
+
+class DevRequestHandler(http.server.BaseHTTPRequestHandler):
+    '''Handles a single request to the DevServer'''
+
+    def do_GET(self):
+        path = urllib.parse.unquote(urllib.parse.urlparse(self.path).path)
+        match = DevServer.BUNDLE_REGEX.search(path)
+        if match is not None:
+            try:
+                output = self.server.builder.build_bundle(match.group(1), match.group(2))
+            except DependencyError as ex:
+                print('ERROR:', ex)
+                self.send_error(500, str(ex))
+                return
+            file = None if output is None else output + (match.group(3) or '')
+        else:
+            # Anything else (icons, static assets) is served as-is
+            start = path.find('min/')
+            file = None if start == -1 or '..' in path else path[start:]
+
+        if file is None or not os.path.isfile(file):
+            self.send_error(404)
+            return
+        with open(file, 'rb') as served:
+            body = served.read()
+        self.send_response(200)
+        self.send_header('Content-Type', mimetypes.guess_type(file)[0] or 'application/octet-stream')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if not self.server.builder.quiet:
+            super().log_message(format, *args)
+
+
+def process_js(files, deps, chunks, force, rem_log, ultra, babel, quiet, jobs, shake=False):
+    '''Processes javascript on its own (see add_js_tasks), returning the number of tasks that failed'''
+    graph = TaskGraph(jobs)
+    add_js_tasks(graph, files, deps, chunks, force, rem_log, ultra, babel, quiet, shake)
+    return graph.run()
+
+
+def add_js_tasks(graph, files, deps, chunks, force, rem_log, ultra, babel, quiet, shake=False, icons=None):
+    '''
+    Adds tasks to the given graph that bundle and minify the javascript for the given pages,
+    along with any shared chunks. Pages don't bundle the icon map themselves, it's a chunk of its
+    own, so only that chunk has to wait for the given icons task to write it
+    '''
+    graph.note(['Looking for updated javascript...'])
+    modified = []
+    tasks = []
+    if any(ICON_MAP in get_deps(file, deps) for file in files):
+        tasks.append(add_chunk_task(graph, ICON_MAP, [ICON_MAP], force, rem_log, babel, quiet, modified, [] if icons is None else [icons]))
+    for name, modules, _ in chunks:
+        tasks.append(add_chunk_task(graph, name, modules, force, rem_log, babel, quiet, modified))
+    for file in files:
+        tasks.append(add_page_task(graph, file, deps, chunks, force, rem_log, ultra, babel, quiet, modified, shake))
+    graph.add(None, None, lambda: report_js(modified, chunks, quiet), tasks)
+
+
+def add_chunk_task(graph, name, modules, force, rem_log, babel, quiet, modified, wait=()):
+    '''Adds a task that bundles (and then minifies) the given chunk once the given tasks have finished'''
+    build = lambda out: process_chunk(name, modules, force, rem_log, babel, quiet, out)
+    return graph.add('js', name, lambda: bundle_js(graph, [name], build, babel, quiet, modified), wait)
+
+
+def add_page_task(graph, file, deps, chunks, force, rem_log, ultra, babel, quiet, modified, shake=False):
+    '''Adds a task that bundles (and then minifies) the given page's scripts, and its deferred chunk if it has one'''
+    page = file[:file.rfind('.')]
+    page_chunks = [chunk for chunk in chunks if page in chunk[2]]
+    build = lambda out: process_file(file, deps, force, rem_log, ultra, babel, quiet, page_chunks, out, shake)
+    return graph.add('js', file, lambda: bundle_js(graph, [page + '_deferred', page], build, babel, quiet, modified))
+
+
+def bundle_js(graph, names, build, babel, quiet, modified):
+    '''
+    Runs the given bundling function, then adds a task to minify each of the given bundles
+    that it built, which are also added to modified. Returns the lines to print
+    '''
+    out = []
+    build(out)
+    for name in names:
+        bundle = g_bundles.pop(name, None)
+        if bundle is not None:
+            modified.append(name)
+            graph.add('minify', name, lambda name=name, bundle=bundle: run_cmd(name, bundle, minify_options(babel), babel, quiet))
+    return out
+
+
+def report_js(modified, chunks, quiet):
+    '''Returns the lines summarizing the script bundles that were built'''
+    out = []
+    if len(modified) == 0 and quiet:
+        out.append('Javascript up to date!')
+    out += g_enum_report.report(quiet)
+    out += g_shake_report.report(quiet)
+    if len(chunks) != 0:
+        out += report_shared_chunks(chunks)
+    return out
+
+
+def watch_sources(files, deps, shared, icons, css, rem_log, ultra, babel, csso, quiet, jobs, shake, prune):
+    '''
+    Watches script/, style/, icon/, and includes/deps.json, rebuilding only the
+    bundles affected by each change until interrupted
+    '''
+    watcher = SourceWatcher()
+    pages = get_page_deps(files, deps)
+    reverse_scripts, reverse_styles = build_reverse_index(files, deps)
+    chunks = plan_shared_chunks(pages, deps, shared) if shared else []
+    print()
+    print('Watching for changes' + (' (inotify)' if watcher.inotify is not None else '') + '. Press Ctrl+C to stop')
+    try:
+        while True:
+            changed = watcher.wait()
+            start = time.time()
+            for path in changed:
+                if os.path.exists(path):
+                    g_index.add(path)
+                else:
+                    g_index.remove(path)
+            print()
+            print('Changed:', ', '.join(sorted(changed)))
+
+            js_pages = set()
+            css_pages = set()
+            if 'includes/deps.json' in changed:
+                try:
+                    deps = load_deps()
+                except DependencyError as ex:
+                    print('ERROR:', ex)
+                    continue
+                pages = get_page_deps(files, deps)
+                reverse_scripts, reverse_styles = build_reverse_index(files, deps)
+                chunks = plan_shared_chunks(pages, deps, shared) if shared else []
+                js_pages.update(files)
+                css_pages.update(files)
+
+            failures = 0
+            # Scripts and styles determine which icon variants and sprites are needed
+            if icons and any(path.startswith(('icon/', 'script/', 'style/')) and path != 'script/iconMap.js' for path in changed):
+                icon_map = g_manifest.file_hash('script/iconMap.js')
+                failures += process_svg_icons(False, quiet, jobs, deps)
+                if g_manifest.file_hash('script/iconMap.js') != icon_map:
+                    changed.add('script/iconMap.js')
+
+            for path in changed:
+                name = path[path.find('/') + 1:path.rfind('.')]
+                if path.startswith('script/'):
+                    js_pages.update(reverse_scripts.get(name, []))
+                    if prune:
+                        # Pruned stylesheets depend on the classes the page's scripts use
+                        css_pages.update(reverse_scripts.get(name, []))
+                elif path.startswith('style/'):
+                    css_pages.update(reverse_styles.get(name, []))
+
+            if css and len(css_pages) != 0:
+                failures += process_css(sorted(css_pages), deps, False, quiet, csso, jobs, prune)
+            if len(js_pages) != 0:
+                failures += process_js(sorted(js_pages), deps, chunks, False, rem_log, ultra, babel, quiet, jobs, shake)
+            publish_build()
+            print(f'Checked {len(js_pages)} script and {len(css_pages)} style bundle(s) in {round(time.time() - start, 2)}s' + (f' ({failures} failed)' if failures else ''))
+    except KeyboardInterrupt:
         print()
-        print('Generating ultra minified files')
+        print('Stopped watching')
 
-    print('Looking for updated javascript...')
-    any_modified_js = False
+
+def build_reverse_index(files, deps):
+    '''
+    Returns a pair of maps from each script and each style to the pages whose bundles
+    include it (directly or through other scripts), so that a change to a single source
+    file only rebuilds the bundles it's part of
+    '''
+    scripts = {}
+    styles = {}
     for file in files:
-        any_modified_js = process_file(file, modified_dates, deps, force, rem_log, ultra, quiet) or any_modified_js
-    if not any_modified_js and quiet:
-        print('Javascript up to date!')
+        includes = get_deps(file, deps)
+        for include in includes + get_deferred_deps(file, deps, includes, []):
+            scripts.setdefault(include, set()).add(file)
+        for include in get_css_deps(file, deps):
+            styles.setdefault(include, set()).add(file)
+    return scripts, styles
 
-    minify(babel, quiet)
-    if ultra and compare:
-        ultra_minified = glob.glob('min/*.min.js')
-        for file in ultra_minified:
-            cleanFile = file[file.rfind('/') + 1:]
-            cleanFile = cleanFile[:file.find('.')]
-            comparisons[cleanFile]['ultra'] = Path(file).stat().st_size
 
+class SourceWatcher:
+    '''
+    Watches the build's sources for changes. Uses inotify if the optional inotify_simple
+    package is installed, otherwise polls, which only has to stat a few dozen files.
+    Either way, changes are determined by comparing (size, mtime) snapshots, and a change
+    is only reported once things have been quiet for DEBOUNCE seconds, so a burst of saves
+    results in a single rebuild
+    '''
 
-    if '-checklong' in args_lower:
-        check_long_words(args_lower[args_lower.index('-checklong') + 1], files)
+    WATCHED = { 'script' : '.js', 'style' : '.css', 'icon' : '.svg', 'includes' : 'deps.json' }
+    POLL_INTERVAL = 0.1
+    DEBOUNCE = 0.2
+
+    def __init__(self):
+        self.inotify = None
+        if inotify_simple is not None:
+            try:
+                self.inotify = inotify_simple.INotify()
+                flags = inotify_simple.flags
+                mask = flags.CLOSE_WRITE | flags.CREATE | flags.DELETE | flags.MOVED_TO | flags.MOVED_FROM
+                for directory in SourceWatcher.WATCHED:
+                    self.inotify.add_watch(directory, mask)
+            except OSError:
+                self.inotify = None
+        self.snapshot = self.take_snapshot()
+
+    def take_snapshot(self):
+        '''Returns a map of every watched file to its (size, mtime)'''
+        snapshot = {}
+        for directory, suffix in SourceWatcher.WATCHED.items():
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if entry.name.endswith(suffix) and entry.is_file():
+                        stat = entry.stat()
+                        snapshot[directory + '/' + entry.name] = (stat.st_size, stat.st_mtime_ns)
+        return snapshot
+
+    def wait_for_activity(self, timeout):
+        '''Waits for (at most) timeout seconds, returning early if inotify reports activity'''
+        if self.inotify is not None:
+            return len(self.inotify.read(timeout=None if timeout is None else int(timeout * 1000))) != 0
+        time.sleep(timeout)
+        return True
 
-    if ultra and compare:
-        cmp_sizes(comparisons)
+    def diff(self):
+        '''Returns the set of files that changed since the last snapshot, and updates the snapshot'''
+        current = self.take_snapshot()
+        changed = set(path for path in current if self.snapshot.get(path) != current[path])
+        changed.update(path for path in self.snapshot if path not in current)
+        self.snapshot = current
+        return changed
+
+    def wait(self):
+        '''Blocks until something changes, then returns the set of changed files'''
+        while True:
+            if not self.wait_for_activity(None if self.inotify is not None else SourceWatcher.POLL_INTERVAL):
+                continue
+            changed = self.diff()
+            if len(changed) == 0:
+                continue
+
+            # Debounce: keep collecting changes until things settle down
+            while True:
+                time.sleep(SourceWatcher.DEBOUNCE)
+                more = self.diff()
+                if len(more) == 0:
+                    return changed
+                changed.update(more)
+
+
+def get_arg_value(arg, default):
+    '''Returns the (case-preserved) command line value following the given argument, or the default if not present'''
+    args_lower = [a.lower() for a in sys.argv]
+    if arg in args_lower:
+        index = args_lower.index(arg)
+        if index + 1 < len(sys.argv):
+            return sys.argv[index + 1]
+    return default
+
+
+def get_jobs(args_lower):
+    '''
+    Returns the maximum number of build tasks (and so minification processes) to run at once. Defaults
+    to the number of CPUs, and can be overridden with '-j N' (or '-jN')
+    '''
+    jobs = os.cpu_count() or 1
+    for i, arg in enumerate(args_lower):
+        if arg == '-j' and i + 1 < len(args_lower) and args_lower[i + 1].isdigit():
+            jobs = int(args_lower[i + 1])
+        elif arg.startswith('-j') and arg[2:].isdigit():
+            jobs = int(arg[2:])
+    return max(1, jobs)
 
-    clean_tmp()
+
+def run_jobs(jobs, max_jobs):
+    '''
+    Runs the given jobs concurrently, with at most max_jobs running at once.
+
+    Each job is a callable that returns a list of lines to print. Output is printed in
+    the order the jobs were given, one job at a time, so lines from different files are
+    never interleaved. A failed job doesn't affect the others; its error is printed in
+    place of its output. Returns the number of jobs that failed.
+    '''
+    if len(jobs) == 0:
+        return 0
+
+    failed = 0
+    with ThreadPoolExecutor(max_workers=min(max_jobs, len(jobs))) as executor:
+        futures = [executor.submit(run_job, job) for job in jobs]
+        for future in futures:
+            output, job_failed = future.result()
+            failed += job_failed
+            for line in output:
+                print(line)
+    return failed
+
+
+def run_job(job):
+    '''Runs a single job (see run_jobs), returning the lines to print and whether it failed'''
+    try:
+        return job(), False
+    except subprocess.CalledProcessError as ex:
+        output = ['ERROR: ' + str(ex)]
+        if ex.output:
+            output.append(ex.output.decode('utf-8').rstrip())
+        return output, True
+    except Exception as ex:
+        return ['ERROR: ' + str(ex)], True
+
+
+class Task:
+    '''A single job in a TaskGraph, along with what it's waiting on and what's waiting on it'''
+
+    def __init__(self, stage, name, job, parent):
+        self.stage = stage
+        self.name = name
+        self.job = job
+        self.parent = parent
+        self.children = []
+        self.dependents = []
+        self.waiting = 0 # Dependencies that haven't finished yet
+        self.remaining = 1 # The job itself, plus any children that haven't finished yet
+        self.ran = False
+        self.finished = False
+        self.output = []
+
+
+class TaskGraph:
+    '''
+    Runs the build as a graph of small tasks (a batch of icons, a page's stylesheet or script
+    bundle, a single minification, etc.), starting each one as soon as the tasks it depends on
+    have finished, with at most max_jobs running at once.
+
+    Like run_jobs, each task returns a list of lines to print. Output is printed in the order the
+    tasks were added, as soon as everything before it has been printed, so it doesn't depend on
+    what happened to finish first. A failed task doesn't affect the others; its error is printed
+    in place of its output. Tasks can add more tasks while they run (e.g. a bundle adding its
+    minification once it knows it changed). Those belong to the task that added them: their output
+    comes right after its output, and anything that depends on it waits for them too.
+
+    When stdout is a terminal, a summary of what's running is shown below the output.
+    '''
+
+    def __init__(self, max_jobs):
+        self.max_jobs = max_jobs
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.roots = []
+        self.ready = []
+        # Tasks added by other tasks, or that something was waiting on. These run before anything
+        # new is started, so work that's been started (e.g. minifying a bundle that was just built)
+        # is finished first, and whatever is holding up the rest of the build (e.g. the icons) isn't
+        # stuck behind the tasks nothing is waiting on
+        self.urgent = []
+        self.total = 0
+        self.done = 0
+        self.progress = sys.stdout.isatty()
+        self.shown = 0
+
+    def add(self, stage, name, job, deps=()):
+        '''
+        Adds a task that runs the given job once all the given tasks have finished, and returns it.
+        Tasks without a stage just print something, and aren't shown in the progress summary
+        '''
+        parent = getattr(self.local, 'task', None)
+        task = Task(stage, name, job, parent)
+        with self.lock:
+            for dep in deps:
+                if not dep.finished:
+                    dep.dependents.append(task)
+                    task.waiting += 1
+            if parent is None:
+                self.roots.append(task)
+            else:
+                parent.children.append(task)
+                parent.remaining += 1
+            if task.waiting == 0:
+                (self.ready if parent is None else self.urgent).append(task)
+            if stage is not None:
+                self.total += 1
+        return task
+
+    def note(self, lines):
+        '''Prints the given lines in order with the output of the tasks around them'''
+        return self.add(None, None, lambda: lines)
+
+    def run(self):
+        '''Runs every task that's been added, returning the number of tasks that failed'''
+        failed = 0
+        order = self.walk(self.roots)
+        pending = next(order, None)
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.max_jobs) as executor:
+            while True:
+                with self.lock:
+                    started = []
+                    for queue in (self.urgent, self.ready):
+                        count = min(len(queue), self.max_jobs - len(running) - len(started))
+                        started += queue[:count]
+                        del queue[:count]
+                for task in started:
+                    running[executor.submit(self.execute, task)] = task
+                if len(running) == 0:
+                    break
+
+                self.show_progress(running.values())
+                finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    task = running.pop(future)
+                    task.output, task_failed = future.result()
+                    task.ran = True
+                    failed += task_failed
+                    with self.lock:
+                        self.done += task.stage is not None
+                        self.finish(task)
+
+                # Print whatever's next in line, up to the first task that hasn't run yet
+                while pending is not None and pending.ran:
+                    self.clear_progress()
+                    for line in pending.output:
+                        print(line)
+                    pending = next(order, None)
+
+        self.clear_progress()
+        return failed
+
+    def execute(self, task):
+        '''Runs the given task's job on a worker thread, returning its output and whether it failed'''
+        self.local.task = task
+        try:
+            if task.stage is None:
+                return run_job(task.job)
+            with profile(task.stage, 'task', file=task.name):
+                return run_job(task.job)
+        finally:
+            self.local.task = None
+
+    def finish(self, task):
+        '''Marks off the given task's job or one of its children, starting anything that was waiting on it if that was the last one'''
+        task.remaining -= 1
+        if task.remaining != 0:
+            return
+        task.finished = True
+        for dependent in task.dependents:
+            dependent.waiting -= 1
+            if dependent.waiting == 0:
+                self.urgent.append(dependent)
+        if task.parent is not None:
+            self.finish(task.parent)
+
+    def walk(self, tasks):
+        '''
+        Yields the given tasks and their children in the order their output is printed. A task's
+        children aren't looked at until its output has been printed, by which point it's done adding them
+        '''
+        for task in tasks:
+            yield task
+            yield from self.walk(task.children)
+
+    def show_progress(self, running):
+        '''Shows how many tasks have finished and what's currently running, if stdout is a terminal'''
+        if not self.progress:
+            return
+        names = ', '.join(task.stage + ' ' + task.name for task in running if task.stage is not None)
+        line = f'[{self.done}/{self.total}] {names}'[:shutil.get_terminal_size().columns - 1]
+        sys.stdout.write('\r' + line.ljust(self.shown))
+        sys.stdout.flush()
+        self.shown = len(line)
+
+    def clear_progress(self):
+        '''Removes the progress summary, so output can be printed in its place'''
+        if self.shown != 0:
+            sys.stdout.write('\r' + ' ' * self.shown + '\r')
+            self.shown = 0
+
+
+class Profiler:
+    '''
+    Records the wall and CPU time of each stage of the build (and each file within it) for -profile.
+    Spans are written as a Chrome trace (chrome://tracing, ui.perfetto.dev), one row per thread,
+    and summarized by stage. Minifier subprocesses also record their own CPU time and peak memory,
+    where the OS reports it
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.spans = []
+
+    @contextlib.contextmanager
+    def span(self, name, category, args):
+        '''Records the time spent in the body of the with statement. Extra args can be added to the yielded dict'''
+        start = time.perf_counter()
+        cpu = time.thread_time()
+        try:
+            yield args
+        finally:
+            args['cpu_ms'] = round((time.thread_time() - cpu) * 1000, 3)
+            span = {
+                'name' : name,
+                'cat' : category,
+                'ph' : 'X',
+                'ts' : round((start - self.start) * 1000000),
+                'dur' : round((time.perf_counter() - start) * 1000000),
+                'pid' : os.getpid(),
+                'tid' : threading.get_ident(),
+                'args' : args
+            }
+            with self.lock:
+                self.spans.append(span)
+
+    def save(self):
+        '''Writes the trace and prints the time spent in each stage, slowest first'''
+        with self.lock:
+            spans = list(self.spans)
+
+        events = [{ 'name' : 'thread_name', 'ph' : 'M', 'pid' : os.getpid(), 'tid' : tid, 'args' : { 'name' : 'main' if tid == threading.main_thread().ident else 'worker' } }
+            for tid in set(span['tid'] for span in spans)]
+        with open(self.path + '.tmp', 'w') as trace:
+            json.dump({ 'traceEvents' : events + spans, 'displayTimeUnit' : 'ms' }, trace)
+        os.replace(self.path + '.tmp', self.path)
+
+        stages = {}
+        for span in spans:
+            stage = stages.setdefault(span['name'], { 'count' : 0, 'wall' : 0, 'cpu' : 0, 'max' : 0 })
+            stage['count'] += 1
+            stage['wall'] += span['dur'] / 1000
+            stage['cpu'] += span['args']['cpu_ms'] + span['args'].get('child_cpu_ms', 0)
+            stage['max'] = max(stage['max'], span['dur'] / 1000)
+
+        # Stages nest (e.g. 'js' contains 'terser'), so the totals add up to more than the build took
+        print()
+        print(f'Profile written to {self.path}')
+        print(f'{"Stage":<24} {"Count":>6} {"Wall (ms)":>11} {"CPU (ms)":>11} {"Max (ms)":>11}')
+        for name, stage in sorted(stages.items(), key=lambda item: -item[1]['wall']):
+            print(f'{name:<24} {stage["count"]:>6} {stage["wall"]:>11.1f} {stage["cpu"]:>11.1f} {stage["max"]:>11.1f}')
+
+        slowest = sorted((span for span in spans if 'file' in span['args']), key=lambda span: -span['dur'])[:10]
+        if len(slowest) != 0:
+            print()
+            print('Slowest files:')
+            for span in slowest:
+                print(f'  {span["dur"] / 1000:>9.1f}ms  {span["name"]:<16} {span["args"]["file"]}')
+
+g_profiler = None
+def profile(name, category='build', **args):
+    '''
+    Returns a context manager that records the time spent in its body under the given name if
+    -profile was passed, yielding a dict that extra details can be added to
+    '''
+    if g_profiler is None:
+        return contextlib.nullcontext(args)
+    return g_profiler.span(name, category, args)
+
+
+def run_tool(cmd, name, file, source=None):
+    '''
+    Runs the given minifier command, returning its output. Raises CalledProcessError if it fails.
+    If source is given, it's streamed to the minifier's stdin, and the minifier's stdout (the
+    minified source) and stderr (any warnings) are returned separately.
+    When profiling, also records the child's CPU time and peak memory, which needs os.wait4 (i.e. not Windows)
+    '''
+    with profile(name, 'subprocess', file=file) as span:
+        data = None if source is None else source.encode('utf-8')
+        if g_profiler is None or not hasattr(os, 'wait4'):
+            if source is None:
+                return subprocess.check_output(cmd, stderr=subprocess.STDOUT).decode('utf-8')
+            result = subprocess.run(cmd, input=data, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            if result.returncode != 0:
+                raise subprocess.CalledProcessError(result.returncode, cmd, result.stderr)
+            return result.stdout.decode('utf-8'), result.stderr.decode('utf-8')
+
+        if source is None:
+            process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            output = process.stdout.read()
+            errors = b''
+        else:
+            # Feed stdin and drain stderr on their own threads, so the minifier never blocks on a full pipe
+            process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            stderr = []
+            threads = [
+                threading.Thread(target=write_stdin, args=(process.stdin, data)),
+                threading.Thread(target=lambda: stderr.append(process.stderr.read()))
+            ]
+            for thread in threads:
+                thread.start()
+            output = process.stdout.read()
+            for thread in threads:
+                thread.join()
+            process.stderr.close()
+            errors = stderr[0]
+        process.stdout.close()
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        span['child_cpu_ms'] = round((usage.ru_utime + usage.ru_stime) * 1000, 3)
+        span['peak_rss_kb'] = usage.ru_maxrss if platform.system() != 'Darwin' else usage.ru_maxrss // 1024
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, cmd, output if source is None else errors)
+        if source is None:
+            return output.decode('utf-8')
+        return output.decode('utf-8'), errors.decode('utf-8')
+
+
+def write_stdin(pipe, data):
+    '''Writes the given data to a child process's stdin, then closes it'''
+    try:
+        pipe.write(data)
+    except BrokenPipeError:
+        pass # The process exited early, which it'll report itself
+    finally:
+        try:
+            pipe.close()
+        except BrokenPipeError:
+            pass
+
+
+def publish_build():
+    '''Publishes the new outputs and saves the build manifest'''
+    publish_assets()
+    g_manifest.save()
+    g_preprocess.save()
+    if g_artifacts is not None:
+        g_artifacts.evict()
+
+
+def finish_build(failures):
+    '''
+    Publishes the build, then prints a summary of failed jobs and
+    sets a failing exit code if there were any
+    '''
+    with profile('publish'):
+        publish_build()
+    if g_profiler is not None:
+        g_profiler.save()
+    if failures == 0:
+        return
+    print('ERROR:', failures, 'file' + ('' if failures == 1 else 's'), 'failed to build')
+    sys.exit(1)
 
 
 def verify_structure():
@@ -139,6 +1002,7 @@ def verify_structure():
     mkdir_if_absent(min_base + 'script')
     mkdir_if_absent(min_base + 'style')
     mkdir_if_absent(min_base + 'icon')
+    mkdir_if_absent(min_base + 'asset')
 
     return True
 
@@ -147,236 +1011,1746 @@ def mkdir_if_absent(directory):
         os.mkdir(directory)
 
 
-def process_svg_icons(force, quiet):
+class FileIndex:
+    '''
+    In-memory listing of the directories the build reads from and writes to. Each
+    directory is read with a single os.scandir pass, and lookups are served from memory
+    instead of globbing the disk again. Files written or deleted by the build must be
+    reported via add/remove to keep the index accurate.
+
+    The subdirectories of NESTED directories (e.g. each color icons are rendered in)
+    are indexed as well, including ones the build creates.
+    '''
+
+    DIRECTORIES = ['.', 'script', 'style', 'icon', 'min/script', 'min/style', 'min/icon', 'min/asset']
+    NESTED = ['min/icon']
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.dirs = {}
+        for directory in FileIndex.DIRECTORIES:
+            self.scan(directory)
+
+    def scan(self, directory):
+        '''(Re)reads the given directory, and its subdirectories if it's nested'''
+        entries = {}
+        subdirs = []
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if entry.is_file():
+                        stat = entry.stat()
+                        entries[entry.name] = (stat.st_size, stat.st_mtime_ns)
+                    elif entry.is_dir() and directory in FileIndex.NESTED:
+                        subdirs.append(directory + '/' + entry.name)
+        except FileNotFoundError:
+            pass
+        with self.lock:
+            self.dirs[directory] = entries
+        for subdir in subdirs:
+            self.scan(subdir)
+
+    def subdirectories(self, directory):
+        '''Returns the indexed subdirectories of the given nested directory'''
+        with self.lock:
+            return sorted(path for path in self.dirs if self.split(path)[0] == directory)
+
+    def find(self, directory, prefix='', suffix=''):
+        '''Returns the paths of all files in the given directory with the given prefix and suffix'''
+        with self.lock:
+            names = [name for name in self.dirs.get(directory, {}) if name.startswith(prefix) and name.endswith(suffix)]
+        base = '' if directory == '.' else directory + '/'
+        return [base + name for name in sorted(names)]
+
+    def stat(self, path):
+        '''
+        Returns a (size, mtime_ns) tuple for the given path, or None if it doesn't exist.
+        Paths outside of the indexed directories are stat'd directly
+        '''
+        directory, name = self.split(path)
+        with self.lock:
+            if directory in self.dirs:
+                return self.dirs[directory].get(name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return (stat.st_size, stat.st_mtime_ns)
+
+    def exists(self, path):
+        return self.stat(path) is not None
+
+    def add(self, path):
+        '''Adds (or updates) the given newly written file'''
+        directory, name = self.split(path)
+        stat = os.stat(path)
+        with self.lock:
+            if directory in self.dirs or self.split(directory)[0] in FileIndex.NESTED:
+                self.dirs.setdefault(directory, {})[name] = (stat.st_size, stat.st_mtime_ns)
+
+    def remove(self, path):
+        '''Removes the given deleted file from the index'''
+        directory, name = self.split(path)
+        with self.lock:
+            self.dirs.get(directory, {}).pop(name, None)
+
+    @staticmethod
+    def split(path):
+        path = path.replace('\\', '/')
+        slash = path.rfind('/')
+        return ('.', path) if slash == -1 else (path[:slash], path[slash + 1:])
+
+
+class BuildManifest:
+    '''
+    Persistent record of the state each output was last built from, stored in
+    includes/cache/build_manifest.json. For every output it records the content hash of
+    each input, the ordered include list, the build flags, and the minifier version, so
+    we rebuild exactly the outputs whose inputs changed, regardless of timestamps.
+
+    File hashes are cached by (size, mtime) so that unchanged files aren't re-read, and a
+    touched-but-identical file (e.g. after a git checkout) is re-hashed but not rebuilt.
+    '''
+
+    PATH = 'includes/cache/build_manifest.json'
+    VERSION = 1
+
+    def __init__(self, index):
+        self.index = index
+        self.lock = threading.Lock()
+        self.hashes = {}
+        self.outputs = {}
+        self.pending = {}
+        self.compressed = {}
+        self.sizes = {}
+        self.scans = {}
+        self.dirty = False
+        try:
+            with open(BuildManifest.PATH) as manifest_file:
+                manifest = json.load(manifest_file)
+            if manifest.get('version') == BuildManifest.VERSION:
+                self.hashes = manifest['hashes']
+                self.outputs = manifest['outputs']
+                self.compressed = manifest.get('compressed', {})
+                self.sizes = manifest.get('sizes', {})
+                self.scans = manifest.get('scans', {})
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def file_hash(self, path):
+        '''Returns the md5 hash of the given file, or None if it doesn't exist'''
+        stat = self.index.stat(path)
+        if stat is None:
+            return None
+
+        with self.lock:
+            cached = self.hashes.get(path)
+        if cached is not None and cached[0] == stat[0] and cached[1] == stat[1]:
+            return cached[2]
+
+        with profile('hash', file=path), open(path, 'rb') as filebytes:
+            file_hash = hashlib.md5(filebytes.read()).hexdigest()
+        with self.lock:
+            self.hashes[path] = [stat[0], stat[1], file_hash]
+            self.dirty = True
+        return file_hash
+
+    def is_current(self, key, state):
+        '''Returns whether the given output was built from the given state and still exists'''
+        with self.lock:
+            entry = self.outputs.get(key)
+        return entry is not None and entry['state'] == state and self.index.exists(entry['output'])
+
+    def stage(self, key, state):
+        '''Remembers the state the given output is about to be built from'''
+        with self.lock:
+            self.pending[key] = state
+
+    def commit(self, key, output):
+        '''Records that the given output was successfully built from its staged state'''
+        self.index.add(output)
+        with self.lock:
+            if key not in self.pending:
+                return
+            entry = { 'state' : self.pending.pop(key), 'output' : output }
+            if self.outputs.get(key) != entry:
+                self.outputs[key] = entry
+                self.dirty = True
+
+    def forget(self, key):
+        '''Removes the given output from the manifest'''
+        with self.lock:
+            if self.outputs.pop(key, None) is not None:
+                self.dirty = True
+
+    def keys(self, prefix):
+        '''Returns the keys of all recorded outputs that start with the given prefix'''
+        with self.lock:
+            return [key for key in self.outputs if key.startswith(prefix)]
+
+    def output(self, key):
+        '''Returns the recorded path of the given output, or None if it has never been built'''
+        with self.lock:
+            entry = self.outputs.get(key)
+        return None if entry is None else entry['output']
+
+    def state(self, key):
+        '''Returns the state the given output was last built from, or None if it has never been built'''
+        with self.lock:
+            entry = self.outputs.get(key)
+        return None if entry is None else entry['state']
+
+    def current_outputs(self):
+        '''Returns a map of output keys to their current paths, for outputs that exist'''
+        with self.lock:
+            outputs = { key : entry['output'] for key, entry in self.outputs.items() }
+        return { key : output for key, output in outputs.items() if self.index.exists(output) }
+
+    def compressed_sizes(self, path):
+        '''Returns the raw and compressed sizes recorded for the given output, or None if it hasn't been compressed'''
+        with self.lock:
+            return self.compressed.get(path)
+
+    def set_compressed_sizes(self, path, sizes):
+        '''Records the raw and compressed sizes of the given output'''
+        with self.lock:
+            if self.compressed.get(path) != sizes:
+                self.compressed[path] = sizes
+                self.dirty = True
+
+    def prune_compressed(self, paths):
+        '''Forgets the compressed sizes of all outputs not in the given set'''
+        with self.lock:
+            for path in [path for path in self.compressed if path not in paths]:
+                del self.compressed[path]
+                self.dirty = True
+
+    def bundle_sizes(self, path):
+        '''Returns the sizes recorded for the given script bundle (see record_bundle_sizes), or None if there aren't any'''
+        with self.lock:
+            return self.sizes.get(path)
+
+    def set_bundle_sizes(self, path, sizes):
+        '''Records the sizes of the given script bundle'''
+        with self.lock:
+            if self.sizes.get(path) != sizes:
+                self.sizes[path] = sizes
+                self.dirty = True
+
+    def prune_bundle_sizes(self, paths):
+        '''Forgets the sizes of all bundles not in the given set'''
+        with self.lock:
+            for path in [path for path in self.sizes if path not in paths]:
+                del self.sizes[path]
+                self.dirty = True
+
+    def scan(self, kind, path):
+        '''
+        Returns what the given kind of scan (e.g. 'icon_uses') last found in the given file,
+        or None if it hasn't been scanned since its contents last changed
+        '''
+        file_hash = self.file_hash(path)
+        with self.lock:
+            cached = self.scans.get(kind, {}).get(path)
+        return cached[1] if cached is not None and cached[0] == file_hash else None
+
+    def set_scan(self, kind, path, result):
+        '''Records what the given kind of scan found in the current contents of the given file'''
+        entry = [self.file_hash(path), result]
+        with self.lock:
+            scans = self.scans.setdefault(kind, {})
+            if scans.get(path) != entry:
+                scans[path] = entry
+                self.dirty = True
+
+    def prune_scans(self, kind, paths):
+        '''Forgets the given kind of scan of all files not in the given set'''
+        with self.lock:
+            scans = self.scans.get(kind, {})
+            for path in [path for path in scans if path not in paths]:
+                del scans[path]
+                self.dirty = True
+
+    def save(self):
+        '''Atomically writes the manifest if anything changed'''
+        if not self.dirty:
+            return
+        tmp_path = BuildManifest.PATH + '.tmp'
+        manifest = { 'version' : BuildManifest.VERSION, 'hashes' : self.hashes, 'outputs' : self.outputs, 'compressed' : self.compressed, 'sizes' : self.sizes, 'scans' : self.scans }
+        with open(tmp_path, 'w') as manifest_file:
+            json.dump(manifest, manifest_file)
+        os.replace(tmp_path, BuildManifest.PATH)
+        self.dirty = False
+
+
+g_index = None
+g_manifest = None
+
+
+# npm packages that provide each minifier. The first is the command line tool
+# we spawn, the second (if any) is the module the node helper loads
+TOOL_PACKAGES = {
+    'terser' : ['terser'],
+    'babel' : ['babel-minify'],
+    'csso' : ['csso-cli', 'csso'],
+    'cleancss' : ['clean-css-cli', 'clean-css'],
+    'svgo' : ['svgo']
+}
+
+g_tool_versions = {}
+def tool_version(tool):
     '''
-    Looks for new/modified SVG icons and copies them to the root icon folder
-    with a hash attached to the file name for cache efficiency
+    Returns the installed version of the given minifier (e.g. "terser@4.8.0"). Reads the
+    version from the package's package.json in the global node_modules directory instead
+    of spawning the tool, which would cost more than an entire no-op build
     '''
+    if tool in g_tool_versions:
+        return g_tool_versions[tool]
+
+    if platform.system() == 'Windows':
+        module_dirs = [os.path.join(os.environ.get('APPDATA', ''), 'npm', 'node_modules')]
+    else:
+        module_dirs = []
+        node = shutil.which('node')
+        if node is not None:
+            module_dirs.append(os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(node))), 'lib', 'node_modules'))
+        module_dirs.append('/usr/local/lib/node_modules')
+        module_dirs.append('/usr/lib/node_modules')
+
+    versions = []
+    for package in TOOL_PACKAGES[tool]:
+        for module_dir in module_dirs:
+            try:
+                with open(os.path.join(module_dir, package, 'package.json')) as package_json:
+                    versions.append(package + '@' + json.load(package_json)['version'])
+                break
+            except (OSError, ValueError, KeyError):
+                continue
+
+    g_tool_versions[tool] = ','.join(versions) if len(versions) != 0 else tool + '@unknown'
+    return g_tool_versions[tool]
 
-    print('Looking for updated icons...')
-    old_icons = glob.glob('min/icon/*.svg')
+
+def process_svg_icons(force, quiet, jobs, deps=None):
+    '''Processes svg icons on their own (see add_icon_tasks), returning the number of tasks that failed'''
+    graph = TaskGraph(jobs)
+    add_icon_tasks(graph, force, quiet, deps)
+    return graph.run()
+
+
+def add_icon_tasks(graph, force, quiet, deps=None):
+    '''
+    Adds the task that looks for new/modified SVG icons to the given graph. The icons that
+    changed aren't known until it runs, so it adds the tasks that minify and render them
+    itself, and it isn't finished until the icon map has been written
+    '''
+    return graph.add('icons', 'scan', lambda: find_svg_icons(graph, force, quiet, deps))
+
+
+def find_svg_icons(graph, force, quiet, deps):
+    '''
+    Looks for new/modified SVG icons and adds tasks to copy them to the root icon folder
+    with a hash attached to the file name for cache efficiency. Icon hashes come
+    from the build manifest, so unchanged icons aren't re-read, and all modified
+    icons are minified together. With -sprite page, deps is used to determine the
+    icons each page uses.
+
+    Returns the lines to print
+    '''
+
+    out = ['Looking for updated icons...']
+    old_icons = g_index.find('min/icon', suffix='.svg')
+    for directory in g_index.subdirectories('min/icon'):
+        old_icons += g_index.find(directory, suffix='.svg')
     new_icons = []
-    icons = glob.glob('icon/*.svg')
+    uses = find_icon_uses()
+    colors = find_icon_colors(uses)
+    icons = g_index.find('icon', suffix='.svg')
     js_icon_map = '''/* exported Icons */
 /* eslint-disable camelcase */
 const Icons = new function()
 {
     let _map =
     {'''
-    changed = 0
+    to_minify = []
     for icon in icons:
-        with open(icon, 'rb') as filebytes:
-            core = icon[icon.rfind(os.sep) + 1:]
-            core = core[:core.find('.')]
-            hashed = hashlib.md5(filebytes.read()).hexdigest()[:10]
-            newpath = 'min/icon/' + core + '.' + hashed + '.svg'
-            if force or not os.path.exists(newpath):
-                print('  Copying', "'" + icon + "' to", "'" + newpath + "'")
-
-                # Minify svg and place in new location
-                minify_svg(icon, newpath, quiet)
-                # shutil.copyfile(icon, newpath)
-                changed += 1
-            elif not quiet:
-                print(' ', icon, 'up to date')
-            new_icons.append(newpath)
-            js_icon_map += '\n        ' + core.lower() + ' : "' + hashed + '",'
+        core = icon[icon.rfind('/') + 1:]
+        core = core[:core.find('.')]
+        hashed = g_manifest.file_hash(icon)[:10]
+        newpath = 'min/icon/' + core + '.' + hashed + '.svg'
+        g_manifest.stage('icon/' + core, { 'hash' : hashed })
+        if force or not g_index.exists(newpath):
+            # Minify svg and place in new location
+            to_minify.append((core, icon, newpath))
+        else:
+            g_manifest.commit('icon/' + core, newpath)
+            if not quiet:
+                out.append('  ' + icon + ' up to date')
+        new_icons.append(newpath)
+        js_icon_map += '\n        ' + core.lower() + ' : "' + hashed + '",'
+
+    # Spawning svgo dominates the time it takes to minify an icon, so minify
+    # them in as few batches as possible, only splitting them up to run in parallel
+    minified = {}
+    tasks = []
+    for batch in [to_minify[i::graph.max_jobs] for i in range(min(graph.max_jobs, len(to_minify)))]:
+        tasks.append(graph.add('icons', batch[0][1] + (f' (+{len(batch) - 1})' if len(batch) > 1 else ''), lambda batch=batch: minify_svgs(batch, quiet)))
+        minified.update((newpath, tasks[-1]) for _, _, newpath in batch)
+
+    # Render each icon in the colors it's used with once it's been minified
+    variants = []
+    for icon in new_icons:
+        core = icon[icon.rfind('/') + 1:icon.find('.')].lower()
+        for color, used_with in colors.items():
+            if used_with is not True and core not in used_with:
+                continue
+            variant = 'min/icon/' + color + '/' + icon[icon.rfind('/') + 1:].lower()
+            variants.append(variant)
+            # Recorded so pages rendered by PHP can find the variant without touching the disk (see icon in common.php)
+            g_manifest.stage('variant/' + color + '/' + core, { 'icon' : icon })
+            if force or not g_index.exists(variant):
+                wait = [minified[icon]] if icon in minified else []
+                tasks.append(graph.add('icons', variant, lambda icon=icon, color=color, variant=variant: render_icon_variant(icon, color, variant), wait))
+            else:
+                g_manifest.commit('variant/' + color + '/' + core, variant)
+
+    graph.add('icons', 'map', lambda: write_icon_map(js_icon_map, new_icons, variants, old_icons, uses, colors, to_minify, deps), tasks)
+    return out
+
+
+def write_icon_map(js_icon_map, new_icons, variants, old_icons, uses, colors, minified, deps):
+    '''
+    Once every icon has been minified and rendered, writes the sprites and the rest of the
+    given icon map (which already maps each icon to its hash), and marks outdated icons for
+    removal. Returns the lines to print
 
+    Fails without touching the map if any of the given (core, icon, newpath) icons that were
+    supposed to be minified weren't, since the map would point pages at icons that don't exist
+    '''
+    missing = [icon for _, icon, newpath in minified if not g_index.exists(newpath)]
+    if len(missing) != 0:
+        raise RuntimeError('Failed to minify ' + ', '.join(missing) + '. Not writing the icon map')
+
+    out = []
+    changed = len(minified)
+    new_icons = new_icons + variants
+
+    sprites = {}
+    if g_sprite_mode is not None:
+        sprites = write_icon_sprites(variants, uses, colors, deps)
+        new_icons += [sprite for groups in sprites.values() for sprite, _ in groups.values()]
+    inlined = inline_icon_variants(variants)
+
+    # Old icons are removed after the new icon map is published
+    removed = 0
     for icon in old_icons:
-        if not icon.replace('\\', '/') in new_icons:
-            os.remove(icon)
-            changed = -1
+        icon = icon.replace('\\', '/')
+        if not icon in new_icons:
+            g_stale_files.append(icon)
+            removed += 1
+
+    for key in g_manifest.keys('icon/'):
+        if not any(icon.startswith('min/icon/' + key[5:] + '.') for icon in new_icons):
+            g_manifest.forget(key)
+    for key in g_manifest.keys('variant/'):
+        if not any(variant.startswith('min/icon/' + key[8:] + '.') for variant in variants):
+            g_manifest.forget(key)
+
+    if changed != 0:
+        out.append('  Modified ' + str(changed) + ' icon' + ('' if changed == 1 else 's'))
+    if removed != 0:
+        out.append('  Removing ' + str(removed) + ' outdated icon file' + ('' if removed == 1 else 's'))
+
+    js_icon_map += '''
+    };
 
-    if changed == 0:
-        print('Icons up to date!\n')
-    else:
-        if changed != -1:
-            print('  Modified', changed, 'icon' + ('' if changed == 1 else 's'))
+    // Colors that icons have been pre-rendered in, either for all icons or a specific set.
+    // Any other color is recolored on demand by svg.php
+    let _rendered =
+    {'''
+    for color in sorted(colors):
+        used_with = colors[color]
+        if used_with is not True:
+            used_with = '{ ' + ', '.join(icon + ' : true' for icon in sorted(used_with)) + ' }'
+        else:
+            used_with = 'true'
+        js_icon_map += '\n        "' + color + '" : ' + used_with + ','
+    js_icon_map += '''
+    };
 
-        print('  Writing icon map...')
-        js_icon_map += '''
+    // Icons that are small enough to be embedded directly, by color
+    let _inline =
+    {'''
+    for color in sorted(inlined):
+        js_icon_map += '\n        "' + color + '" :\n        {'
+        for icon in sorted(inlined[color]):
+            js_icon_map += '\n            ' + icon + ' : "' + inlined[color][icon] + '",'
+        js_icon_map += '\n        },'
+    js_icon_map += '''
     };
 
-    this.get = function(icon)
+    // Sprite sheets containing the icons used together''' + (' on each page' if g_sprite_mode == 'page' else '') + ''', by color.
+    // Each icon is a <view> in the sheet, referenced by fragment (sheet.svg#icon)
+    let _sprites =
+    {'''
+    for group in sorted(sprites):
+        indent = '\n        '
+        if g_sprite_mode == 'page':
+            js_icon_map += '\n        "' + group + '" :\n        {'
+            indent += '    '
+        for color in sorted(sprites[group]):
+            sprite, icons = sprites[group][color]
+            js_icon_map += indent + '"' + color + '" : ["' + sprite[sprite.rfind('/') + 1:] + '", { ' + ', '.join(icon + ' : true' for icon in icons) + ' }],'
+        if g_sprite_mode == 'page':
+            js_icon_map += '\n        },'
+    js_icon_map += '''
+    }'''
+    if g_sprite_mode == 'page':
+        js_icon_map += '''[location.pathname.substring(location.pathname.lastIndexOf("/") + 1).split(".")[0] || "index"] || {}'''
+    js_icon_map += ''';
+
+    let getColor = function(icon, color)
     {
-        return `i/c1c1c1/${icon}.${_map[icon]}.svg`;
+        const lower = color.toLowerCase();
+        if (_inline[lower] && _inline[lower][icon])
+        {
+            return _inline[lower][icon];
+        }
+
+        const sprite = _sprites[lower];
+        if (sprite && sprite[1][icon])
+        {
+            return `min/icon/sprite/${sprite[0]}#${icon}`;
+        }
+
+        const rendered = _rendered[lower];
+        if (rendered === true || (rendered && rendered[icon]))
+        {
+            return `min/icon/${lower}/${icon}.${_map[icon]}.svg`;
+        }
+
+        return `i/${color}/${icon}.${_map[icon]}.svg`;
     };
 
-    this.getColor = function(icon, color)
+    this.get = function(icon)
     {
-        return `i/${color}/${icon}.${_map[icon]}.svg`;
+        return getColor(icon, "''' + DEFAULT_ICON_COLOR + '''");
     };
+
+    this.getColor = getColor;
 }();
 
 '''
-        js_icon_map = js_icon_map.replace('\\', '/')
+    js_icon_map = js_icon_map.replace('\\', '/')
+    # Only write the map when it actually changes, since every page that uses icons depends on it
+    map_changed = get_lines('script/iconMap.js') != js_icon_map
+    if map_changed:
+        out.append('  Writing icon map...')
         with open('script/iconMap.js', 'w+') as js_icon_file:
             js_icon_file.write(js_icon_map)
-        print('Done processing icons\n')
+        g_index.add('script/iconMap.js')
+
+    if changed == 0 and removed == 0 and not map_changed:
+        out += ['Icons up to date!', '']
+    else:
+        out += ['Done processing icons', '']
+    return out
+
+
+DEFAULT_ICON_COLOR = 'c1c1c1'
+
+def find_icon_colors(uses):
+    '''
+    Returns a map of lowercase colors to the set of (lowercase) icons used with that color across
+    all the given script uses (see find_icon_uses) and our stylesheets, or True if the color is used
+    with an icon we can't determine statically (e.g. Icons.getColor(name, "FFF")). Colors that aren't
+    literals (e.g. Icons.getColor("edit", statusColors[status])) are left to svg.php. Like script uses,
+    the icons each stylesheet references are kept in the build manifest until it changes
+    '''
+    colors = { DEFAULT_ICON_COLOR : True }
+    for script_colors in uses.values():
+        for color, icons in script_colors.items():
+            for icon in ([None] if icons is True else icons):
+                add_icon_color(colors, icon, color)
+
+    styles = g_index.find('style', suffix='.css')
+    for style in styles:
+        found = g_manifest.scan('icon_colors', style)
+        if found is None:
+            found = [[color.lower(), icon.lower()] for color, icon in re.findall(r'\bi/([0-9a-fA-F]{3}|[0-9a-fA-F]{6})/(\w+)\.', get_lines(style))]
+            g_manifest.set_scan('icon_colors', style, found)
+        for color, icon in found:
+            add_icon_color(colors, icon, color)
+    g_manifest.prune_scans('icon_colors', set(styles))
+    return colors
+
+
+def find_icon_uses():
+    '''
+    Looks through our scripts for calls to Icons.get/Icons.getColor, returning a map of
+    each script's name to the colors it uses each icon with (in the form find_icon_colors returns).
+    What each script uses is kept in the build manifest, so only scripts that changed are tokenized
+    '''
+    uses = {}
+    scripts = [script for script in g_index.find('script', suffix='.js') if script != 'script/iconMap.js']
+    for script in scripts:
+        found = g_manifest.scan('icon_uses', script)
+        if found is None:
+            found = { color : (True if icons is True else sorted(icons)) for color, icons in find_script_icon_uses(script).items() }
+            g_manifest.set_scan('icon_uses', script, found)
+        uses[script[script.find('/') + 1:script.rfind('.')]] = { color : (True if icons is True else set(icons)) for color, icons in found.items() }
+    g_manifest.prune_scans('icon_uses', set(scripts))
+    return uses
+
+
+def find_script_icon_uses(script):
+    '''Returns the colors the given script uses each icon with (see find_icon_uses)'''
+    colors = {}
+    tokens = [token for token in tokenize_js(get_lines(script)) if token[0] not in ('ws', 'comment')]
+    for i in range(len(tokens) - 3):
+        if tokens[i][1] != 'Icons' or tokens[i + 1][1] != '.' or tokens[i + 2][1] not in ('get', 'getColor') or tokens[i + 3][1] != '(':
+            continue
+
+        # Split the arguments at top-level commas
+        args = [[]]
+        depth = 0
+        for token in tokens[i + 4:]:
+            depth += 1 if token[1] in ('(', '[', '{') else -1 if token[1] in (')', ']', '}') else 0
+            if depth < 0:
+                break
+            if depth == 0 and token[1] == ',':
+                args.append([])
+            else:
+                args[-1].append(token)
+
+        icon = args[0][0][1][1:-1].lower() if len(args[0]) == 1 and args[0][0][0] == 'string' else None
+        if tokens[i + 2][1] == 'get':
+            color = DEFAULT_ICON_COLOR
+        elif len(args) > 1 and len(args[1]) == 1 and args[1][0][0] == 'string':
+            color = args[1][0][1][1:-1].lower()
+        else:
+            continue
+        add_icon_color(colors, icon, color)
+    return colors
+
+
+def add_icon_color(colors, icon, color):
+    '''Records that the given icon (or any icon, if None) is used with the given color'''
+    if not re.match(r'^([0-9a-f]{3}|[0-9a-f]{6})$', color) or colors.get(color) is True:
+        return
+    if icon is None:
+        colors[color] = True
+    else:
+        colors.setdefault(color, set()).add(icon)
+
 
-def minify_svg(icon, newpath, quiet):
+g_sprite_mode = None
+g_inline_icons = 0
+
+def write_icon_sprites(variants, uses, colors, deps):
+    '''
+    Combines the pre-rendered icon variants into sprite sheets, one per color, either for the
+    whole site (-sprite global) or for each page from the icons its scripts use (-sprite page).
+    Returns a map of each group ('all', or the page name) to the sprite written for each
+    color, along with the icons it contains
+    '''
+    by_color = {}
+    for variant in variants:
+        color = variant.split('/')[2]
+        icon = variant[variant.rfind('/') + 1:variant.find('.')]
+        if g_index.exists(variant):
+            by_color.setdefault(color, {})[icon] = variant
+
+    groups = { 'all' : colors }
+    if g_sprite_mode == 'page' and deps is not None:
+        groups = {}
+        for page, includes in get_page_deps(g_index.find('.', suffix='.php'), deps).items():
+            scripts = list(includes)
+            for deferred in deps.deferred(page):
+                scripts += deps.scripts(deferred)
+            page_colors = {}
+            for script in scripts:
+                for color, icons in uses.get(script, {}).items():
+                    for icon in ([None] if icons is True else icons):
+                        add_icon_color(page_colors, icon, color)
+            groups[page] = page_colors
+
+    sprites = {}
+    mkdir_if_absent('min/icon/sprite')
+    for group, group_colors in groups.items():
+        for color, icons in group_colors.items():
+            available = by_color.get(color, {})
+            icons = sorted(available if icons is True else (icon for icon in icons if icon in available))
+            if len(icons) < 2:
+                continue # Nothing to combine
+
+            sheet = build_icon_sprite([(icon, available[icon]) for icon in icons])
+            hashed = hashlib.md5(sheet.encode('utf-8')).hexdigest()[:10]
+            sprite = 'min/icon/sprite/' + color + '.' + hashed + '.svg' # Pages that use the same icons share a sheet
+            if not g_index.exists(sprite):
+                with open(sprite + '.tmp', 'w') as out:
+                    out.write(sheet)
+                os.replace(sprite + '.tmp', sprite)
+                g_index.add(sprite)
+            sprites.setdefault(group, {})[color] = (sprite, icons)
+    return sprites
+
+
+def build_icon_sprite(icons):
+    '''
+    Returns a sprite sheet containing the given (name, path) icons. Each icon becomes a <symbol>
+    that's drawn below the previous one, with a <view> of the same name as the icon that shows
+    just that icon, so an <img> can reference it as sprite.svg#name and keep its aspect ratio
+    '''
+    symbols = ''
+    views = ''
+    offset = 0
+    for name, path in icons:
+        svg = get_lines(path)
+        match = re.search(r'<svg\b([^>]*)>(.*)</svg>', svg, re.DOTALL)
+        attributes = dict(re.findall(r'([\w:-]+)\s*=\s*"([^"]*)"', match.group(1)))
+        body = match.group(2)
+        view_box = attributes.get('viewBox', '0 0 ' + attributes.get('width', '24').replace('px', '') + ' ' + attributes.get('height', '24').replace('px', ''))
+        width, height = (float(value) for value in view_box.replace(',', ' ').split()[2:4])
+
+        # Keep inherited presentation attributes (e.g. fill="none"), but drop the ones that only apply to the root
+        kept = ''.join(f' {key}="{value}"' for key, value in attributes.items()
+            if key not in ('id', 'class', 'viewBox', 'width', 'height', 'x', 'y', 'version', 'xml:space') and not key.startswith('xmlns'))
+
+        # ids and classes have to be unique across the whole sheet
+        body = re.sub(r'\bid="([^"]+)"', lambda m: f'id="{name}-{m.group(1)}"', body)
+        body = re.sub(r'(url\(\s*|href=")#([^)"\s]+)', lambda m: f'{m.group(1)}#{name}-{m.group(2)}', body)
+        body = re.sub(r'\bclass="([^"]+)"', lambda m: 'class="' + ' '.join(f'{name}-{cls}' for cls in m.group(1).split()) + '"', body)
+        body = re.sub(r'(<style[^>]*>)(.*?)(</style>)', lambda m: m.group(1) + re.sub(r'\.(-?[_a-zA-Z][\w-]*)', f'.{name}-\\1', m.group(2)) + m.group(3), body, flags=re.DOTALL)
+        symbols += f'<symbol id="s-{name}" viewBox="{view_box}"{kept}>{body}</symbol>'
+        views += f'<view id="{name}" viewBox="0 {offset:g} {width:g} {height:g}"/>' \
+            f'<use href="#s-{name}" xlink:href="#s-{name}" y="{offset:g}" width="{width:g}" height="{height:g}"/>'
+        offset += height + 1 # Leave a gap so neighboring icons don't bleed into each other when scaled
+    return '<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink">' + symbols + views + '</svg>'
+
+
+def inline_icon_variants(variants):
+    '''
+    Returns a map of colors to the icons whose pre-rendered variant in that color is no larger
+    than the -inlineicons threshold, along with the data URI to use for it
+    '''
+    inlined = {}
+    if g_inline_icons <= 0:
+        return inlined
+    for variant in variants:
+        stat = g_index.stat(variant)
+        if stat is None or stat[0] > g_inline_icons:
+            continue
+        svg = re.sub(r'\s+', ' ', get_lines(variant)).strip()
+        icon = variant[variant.rfind('/') + 1:variant.find('.')]
+        inlined.setdefault(variant.split('/')[2], {})[icon] = 'data:image/svg+xml,' + urllib.parse.quote(svg, safe=' /=:;,\'')
+    return inlined
+
+
+def render_icon_variant(icon, color, variant):
+    '''Writes a copy of the given minified icon with its fill set to the given color'''
+    if not g_index.exists(icon):
+        return [] # Failed to minify, which has already been reported
+    mkdir_if_absent(variant[:variant.rfind('/')])
+    with open(icon, 'r') as source:
+        svg = source.read()
+    with open(variant + '.tmp', 'w') as out:
+        out.write(re.sub('FILL_COLOR', '#' + color, svg, flags=re.IGNORECASE))
+    os.replace(variant + '.tmp', variant)
+    g_manifest.commit('variant/' + color + '/' + variant[variant.rfind('/') + 1:variant.find('.')], variant)
+    return []
+
+def minify_svgs(batch, quiet):
+    '''
+    Minifies the given (core, icon, newpath) svg icons with a single svgo invocation
+    (or the node helper, if it's running), returning the lines to print
+    '''
+    out = []
+    remaining = []
+    for core, icon, newpath in batch:
+        out.append('  Copying ' + "'" + icon + "' to " + "'" + newpath + "'")
+        result = server_minify('svgo', get_lines(icon), icon)
+        if result is not None:
+            with open(newpath, 'w+') as min_file:
+                min_file.write(result[0])
+            g_manifest.commit('icon/' + core, newpath)
+        else:
+            remaining.append((core, icon, newpath))
+
+    if len(remaining) == 0:
+        return out
+
+    inputs = [icon for _, icon, _ in remaining]
+    outputs = [newpath for _, _, newpath in remaining]
     system = platform.system()
     if system == 'Windows':
-        cmd = 'node.exe ' + os.environ['APPDATA'] + r'\npm\node_modules\svgo\bin\svgo ' + icon + ' -o ' + newpath
+        cmd = 'node.exe ' + os.environ['APPDATA'] + r'\npm\node_modules\svgo\bin\svgo ' + ' '.join(inputs) + ' -o ' + ' '.join(outputs)
     elif system == 'Linux':
-        cmd = ['svgo', icon, '-o', newpath]
+        cmd = ['svgo'] + inputs + ['-o'] + outputs
     else:
-        print('Unsupported OS:', os)
-    output = subprocess.check_output(cmd, stderr=subprocess.STDOUT).decode('utf-8')
+        raise RuntimeError('Unsupported OS: ' + system)
+    output = run_tool(cmd, 'svgo', ', '.join(inputs))
     if not quiet and len(output) != 0:
-        print(output)
-        print()
+        out.append(output)
+        out.append('')
+
+    # svgo can exit cleanly without writing everything it was given, so only
+    # commit what's actually there. write_icon_map reports anything missing
+    for core, _, newpath in remaining:
+        if os.path.exists(newpath):
+            g_manifest.commit('icon/' + core, newpath)
+    return out
+
+def process_css(files, deps, force, quiet, csso, jobs, prune=False):
+    '''Processes css on its own (see add_css_tasks), returning the number of tasks that failed'''
+    graph = TaskGraph(jobs)
+    add_css_tasks(graph, files, deps, force, quiet, csso, prune)
+    return graph.run()
 
-def process_css(files, deps, force, quiet, csso):
+
+def add_css_tasks(graph, files, deps, force, quiet, csso, prune=False, icons=None):
     '''
-    Processes css includes for each page, bundles them into a temp
-    file, and runs clean-css-cli on it.
+    Adds a task for each page to the given graph that processes its css includes, bundles
+    them in memory, and streams the bundle through csso or clean-css-cli (see find_css_minifier).
+    If prune is True, rules that can't match anything the page produces are removed first. The
+    icon map is one of those sources, so pruned pages that use it wait for the given icons task.
+
+    Returns the tasks, which finish once each page's stylesheet has been written
     '''
-    print('Looking for updated CSS...')
-    modified_dates = get_modified_dates('style/*.css')
-    modified_any = False
+    lines = ['Looking for updated CSS...']
+    minifier = find_css_minifier(csso)
+    requested = 'csso' if csso else 'cleancss'
+    if not g_dev and minifier is not None and minifier != requested:
+        lines.append(f'WARN: {TOOL_PACKAGES[requested][0]} is not installed, using {TOOL_PACKAGES[minifier][0]} instead')
+    graph.note(lines)
+    modified = []
+    pruned = {}
+    flags = { 'csso' : minifier == 'csso', 'daemon' : minify_server_mode() }
+    tool = tool_version(minifier or requested)
+    tasks = []
     for file in files:
-        includes = get_css_deps(file, deps)
-        if len(includes) == 0:
-            continue
-        if not force and not needs_parse(file, includes, modified_dates, 'min/style/' + file[:file.rfind('.')] + '.*.min.css'):
-            if not quiet:
-                print(file, 'up to date')
-            continue
-        combined = ''
+        wait = [icons] if prune and icons is not None and ICON_MAP in get_page_scripts(file, deps) else []
+        tasks.append(graph.add('css', file, lambda file=file: bundle_css(graph, file, deps, force, quiet, minifier, prune, flags, tool, modified, pruned), wait))
+    graph.add(None, None, lambda: report_css(modified, pruned, quiet), tasks)
+    return tasks
+
+
+def bundle_css(graph, file, deps, force, quiet, minifier, prune, flags, tool, modified, pruned):
+    '''
+    Bundles the stylesheets for the given page if they changed, adding a task to minify the
+    bundle. Pages that were bundled are added to modified, and the size of each pruned bundle
+    before and after pruning is added to pruned. Returns the lines to print
+    '''
+    includes = get_css_deps(file, deps)
+    if len(includes) == 0:
+        return []
+    key = 'style/' + file[:file.rfind('.')]
+    inputs = ['style/' + include + '.css' for include in includes]
+    page_flags = flags
+    assets = sorted(set(asset for include in includes for asset in get_css_assets('style/' + include + '.css').values()))
+    if len(assets) != 0:
+        # Editing an image only invalidates the bundles that reference it
+        page_flags = dict(flags, assets=assets)
+        inputs += assets
+    if prune:
+        # Pruning depends on everything the page can produce, not just its styles
+        page_flags = dict(page_flags, prune=True)
+        inputs += [CSS_SAFELIST] + get_page_sources(file, deps)
+    if not needs_parse(key, includes, inputs, page_flags, tool, force):
+        return [] if quiet else [file + ' up to date']
+    bundle = Bundle()
+    with profile('concatenate', file=key):
         for include in includes:
             include_file = 'style/' + include + '.css'
-            combined += '/* ' + include + '.css */\n' + get_lines(include_file) + '\n\n'
-        write_temp(file, combined, 'css')
-        tmp_file = 'tmp' + os.sep + file[:file.rfind('.')] + '.tmp.css'
-        base_file = file[file.find(os.sep) + 1:file.find('.')]
-        for existing in glob.glob('min/style/' + base_file + '.*.min.css'):
-            os.remove(existing)
-        file_hash = get_hash(tmp_file)
-        clean_file = base_file + '.' + file_hash + '.min.css'
-        system = platform.system()
-        modified_any = True
-        if system == 'Windows':
-            print('Minifying', clean_file)
-            cmd_params = (' ' + tmp_file + ' -o min\\style\\' + clean_file) if csso else (' -O2 -o min\\style\\' + clean_file + ' ' + tmp_file)
-            cmd = 'node.exe ' + os.environ['APPDATA'] + r'\npm\node_modules'
-            cmd += r'\csso-cli\bin\csso ' if csso else r'\clean-css-cli\bin\cleancss '
-            cmd += cmd_params
-            output = subprocess.check_output(cmd, stderr=subprocess.STDOUT).decode('utf-8')
-            if len(output) != 0:
-                print('   ', output)
+            bundle.append('/* ' + include + '.css */\n' + rewrite_css_urls(include_file) + '\n\n')
+    if prune:
+        before = len(bundle.text())
+        with profile('prune', file=key):
+            combined = prune_css(bundle.text(), get_used_selectors(file, deps), get_css_safelist(file))
+        pruned[file[:file.rfind('.')]] = (before, len(combined))
+        bundle = Bundle()
+        bundle.append(combined)
+    base_file = file[file.find(os.sep) + 1:file.find('.')]
+    modified.append(file)
+    graph.add('minify', base_file + '.css', lambda: minify_css(key, bundle, base_file, minifier))
+    return []
+
+
+def report_css(modified, pruned, quiet):
+    '''Returns the lines summarizing the stylesheets that were built'''
+    out = []
+    if len(modified) == 0 and quiet:
+        out.append('CSS up to date!')
+    if len(pruned) != 0:
+        out += report_pruned_css(pruned)
+    out.append('')
+    return out
+
+
+def find_css_minifier(csso):
+    '''
+    Returns the minifier to use for stylesheets ('csso' if csso is True, otherwise 'cleancss'),
+    falling back to the other one if it isn't installed. Returns None if neither is
+    '''
+    tools = ['csso', 'cleancss'] if csso else ['cleancss', 'csso']
+    if platform.system() == 'Windows' or g_minify_server is not None:
+        return tools[0]
+    for tool in tools:
+        if shutil.which(tool) is not None:
+            return tool
+    return None
+
+
+def minify_css(key, bundle, name, minifier):
+    '''
+    Minifies the given css bundle with the given minifier (see find_css_minifier), returning the
+    lines to print. Without a minifier, fails rather than publish an unminified stylesheet
+    '''
+    if g_dev:
+        return ['Copying ' + write_css(key, name, bundle.text()) + ' (unminified)']
+
+    if minifier is None:
+        raise RuntimeError('Could not minify ' + name + '.css: neither csso nor clean-css-cli is installed')
+
+    cache_key = artifact_key(minifier, ['minify'], bundle.text())
+    cached = fetch_artifact(cache_key)
+    if cached is not None:
+        return ['Minifying ' + write_css(key, name, cached[0]) + ' (cached)']
+
+    result = server_minify(minifier, bundle.text(), key + '.css')
+    if result is not None:
+        minified, output, _ = result
+    elif platform.system() == 'Windows':
+        cmd = 'node.exe ' + os.environ['APPDATA'] + r'\npm\node_modules'
+        cmd += r'\csso-cli\bin\csso' if minifier == 'csso' else r'\clean-css-cli\bin\cleancss -O2'
+        minified, output = run_tool(cmd, minifier, key, bundle.text())
+    else:
+        cmd = ['csso'] if minifier == 'csso' else ['cleancss', '-O2']
+        minified, output = run_tool(cmd, minifier, key, bundle.text())
+    store_artifact(cache_key, minified, output)
+    out = ['Minifying ' + write_css(key, name, minified)]
+    if len(output) != 0:
+        out.append('    ' + output)
+    return out
+
+
+def write_css(key, name, contents):
+    '''Writes the given page's finished stylesheet bundle, returning its file name'''
+    clean_file = name + '.' + content_hash(contents) + '.min.css'
+    write_bundle('min/style/' + clean_file, contents)
+    g_manifest.commit(key, 'min/style/' + clean_file)
+    return clean_file
+
+
+def get_css_deps(file, deps):
+    '''Gets the stylesheets for the given php file, in the order they should be bundled'''
+    return list(deps.page_styles(file[:file.rfind('.')]))
+
+
+CSS_URL_REGEX = re.compile(r'''url\(\s*(["']?)([^"')]+)\1\s*\)''')
+
+def get_css_assets(file):
+    '''
+    Returns a map of the url() references in the given stylesheet that point to local files,
+    to the path of the file they reference (relative to the project root)
+    '''
+    assets = {}
+    for _, url in CSS_URL_REGEX.findall(get_lines(file)):
+        path = resolve_asset(url, file[:file.rfind('/') + 1])
+        if path is not None:
+            assets[url] = path
+    return assets
+
+
+def resolve_asset(url, base):
+    '''
+    Returns the local file the given url refers to, or None if it isn't a local file. Relative
+    urls are relative to the given directory. Absolute urls include the directory the site is
+    hosted under (e.g. /plex/res/noise.png), so the first segment is dropped if needed
+    '''
+    if re.match(r'^([a-z]+:|//|#)', url, re.IGNORECASE):
+        return None # data URI, external, or fragment
+    path = re.split(r'[?#]', url)[0]
+    if path.startswith('/'):
+        candidates = [path[1:], path[path.find('/', 1) + 1:] if path.find('/', 1) != -1 else None]
+    else:
+        candidates = [os.path.normpath(base + path).replace('\\', '/')]
+    for candidate in candidates:
+        if candidate is not None and not candidate.startswith('..') and os.path.isfile(candidate):
+            return candidate
+    return None
+
+
+def rewrite_css_urls(file):
+    '''
+    Returns the contents of the given stylesheet with every url() that references a local file
+    pointed at that file's content-hashed copy in min/asset instead, publishing it if needed
+    '''
+    assets = get_css_assets(file)
+    def rewrite(match):
+        url = match.group(2)
+        if url not in assets:
+            return match.group(0)
+        suffix = url[len(re.split(r'[?#]', url)[0]):] # Keep any fragment (e.g. sprite.svg#icon)
+        output = publish_static_asset(assets[url])
+        return 'url("../asset/' + output[output.rfind('/') + 1:] + suffix + '")'
+    return CSS_URL_REGEX.sub(rewrite, get_lines(file))
+
+
+def publish_static_asset(path):
+    '''
+    Copies the given file (e.g. res/noise.png) to min/asset with its content hash in its name so it
+    can be cached indefinitely, returning the new path. Nothing is copied if it's already up to date
+    '''
+    hashed = g_manifest.file_hash(path)[:10]
+    stem, ext = static_asset_name(path)
+    output = 'min/asset/' + stem + '.' + hashed + ext
+    key = 'asset/' + path
+    g_manifest.stage(key, { 'hash' : hashed })
+    if not g_index.exists(output):
+        # Stylesheets are bundled concurrently, and several can publish the same asset at once
+        tmp_path = f'{output}.{threading.get_ident()}.tmp'
+        shutil.copyfile(path, tmp_path)
+        os.replace(tmp_path, output)
+    g_manifest.commit(key, output)
+    return output
+
+
+def static_asset_name(path):
+    '''Returns the name (without hash) and extension the given asset is published under'''
+    stem, ext = os.path.splitext(path.replace('/', '-'))
+    return stem, ext
+
+
+PAGE_ASSET_REGEX = re.compile(r'''\basset\(\s*["']([^"']+)["']\s*\)''')
+
+def process_static_assets(files):
+    '''
+    Publishes the static assets pages reference via asset() (see common.php), then forgets any
+    previously published asset that neither a page nor a current stylesheet references anymore.
+    Returns the lines to print
+    '''
+    out = []
+    referenced = set()
+    for file in files:
+        for path in PAGE_ASSET_REGEX.findall(get_lines(file)):
+            if os.path.isfile(path):
+                publish_static_asset(path)
+                referenced.add(path)
+            else:
+                out.append('WARN: Could not find asset ' + path + ' referenced by ' + file)
+
+    for key in g_manifest.keys('style/'):
+        referenced.update(g_manifest.state(key)['flags'].get('assets', []))
+    for key in g_manifest.keys('asset/'):
+        if key[6:] not in referenced:
+            g_stale_files.append(g_manifest.output(key))
+            g_manifest.forget(key)
+    return out
+
+
+CSS_SAFELIST = 'includes/css_safelist.json'
+
+# Selectors that match without the page having to produce anything
+CSS_ALWAYS_USED = { 'html', 'body', 'head', '*' }
+
+def get_css_safelist(file):
+    '''
+    Returns the class names, ids, and tags that -prune must assume the given page uses, from
+    css_safelist.json (under "*" or the page's name). Entries ending in '*' match any name with that
+    prefix, for class names that are built at runtime (e.g. "status" + status)
+    '''
+    safelist = get_lines(CSS_SAFELIST)
+    if len(safelist) == 0:
+        return []
+    safelist = json.loads(safelist)
+    return safelist.get('*', []) + safelist.get(file[:file.rfind('.')], [])
+
+
+def get_page_sources(file, deps):
+    '''
+    Returns every file that can add markup to the given page: its template and everything it includes,
+    its scripts, and the endpoints its scripts request HTML from (e.g. process_request.php)
+    '''
+    scripts = ['script/' + script + '.js' for script in get_page_scripts(file, deps)]
+    endpoints = set()
+    for script in scripts:
+        endpoints.update(re.findall(r'["\'`](\w+\.php)\b', get_lines(script)))
+    return get_page_templates([file] + sorted(endpoints)) + scripts
+
+
+def get_page_templates(files):
+    '''Returns the given php files and every php/html file they (transitively) include'''
+    templates = []
+    pending = list(reversed(files))
+    while len(pending) != 0:
+        template = pending.pop()
+        if template in templates or template.startswith('includes/cache/') or not os.path.exists(template):
+            continue # Generated files (e.g. the asset manifest) can't add markup
+        templates.append(template)
+        for included in re.findall(r'\b(?:include|require)(?:_once)?\s*\(?\s*["\']([^"\']+\.(?:php|html))["\']', get_lines(template)):
+            pending += [included, 'includes/' + included]
+    return templates
+
+
+def get_page_scripts(file, deps):
+    '''Returns every script the given page loads, including deferred ones'''
+    page = file[:file.rfind('.')]
+    scripts = get_deps(file, deps)
+    if page in deps:
+        for deferred in deps.deferred(page):
+            scripts += [script for script in deps.scripts(deferred) if script not in scripts]
+    return scripts
+
+
+def get_used_selectors(file, deps):
+    '''
+    Returns every word in the given page's sources. Any class name, id, or tag a page can produce
+    has to appear in one of them somewhere, so a selector that needs anything else can't match
+    '''
+    used = set(CSS_ALWAYS_USED)
+    for source in get_page_sources(file, deps):
+        used.update(re.findall(r'[A-Za-z_][\w-]*', get_lines(source)))
+    return used
+
+
+def prune_css(css, used, safelist):
+    '''
+    Removes rules from the given stylesheet whose selectors need a class name, id, or tag that isn't
+    in the given set of used words or the safelist. Selectors are removed individually from selector
+    lists, and @media/@supports blocks are pruned recursively, then dropped if empty. Other at-rules
+    (@keyframes, @font-face, etc.) are kept as-is. Comments are dropped.
+    '''
+    prefixes = tuple(entry[:-1] for entry in safelist if entry.endswith('*'))
+    used = used | set(entry for entry in safelist if not entry.endswith('*'))
+    def is_used(name):
+        return name in used or (len(prefixes) != 0 and name.startswith(prefixes))
+
+    def can_match(selector):
+        # Pseudo-classes (including :not(...)) and attribute selectors only narrow a match
+        simplified = re.sub(r'::?[\w-]+(\((?:[^()]|\([^()]*\))*\))?', ' ', selector)
+        simplified = re.sub(r'\[[^\]]*\]', ' ', simplified)
+        names = re.findall(r'[.#]([\w-]+)', simplified)
+        names += re.findall(r'(?:^|[\s>+~])([a-zA-Z][\w-]*)', simplified)
+        return all(is_used(name) for name in names)
+
+    def prune(start):
+        # Returns the pruned contents of the block starting at css[start], and the index just past it
+        out = ''
+        i = start
+        while i < len(css):
+            if css.startswith('/*', i):
+                i = css.find('*/', i + 2)
+                i = len(css) if i == -1 else i + 2
+                continue
+            if css[i].isspace():
+                i += 1
+                continue
+            if css[i] == '}':
+                return out, i + 1
+
+            prelude_end = css_find(css, i, '{;}')
+            prelude = re.sub(r'/\*.*?\*/', '', css[i:prelude_end], flags=re.DOTALL).strip()
+            if prelude_end == len(css) or css[prelude_end] != '{':
+                # Statement at-rule (@import, @charset), or a stray declaration
+                out += prelude + (';' if prelude_end < len(css) and css[prelude_end] == ';' else '') + '\n'
+                i = prelude_end + (1 if prelude_end < len(css) and css[prelude_end] == ';' else 0)
+                continue
+
+            if prelude.startswith('@'):
+                if re.match(r'@(media|supports|document|layer)\b', prelude):
+                    inner, i = prune(prelude_end + 1)
+                    if len(inner) != 0:
+                        out += prelude + '\n{\n' + inner + '}\n'
+                else:
+                    end = css_block_end(css, prelude_end)
+                    out += css[i:end] + '\n'
+                    i = end
+                continue
+
+            end = css_block_end(css, prelude_end)
+            selectors = [selector.strip() for selector in css_split(prelude) if can_match(selector)]
+            if len(selectors) != 0:
+                out += ',\n'.join(selectors) + '\n' + css[prelude_end:end] + '\n'
+            i = end
+        return out, i
+
+    return prune(0)[0]
+
+
+def css_find(css, start, chars):
+    '''Returns the index of the first of the given characters at or after start that isn't in a string or comment'''
+    i = start
+    while i < len(css):
+        if css.startswith('/*', i):
+            i = css.find('*/', i + 2)
+            if i == -1:
+                return len(css)
+            i += 2
+            continue
+        if css[i] in ('"', "'"):
+            i = css_string_end(css, i)
+            continue
+        if css[i] in chars:
+            return i
+        i += 1
+    return len(css)
+
+
+def css_string_end(css, start):
+    '''Returns the index just past the string starting at css[start]'''
+    i = start + 1
+    while i < len(css) and css[i] != css[start]:
+        i += 2 if css[i] == '\\' else 1
+    return i + 1
+
+
+def css_block_end(css, start):
+    '''Returns the index just past the block whose opening brace is at css[start]'''
+    depth = 0
+    i = start
+    while i < len(css):
+        i = css_find(css, i, '{}')
+        if i == len(css):
+            break
+        depth += 1 if css[i] == '{' else -1
+        i += 1
+        if depth == 0:
+            break
+    return i
+
+
+def css_split(selectors):
+    '''Splits the given selector list at top-level commas'''
+    parts = ['']
+    depth = 0
+    for char in selectors:
+        depth += 1 if char in '([' else -1 if char in ')]' else 0
+        if char == ',' and depth == 0:
+            parts.append('')
         else:
-            print('Copying', clean_file, 'to main directory')
-            shutil.copyfile(tmp_file, 'min/style/' + clean_file)
-    clean_tmp()
-    if not modified_any and quiet:
-        print('CSS up to date!')
+            parts[-1] += char
+    return parts
+
+
+def report_pruned_css(pruned):
+    '''Returns the lines showing the size of each page's stylesheet before and after pruning'''
+    before = sum(sizes[0] for sizes in pruned.values())
+    after = sum(sizes[1] for sizes in pruned.values())
+    out = ['']
+    out.append(f'Pruned unused CSS from {len(pruned)} stylesheet(s), {before} -> {after} bytes before minification')
+    out.append(f'{"Page":<20} {"Before":>9} {"After":>9}')
+    for page in sorted(pruned):
+        out.append(f'{page:<20} {pruned[page][0]:>9} {pruned[page][1]:>9}')
+    return out
+
+
+# Marks the start of each include in a bundle. Minifiers keep /*! comments, so the markers
+# survive minification and let us attribute the minified bytes to the include they came from.
+# They're removed once the sizes have been recorded
+INCLUDE_MARKER = '/*!{}*/\n'
+INCLUDE_MARKER_REGEX = re.compile(r'/\*!([\w$()]+)\*/\n?')
+
+SIZE_BUDGETS = 'includes/size_budgets.json'
+SIZE_REPORT = 'includes/cache/size_report.json'
+
+def split_bundle(source):
+    '''
+    Splits the given bundle at its include markers, returning a list of (include, text). Anything
+    before the first marker is attributed to "(bundle)"
+    '''
+    parts = []
+    name = '(bundle)'
+    last = 0
+    for match in INCLUDE_MARKER_REGEX.finditer(source):
+        parts.append((name, source[last:match.start()]))
+        name = match.group(1)
+        last = match.end()
+    parts.append((name, source[last:]))
+    return [part for part in parts if len(part[1]) != 0]
+
+
+def strip_include_markers(minified):
+    '''
+    Returns the given minified bundle without its include markers (or any sourceMappingURL
+    comment the minifier added), along with the (start, end) offsets of everything that was removed
+    '''
+    removed = [match.span() for match in INCLUDE_MARKER_REGEX.finditer(minified)]
+    url = re.search(r'\n?//# sourceMappingURL=.*\s*$', minified)
+    if url is not None:
+        removed.append(url.span())
+    stripped = ''
+    last = 0
+    for start, end in removed:
+        stripped += minified[last:start]
+        last = end
+    return stripped + minified[last:], removed
+
+
+def record_bundle_sizes(bundle, min_file, minified, stripped):
+    '''
+    Records the raw (preprocessed), minified, and gzipped size of the given bundle and each
+    of its includes in the manifest, using the include markers in the minified bundle. If
+    the minifier dropped an include's marker, its minified bytes are attributed to the
+    include before it, and its own minified size is recorded as None
+    '''
+    with profile('sizes', file=min_file):
+        data = stripped.encode('utf-8')
+        sizes = { 'raw' : 0, 'min' : len(data), 'gzip' : len(gzip.compress(data, 9, mtime=0)), 'includes' : {} }
+        for name, text in split_bundle(bundle.text()):
+            raw = len(text.encode('utf-8'))
+            sizes['raw'] += raw
+            sizes['includes'].setdefault(name, [0, None, None])[0] += raw
+        for name, text in split_bundle(minified):
+            text = text.encode('utf-8')
+            entry = sizes['includes'].setdefault(name, [0, None, None])
+            entry[1] = (entry[1] or 0) + len(text)
+            entry[2] = (entry[2] or 0) + len(gzip.compress(text, 9, mtime=0))
+    g_manifest.set_bundle_sizes(min_file, sizes)
+
+
+def bundle_sizes(key):
+    '''
+    Returns the sizes recorded for the given bundle's current output (see record_bundle_sizes),
+    or None if it hasn't been built
+    '''
+    output = g_manifest.output(key)
+    if output is None or not g_index.exists(output):
+        return None
+    sizes = g_manifest.bundle_sizes(output)
+    if sizes is None:
+        # Built before sizes were recorded. All we can measure is the output itself
+        with open(output, 'rb') as min_js:
+            data = min_js.read()
+        sizes = { 'raw' : len(data), 'min' : len(data), 'gzip' : len(gzip.compress(data, 9, mtime=0)), 'includes' : {} }
+        g_manifest.set_bundle_sizes(output, sizes)
+    return sizes
+
+
+def page_script_sizes(page):
+    '''
+    Returns the raw, minified, and gzipped size of the scripts the given page loads up front
+    (its bundle and any chunks), broken down by include, or None if the page has no bundle.
+    Deferred scripts are reported separately, since they don't block the page
+    '''
+    key = 'script/' + page
+    state = g_manifest.state(key)
+    if state is None or bundle_sizes(key) is None:
+        return None
+
+    totals = { 'raw' : 0, 'min' : 0, 'gzip' : 0, 'includes' : {}, 'deferred' : None }
+    for bundle in [page] + state['flags'].get('chunks', []):
+        sizes = bundle_sizes('script/' + bundle)
+        if sizes is None:
+            continue
+        for kind in ('raw', 'min', 'gzip'):
+            totals[kind] += sizes[kind]
+        for include, (raw, minified, gzipped) in sizes['includes'].items():
+            totals['includes'][include if bundle == page else bundle + '/' + include] = { 'raw' : raw, 'min' : minified, 'gzip' : gzipped }
+
+    deferred = bundle_sizes('script/' + page + '_deferred') if 'deferred' in state['flags'] else None
+    if deferred is not None:
+        totals['deferred'] = { kind : deferred[kind] for kind in ('raw', 'min', 'gzip') }
+    return totals
+
+
+def measure_options(file, page):
+    '''
+    Returns how many bytes (raw and gzipped, before minification) -ultra, -notmi, and -nolog
+    each save from the given page's bundle. Options the bundle wasn't built with are measured
+    by turning them on, the rest by turning them off
+    '''
+    state = g_manifest.state('script/' + page)
+    flags = state['flags']
+    keep = get_shake_allowlist(file) if flags.get('shake') else None
+    measured = {}
+    def measure(rem_log, ultra):
+        if (rem_log, ultra) not in measured:
+            combined = create_bundle(state['includes'], rem_log, ultra, True, '', keep).text().encode('utf-8')
+            measured[(rem_log, ultra)] = (len(combined), len(gzip.compress(combined, 9, mtime=0)))
+        return measured[(rem_log, ultra)]
+
+    rem_log = flags['rem_log']
+    ultra = flags['ultra']
+    savings = {}
+    variants = { 'notmi' : ((rem_log & ~1, ultra), (rem_log | 1, ultra)), 'nolog' : ((rem_log & ~2, ultra), (rem_log | 2, ultra)) }
+    if 'deferred' not in flags:
+        # Ultra can't be used with deferred scripts, so there's nothing to compare against
+        variants['ultra'] = ((rem_log, False), (rem_log, True))
+    for option, (without, with_option) in variants.items():
+        before, after = measure(*without), measure(*with_option)
+        savings[option] = { 'enabled' : with_option == (rem_log, ultra), 'raw' : before[0] - after[0], 'gzip' : before[1] - after[1] }
+    return savings
+
+
+def report_bundle_sizes(files, path, quiet, top=5):
+    '''
+    Prints the size of the scripts each page loads, the includes that make up most of
+    each bundle, and how much -ultra, -notmi, and -nolog save, and writes the full
+    report to the given JSON file
+    '''
+    global g_enum_report, g_shake_report
+    pages = {}
+    reports = (g_enum_report, g_shake_report)
+    # Measuring options rebuilds every bundle, which shouldn't show up in the next build's reports
+    g_enum_report, g_shake_report = EnumReport(), ShakeReport()
+    try:
+        for file in files:
+            page = file[:file.rfind('.')]
+            sizes = page_script_sizes(page)
+            if sizes is None:
+                continue
+            for include in sizes['includes'].values():
+                include['share'] = round(100 * (include['min'] or 0) / max(sizes['min'], 1), 2)
+            with profile('report', file=file):
+                sizes['options'] = measure_options(file, page)
+            pages[page] = sizes
+    finally:
+        g_enum_report, g_shake_report = reports
+
+    print()
+    print(f'{"Page":<20} {"Raw":>9} {"Min":>9} {"Gzip":>9} {"-ultra":>9} {"-notmi":>9} {"-nolog":>9}')
+    for page in sorted(pages):
+        sizes = pages[page]
+        saved = [sizes['options'][option]['gzip'] if option in sizes['options'] else '-' for option in ('ultra', 'notmi', 'nolog')]
+        print(f'{page:<20} {sizes["raw"]:>9} {sizes["min"]:>9} {sizes["gzip"]:>9} {saved[0]:>9} {saved[1]:>9} {saved[2]:>9}')
+        if quiet:
+            continue
+        largest = sorted(sizes['includes'].items(), key=lambda item: -(item[1]['min'] or 0))[:top]
+        for include, include_sizes in largest:
+            minified = '-' if include_sizes['min'] is None else include_sizes['min']
+            print(f'  {include:<18} {include_sizes["raw"]:>9} {minified:>9} {include_sizes["share"]:>8}%')
+    print('Option savings are gzipped bytes before minification. Full report written to', path)
     print()
 
+    with open(path + '.tmp', 'w') as report_file:
+        json.dump(pages, report_file, indent=4, sort_keys=True)
+    os.replace(path + '.tmp', path)
 
-def get_css_deps(file, deps):
-    res = []
-    raw = file[:file.rfind('.')]
-    if not raw in deps:
-        return res
 
-    includes = deps[raw]['css']
-    if "style" in includes:
-        res.append("style")
+def check_size_budgets(files):
+    '''
+    Checks the scripts each page loads up front against includes/size_budgets.json, returning
+    the number of pages over budget. Budgets are the maximum minified ("min") and/or gzipped
+    ("gzip") bytes, given for all pages ("*") and/or individual pages
+    '''
+    budgets = get_lines(SIZE_BUDGETS)
+    if len(budgets) == 0:
+        return 0
 
-    implicit = []
-    get_css_deps_from_js(raw, deps, implicit)
+    budgets = json.loads(budgets)
+    failures = 0
+    for file in files:
+        page = file[:file.rfind('.')]
+        budget = dict(budgets.get('*', {}))
+        budget.update(budgets.get(page, {}))
+        sizes = page_script_sizes(page) if len(budget) != 0 else None
+        if sizes is None:
+            continue
+        over = [kind for kind in ('min', 'gzip') if kind in budget and sizes[kind] > budget[kind]]
+        for kind in over:
+            print(f'ERROR: {page} loads {sizes[kind]} {kind} bytes of script, over its budget of {budget[kind]}')
+        failures += 1 if len(over) != 0 else 0
+    return failures
 
-    # Some "base" css files should go first to allow overriding by subsequent files
-    base = ["overlay", "nav", "table", "tooltip"]
-    for css in base:
-        if css in implicit:
-            res.append(css)
-    for css in implicit:
-        if css not in res:
-            res.append(css)
 
-    for include in includes:
-        if include != "style" and include != raw:
-            res.append(include)
+def check_long_words(min_letters):
+    '''
+    Checks the current script bundles for tokens that take up the most bytes, gated on the passed in minimum word length
+    '''
+    source = ''
+    for key, output in g_manifest.current_outputs().items():
+        if key.startswith('script/'):
+            source += get_lines(output) + '\n'
 
-    if raw in includes:
-        if raw in res:
-            res.remove(raw)
-        res.append(raw)
-    
-    return res
+    words = {}
+    for match in re.findall(r'\b[$_a-zA-Z][\w]{' + str(int(min_letters) - 1) + r',}\b', source):
+        if not match in words:
+            words[match] = { 'count' : 0, 'bytes' : 0 }
+        words[match]['bytes'] += len(match)
+        words[match]['count'] += 1
+
+    sorted_words = sorted(words.items(), reverse=True, key=lambda x: x[1]['bytes'])
+    for e in sorted_words[:20]:
+        print(f'{e[0]} - {e[1]["bytes"]} bytes ({e[1]["count"]} instances)')
 
 
-def get_css_deps_from_js(dep, deps, res):
-    if not dep in deps:
-        return
+# The generated icon map changes whenever an icon does, so instead of being bundled into (and
+# invalidating) every page that uses icons, it's always built as its own chunk
+ICON_MAP = 'iconMap'
+
+def process_file(file, deps, force, rem_log, ultra, babel, quiet, chunks, out, shake=False):
+    '''
+    Process a single file (if needed), adding any lines to print to out. Scripts that are
+    part of one of the given shared chunks, and the icon map, are left out of the page's bundle.
+    If shake is True, unused top-level declarations are removed from the bundle
+    '''
+
+    lines = get_lines(file)
+    if len(lines) == 0:
+        return False
+
+    includes = get_deps(file, deps)
+    if len(includes) == 0:
+        return False # File has no build_js, so don't build anything
+
+    shared = [module for chunk in chunks for module in chunk[1]]
+    deferred = get_deferred_deps(file, deps, includes, shared)
+    if ultra and len(deferred) != 0:
+        # Ultra's bundle-wide renames assume a single bundle, so just include everything up front
+        out.append('WARN: -ultra does not support deferred scripts, including them in ' + file)
+        includes = includes[:-1] + deferred + includes[-1:]
+        deferred = []
+    chunk_names = [chunk[0] for chunk in chunks]
+    if ICON_MAP in includes or ICON_MAP in deferred:
+        chunk_names.insert(0, ICON_MAP)
+    includes = [include for include in includes if include not in shared and include != ICON_MAP]
+    deferred = [include for include in deferred if include != ICON_MAP]
+
+    page = file[:file.rfind('.')]
+    deferred_path = None
+    if len(deferred) != 0:
+        deferred_path = process_deferred_chunk(page + '_deferred', deferred, includes, force, rem_log, babel, quiet, out)
+    elif g_manifest.output('script/' + page + '_deferred') is not None:
+        # The page no longer has a chunk (e.g. -ultra folded it in), so stop publishing the one from a previous build
+        g_manifest.forget('script/' + page + '_deferred')
+        g_removed_outputs.append('script/' + page + '_deferred')
+
+    key = 'script/' + page
+    inputs = ['script/' + include + '.js' for include in includes]
+    flags = { 'rem_log' : rem_log, 'ultra' : ultra, 'babel' : babel, 'daemon' : minify_server_mode(), 'chunks' : chunk_names }
+    if deferred_path is not None:
+        flags['deferred'] = deferred_path
+
+    # Deferred chunks reach into the page's scope through the loader, which the tree shaker can't see
+    shake = shake and deferred_path is None
+    if shake:
+        flags['shake'] = True
+        inputs += [SHAKE_ALLOWLIST, file]
+    if not needs_parse(key, includes, inputs, flags, tool_version('babel' if babel else 'terser'), force):
+        if not quiet:
+            out.append(file + ' up to date')
+        return False
+
+    loader = ''
+    if deferred_path is not None:
+        loader = deferred_loader(deferred_path, *deferred_interface(includes, deferred))
+    elif len(deps.deferred(page)) != 0:
+        loader = deferred_loader(None)
+    g_bundles[page] = create_bundle(includes, rem_log, ultra, True, loader, get_shake_allowlist(file) if shake else None)
+    return True
+
+
+def get_deferred_deps(file, deps, includes, shared):
+    '''
+    Returns the scripts that make up the given page's deferred chunk: the scripts listed under
+    "defer" in deps.json and their dependencies, minus anything the page (or a shared chunk)
+    already loads up front
+    '''
+    page = file[:file.rfind('.')]
+    if page not in deps:
+        return []
+
+    deferred = []
+    for dep in deps.deferred(page):
+        for include in deps.scripts(dep):
+            if include not in includes and include not in shared and include not in deferred:
+                deferred.append(include)
+    return deferred
+
+
+def process_deferred_chunk(name, modules, includes, force, rem_log, babel, quiet, out):
+    '''
+    Process a page's deferred chunk (if needed), returning the path the page should load
+    it from. The path has to be baked into the page's bundle, so unlike other bundles we
+    determine its final name now rather than after minification, from everything that
+    determines the minified output: the bundle, the minifier and its options, and the mode.
+
+    Like the page's bundle, the chunk is wrapped in its own scope. It gets the declarations
+    it needs from the page's scripts (includes) through the namespace object the page's
+    loader sets up, and adds the declarations the page needs to it (see deferred_loader)
+    '''
+    key = 'script/' + name
+    # Which declarations are shared depends on the page's scripts too
+    inputs = ['script/' + include + '.js' for include in modules + includes]
+    flags = { 'rem_log' : rem_log, 'ultra' : False, 'babel' : babel, 'daemon' : minify_server_mode(), 'scoped' : True }
+    if not needs_parse(key, modules, inputs, flags, tool_version('babel' if babel else 'terser'), force):
+        if not quiet:
+            out.append(name + ' up to date')
+        return g_manifest.output(key)
+
+    imports, exports = deferred_interface(includes, modules)
+    prelude = ''
+    if len(imports) != 0:
+        prelude = f'/* deferred imports */\nconst {{ {", ".join(imports)} }} = window.{DEFERRED_NAMESPACE};\n\n'
+    epilogue = f'/* deferred exports */\nObject.assign(window.{DEFERRED_NAMESPACE}, {{ {", ".join(exports)} }});\n'
+    bundle = create_bundle(modules, rem_log, False, True, prelude, epilogue=epilogue)
+    tool = 'babel' if babel else 'terser'
+    state = json.dumps([tool, tool_version(tool), minify_options(babel), minify_server_mode()])
+    bundle.path = 'min/script/' + name + '.' + content_hash(state + bundle.text()) + '.min.js'
+    g_bundles[name] = bundle
+    return bundle.path
+
+
+def deferred_interface(includes, deferred):
+    '''
+    Returns the names a page's deferred chunk imports (top-level declarations in the page's
+    scripts that the chunk's scripts reference) and exports (top-level declarations in the
+    chunk's scripts that the page's scripts reference), both sorted. consolelog is left out,
+    since it isn't scoped
+    '''
+    declared = ([], [])
+    referenced = ([], [])
+    for side, scripts in enumerate((includes, deferred)):
+        for include in scripts:
+            if include == 'consolelog':
+                continue
+            for statement in split_top_level(tokenize_js(get_lines('script/' + include + '.js'))):
+                declared[side].extend(statement['names'])
+                referenced[side].extend(statement['references'])
+    page_names, chunk_names = set(declared[0]), set(declared[1])
+    imports = sorted((set(referenced[1]) & page_names) - chunk_names)
+    exports = sorted((set(referenced[0]) & chunk_names) - page_names)
+    return imports, exports
+
+
+DEFERRED_NAMESPACE = 'DeferredScripts'
+
+def deferred_loader(path, imports=(), exports=()):
+    '''
+    Returns the loader added to bundles of pages with deferred scripts. Pages call
+    loadDeferred(), which returns a promise that resolves once the deferred chunk has been
+    loaded. If path is None, the deferred scripts are already part of the bundle.
+
+    Before adding the chunk, the loader sets up a namespace object with getters for the
+    page's declarations the chunk imports. The chunk adds the declarations the page uses to
+    it, which are then copied to variables in the page's scope, so both bundles stay scoped
+    '''
+    if path is None:
+        return '/* deferred loader */\nfunction loadDeferred() { return Promise.resolve(); }\n\n'
+
+    loader = '/* deferred loader */\n'
+    if len(exports) != 0:
+        loader += 'let ' + ', '.join(exports) + ';\n'
+    loader += 'let g_deferred = null;\n' + \
+        'function loadDeferred()\n' + \
+        '{\n' + \
+        '    if (!g_deferred)\n' + \
+        '    {\n' + \
+        f'        window.{DEFERRED_NAMESPACE} =\n' + \
+        '        {\n' + \
+        ''.join(f'            get {name}() {{ return {name}; }},\n' for name in imports) + \
+        '        };\n' + \
+        '        g_deferred = new Promise((resolve, reject) =>\n' + \
+        '        {\n' + \
+        '            let script = document.createElement("script");\n' + \
+        '            script.addEventListener("load", resolve);\n' + \
+        '            script.addEventListener("error", reject);\n' + \
+        f'            script.src = "{path}";\n' + \
+        '            document.head.appendChild(script);\n' + \
+        '        })'
+    if len(exports) != 0:
+        loader += f'.then(() => ({{ {", ".join(exports)} }} = window.{DEFERRED_NAMESPACE}))'
+    return loader + ';\n' + \
+        '    }\n' + \
+        '\n' + \
+        '    return g_deferred;\n' + \
+        '}\n\n'
+
+
+def process_chunk(name, modules, force, rem_log, babel, quiet, out):
+    '''
+    Process a shared chunk (if needed), adding any lines to print to out. Unlike page bundles,
+    chunks aren't wrapped in their own scope, since the pages that use them need to see their contents
+    '''
+    key = 'script/' + name
+    inputs = ['script/' + module + '.js' for module in modules]
+    flags = { 'rem_log' : rem_log, 'ultra' : False, 'babel' : babel, 'daemon' : minify_server_mode(), 'scoped' : False }
+    if not needs_parse(key, modules, inputs, flags, tool_version('babel' if babel else 'terser'), force):
+        if not quiet:
+            out.append(name + ' up to date')
+        return False
 
-    for include in deps[dep]['js']:
-        if include in deps:
-            for css in deps[include]['css']:
-                if not css in res:
-                    res.append(css)
-                    get_css_deps_from_js(css, deps, res)
-            if not include in res:
-                get_css_deps_from_js(include, deps, res)
+    g_bundles[name] = create_bundle(modules, rem_log, False, False)
+    return True
 
 
-def cmp_sizes(comp):
-    for file in comp:
-        noultra = comp[file]['noultra']
-        ultra = comp[file]['ultra']
-        print(file + ':', noultra, 'to', ultra, ':', str(round((1 - (ultra / noultra)) * 100, 2)) + '%')
+def get_page_deps(files, deps):
+    '''Returns a map of each page that builds a script bundle to its includes'''
+    pages = {}
+    for file in files:
+        if 'build_js()' not in get_lines(file):
+            continue
+        includes = get_deps(file, deps)
+        if len(includes) != 0:
+            pages[file[:file.rfind('.')]] = includes
+    return pages
 
 
-def check_long_words(min_letters, files):
-    '''
-    Checks minified files for tokens that take up the most bytes, gated on the passed in minimum word length
+def plan_shared_chunks(pages, deps, min_pages):
     '''
+    Groups scripts that are used by at least min_pages pages into shared chunks, which
+    are cached once by the browser instead of being downloaded again inside every page.
 
-    to_parse = []
-    for f in files:
-        js = glob.glob("min/script/" + f[f.rfind('/') + 1:f.rfind('.')] + "*.min.js")
-        if len(js) != 0:
-            to_parse.append(js[0])
-    words = {}
-    for file in to_parse:
-        lines = get_lines(file)
-        for match in re.findall(r'\b[$_a-zA-Z][\w]{' + str(int(min_letters) - 1) + r',}\b', lines):
-            if not match in words:
-                words[match] = { 'count' : 0, 'bytes' : 0 }
-            words[match]['bytes'] += len(match)
-            words[match]['count'] += 1
+    A chunk is only used by pages that include every script in it, so pages never run
+    code they didn't ask for, and a script can only be part of a chunk if all of its own
+    dependencies are too. If too few pages use every candidate script, the least used one
+    is dropped until enough pages qualify. The pages that get a chunk are then set aside,
+    and the process repeats for the rest, so multiple chunks may be created.
 
-    sorted_words = sorted(words.items(), reverse=True, key=lambda x: x[1]['bytes'])
-    i = 0
-    for e in sorted_words:
-        print(f'{e[0]} - {e[1]["bytes"]} bytes ({e[1]["count"]} instances)')
-        i += 1
-        if i == 20:
+    Returns a list of (chunk name, ordered scripts, pages using the chunk) tuples
+    '''
+    chunks = []
+    remaining = { page : [include for include in includes[:-1] if include != ICON_MAP] for page, includes in pages.items() }
+    while len(remaining) >= min_pages:
+        counts = {}
+        for includes in remaining.values():
+            for include in includes:
+                counts[include] = counts.get(include, 0) + 1
+
+        candidates = set(include for include, count in counts.items() if count >= min_pages)
+        users = []
+        while True:
+            close_shared_modules(candidates, deps)
+            if len(candidates) == 0:
+                break
+            users = [page for page, includes in remaining.items() if candidates.issubset(includes)]
+            if len(users) >= min_pages:
+                break
+            candidates.remove(min(candidates, key=lambda include: (counts[include], include)))
+
+        if len(candidates) == 0:
             break
 
+        # Keep the relative order the scripts would have had in the page bundles
+        ordered = [include for include in remaining[users[0]] if include in candidates]
+        chunks.append(('shared' + str(len(chunks)), ordered, sorted(users)))
+        for page in users:
+            del remaining[page]
 
-def process_file(file, modified_dates, deps, force, rem_log, ultra, quiet):
-    '''Process a single file (if needed)'''
+    return chunks
 
-    reset_var()
-    lines = get_lines(file)
-    if len(lines) == 0:
-        return False
 
-    includes = get_deps(file, deps)
-    if len(includes) == 0:
-        return False # File has no build_js, so don't build anything
+def close_shared_modules(candidates, deps):
+    '''Removes scripts from the given set whose dependencies aren't also in the set'''
+    changed = True
+    while changed:
+        changed = False
+        for candidate in list(candidates):
+            if candidate in deps and any(dep not in candidates for dep in deps.direct(candidate)):
+                candidates.remove(candidate)
+                changed = True
 
-    if not force and not needs_parse(file, includes, modified_dates, 'min/script/' + file[:file.rfind('.')] + '.*.min.js'):
-        if not quiet:
-            print(file, "up to date")
-        return False
 
-    combined = create_temp(includes, rem_log, ultra)
-    write_temp(file, combined, 'js')
-    return True
+def report_shared_chunks(chunks):
+    '''Returns the lines showing the size of each shared chunk, which is what pages sharing it no longer download on each navigation'''
+    out = ['', 'Shared chunks:']
+    for name, modules, pages in chunks:
+        output = g_manifest.output('script/' + name)
+        size = g_index.stat(output)[0] if output is not None and g_index.exists(output) else 0
+        out.append(f'  {name}: {len(modules)} scripts, {size} bytes ({", ".join(modules)})')
+        out.append(f'    Saves {size} bytes per navigation between {", ".join(pages)}')
+    return out
 
 
 def get_lines(file):
@@ -394,316 +2768,1571 @@ def get_lines(file):
 
 def get_deps(file, deps):
     ''' Gets the dependencies for the given php file'''
-    res = []
-    raw = file[:file.rfind('.')]
-    if not raw in deps:
-        return res
-    get_deps_core(raw, deps, 0, res)
-    res = flatten_deps(res)
-    res.append(raw) # Always add the page's core js file last
-
-    # Order doesn't matter too much, but consolelog and common
-    # should be first
-    has_consolelog = "consolelog" in res
-    has_common = "common" in res
-    if has_consolelog and res[0] != "consolelog":
-        res.remove("consolelog")
-        res.insert(0, "consolelog")
-
-    if has_common and res[1 if has_consolelog else 0] != "common":
-        res.remove("common")
-        res.insert(1 if has_consolelog else 0, "common")
-    return res
-
-def get_deps_core(dep, deps, depth, res):
-    '''Recursively add dependencies if they're not already part of the result'''
-    while len(res) <= depth:
-        res.append([])
-    for include in deps[dep]['js']:
-        if not include in res[depth]:
-            res[depth].insert(0, include)
-            get_deps_core(include, deps, depth + 1, res)
-        else:
-            res[depth].remove(include)
-            res[depth].insert(0, include)
+    return list(deps.page_scripts(file[:file.rfind('.')]))
+
+
+def load_deps():
+    '''Parses includes/deps.json into a DependencyGraph'''
+    try:
+        graph = DependencyGraph(json.loads(get_lines('includes' + os.sep + 'deps.json')))
+    except ValueError as ex:
+        raise DependencyError('Could not parse includes/deps.json: ' + str(ex))
+
+    # Resolve everything up front so problems are reported before we start building anything.
+    # Orderings are memoized, so this is linear in the size of the graph
+    for name in graph.deps:
+        graph.scripts(name)
+        for deferred in graph.deferred(name):
+            graph.scripts(deferred)
+    return graph
 
-def flatten_deps(deps):
-    res = []
-    for depLevel in reversed(deps):
-        for dep in depLevel:
-            if dep not in res:
-                res.append(dep)
-    return res
 
+class DependencyError(Exception):
+    '''Raised for problems with deps.json, such as cycles or references to unknown scripts'''
 
-def needs_parse(file, includes, modified_dates, min_file):
-    ''' Determine if we should re-minify the file given it's desired includes
 
-    We only need to parse if last modified date of the minified file is older
-    than the PHP file or any of the scripts it includes
+class DependencyGraph:
+    '''
+    The script/style dependency graph described by deps.json. Built once per run, with
+    the ordering for each script memoized, so shared subgraphs (common, consolelog, etc.)
+    are only walked once no matter how many pages include them.
+
+    Script orderings are topological (every script comes after everything it depends on),
+    with consolelog and common moved to the front, and the page's own script last. With
+    ?nomin, common.php loads scripts and styles in the same order (see get_script_order and
+    get_css_includes), so changes to the ordering need to be made there too.
     '''
-    fileglob = glob.glob(min_file)
-    min_mod = 0 if len(fileglob) == 0 else os.stat(fileglob[0]).st_mtime
-    # min_mod = 0 if not os.path.exists(min_file) else os.stat(min_file).st_mtime
-    php_mod = os.stat(file).st_mtime
 
-    if php_mod > min_mod:
-        return True
+    # Some "base" css files should go first to allow overriding by subsequent files
+    BASE_CSS = ["overlay", "nav", "table", "tooltip"]
+
+    def __init__(self, deps):
+        self.deps = deps
+        self.orders = {}
+        self.page_orders = {}
+        self.style_orders = {}
+
+    def __contains__(self, name):
+        return name in self.deps
+
+    def get(self, name, default=None):
+        return self.deps.get(name, default)
+
+    def direct(self, name):
+        '''Returns the scripts the given script directly depends on'''
+        return self.deps[name]['js']
+
+    def deferred(self, name):
+        '''Returns the scripts the given page loads lazily'''
+        return self.deps[name].get('defer', [])
+
+    def styles(self, name):
+        '''Returns the stylesheets the given script directly depends on'''
+        return self.deps[name]['css']
+
+    def scripts(self, name):
+        '''
+        Returns the given script and everything it (transitively) depends on, ordered such
+        that each script comes after all of its dependencies, with the given script last.
+
+        Walks the graph iteratively so deep graphs can't overflow the stack, and raises a
+        DependencyError if it finds a cycle or a reference to a script not in deps.json
+        '''
+        if name in self.orders:
+            return self.orders[name]
+        self.verify(name, None)
+
+        stack = [(name, iter(self.direct(name)))]
+        on_stack = { name }
+        while len(stack) != 0:
+            node, remaining = stack[-1]
+            descended = False
+            for dep in remaining:
+                if dep in self.orders:
+                    continue
+                if dep in on_stack:
+                    cycle = [entry[0] for entry in stack]
+                    cycle = cycle[cycle.index(dep):] + [dep]
+                    raise DependencyError('Dependency cycle in deps.json: ' + ' -> '.join(cycle))
+                self.verify(dep, node)
+                stack.append((dep, iter(self.direct(dep))))
+                on_stack.add(dep)
+                descended = True
+                break
+
+            if descended:
+                continue
+
+            # Everything this node depends on has been ordered, so merge those orderings
+            stack.pop()
+            on_stack.remove(node)
+            order = []
+            seen = set()
+            for dep in self.direct(node):
+                for include in self.orders[dep]:
+                    if include not in seen:
+                        seen.add(include)
+                        order.append(include)
+            if node not in seen:
+                order.append(node)
+            self.orders[node] = order
+
+        return self.orders[name]
+
+    def verify(self, name, parent):
+        '''Ensures the given script is in deps.json'''
+        if name not in self.deps:
+            if parent is None:
+                raise DependencyError(f"'{name}' is not in deps.json")
+            raise DependencyError(f"'{parent}' depends on '{name}', which is not in deps.json")
+        if 'js' not in self.deps[name] or 'css' not in self.deps[name]:
+            raise DependencyError(f"'{name}' in deps.json must have both 'js' and 'css' lists")
+
+    def page_scripts(self, page):
+        '''
+        Returns the scripts to bundle for the given page, or an empty list if it isn't in deps.json.
+        consolelog and common go first, and the page's own script goes last
+        '''
+        if page in self.page_orders:
+            return self.page_orders[page]
+        if page not in self.deps:
+            return []
+
+        order = self.scripts(page)
+        first = [include for include in ['consolelog', 'common'] if include in order]
+        order = first + [include for include in order if include not in first and include != page]
+        if page not in first:
+            order.append(page)
+        self.page_orders[page] = order
+        return order
+
+    def page_styles(self, page):
+        '''
+        Returns the stylesheets to bundle for the given page: "style" first, then the base stylesheets,
+        then any other stylesheets required by the page's scripts (including deferred ones) in dependency
+        order, then the page's own stylesheets, with the one named after the page last
+        '''
+        if page in self.style_orders:
+            return self.style_orders[page]
+        if page not in self.deps:
+            return []
+
+        implicit = []
+        scripts = self.scripts(page)[:-1]
+        for deferred in self.deferred(page):
+            scripts = scripts + [script for script in self.scripts(deferred) if script not in scripts]
+        for script in scripts:
+            for css in self.styles(script):
+                if css not in implicit:
+                    implicit.append(css)
+
+        includes = self.styles(page)
+        res = ['style'] if 'style' in includes else []
+        res += [css for css in DependencyGraph.BASE_CSS if css in implicit]
+        res += [css for css in implicit if css not in res]
+        res += [include for include in includes if include != 'style' and include != page and include not in res]
+        if page in includes:
+            res = [css for css in res if css != page] + [page]
+
+        self.style_orders[page] = res
+        return res
 
-    should_parse = False
-    for include in includes:
-        if not include in modified_dates or modified_dates[include] > min_mod:
-            should_parse = True
-            break
-    return should_parse
+
+def needs_parse(key, includes, inputs, flags, tool, force):
+    ''' Determine if we should rebuild the given output
+
+    We only need to rebuild if the contents of any input, the list of includes itself
+    (i.e. deps.json changed), the build flags, or the minifier version differ from what
+    the output was last built with. Either way, the current state is staged in the manifest
+    so it can be recorded once the new output has been written.
+    '''
+    state = {
+        'includes' : includes,
+        'inputs' : { path : g_manifest.file_hash(path) for path in inputs },
+        'flags' : flags,
+        'tool' : tool
+    }
+
+    current = g_manifest.is_current(key, state)
+    g_manifest.stage(key, state)
+    return force or not current
 
 
-def create_temp(includes, rem_log, ultra):
+def create_bundle(includes, rem_log, ultra, scoped=True, prelude='', keep=None, epilogue=''):
     '''
-    Creates a temporary javascript file that combines all the necessary includes for a web page.
+    Creates a Bundle that combines all the necessary includes for a web page.
 
     Arguments:
         rem_log: integer describing what (if any) logging statements should be removed to further reduce file size
         ultra: if True, does additional generally unsafe preprocessing to further reduce file size
+        scoped: if True, wraps everything (other than consolelog) in its own scope
+        prelude: generated code to add before the first include (inside the scope)
+        epilogue: generated code to add after the last include (inside the scope)
+        keep: if not None, removes top-level declarations that aren't reachable from the last include
+              (the page's own script) or the names in this set. Requires scoped
+
+    Returns the Bundle, which also maps each of its lines back to the include they came from
     '''
 
-    combined = '(function(){'
-    consolelog = ''
+    sources = {}
     for include in includes:
-        include_file = 'script/' + include + '.js'
-        if include == "consolelog":
-            # consolelog has functions that we want users to have access to, so it can't go in the inner scope
-            consolelog = get_lines(include_file)
-            continue
-        lines = get_lines(include_file)
-
-        # Experimental. Attempts to remove all Log.tmi entries from the source file.
-        # The regex is simple, so things could go wrong if funky comments/log statements are used.
-        if rem_log & 3 != 0:
-            reg = r'(\/\*@__PURE__\*\/)?\blogTmi\(.*\); *\n'
-            if rem_log & 2 == 2:
-                # More for testing than anything else. Completely re move _all_ logs, even info/warn/error
-                reg = r'(\/\*@__PURE__\*\/)?\blog(Tmi|Verbose|Info|Warn|Error)\(.*\); *\n'
-            lines = re.sub(reg, '', lines)
-
+        sources[include] = g_preprocess.read('script/' + include + '.js')
+    originals = dict(sources)
+    if keep is not None and scoped:
+        with profile('shake', file=includes[-1]):
+            removed, saved = shake_tree(sources, includes[-1], keep)
+        g_shake_report.add(includes[-1], removed, saved)
+
+    # Every include is rewritten in a single pass with the same set of rules (plus some
+    # markdown-specific ones), so adding a rule doesn't mean another scan of the bundle
+    rewriter = JsRewriter()
+    log_rewriter = JsRewriter()
+    if rem_log & 3 != 0:
+        # More for testing than anything else, -nolog completely removes _all_ logs, even info/warn/error
+        levels = ['Tmi', 'Verbose', 'Info', 'Warn', 'Error'] if rem_log & 2 == 2 else ['Tmi']
+        for level in levels:
+            rewriter.remove_call('Log', level.lower())
+            rewriter.remove_call('log' + level)
+
+    names = VarAllocator()
+    if ultra:
+        rewriter.rename('appendChild', 'a', member=True, call=True)
+        rewriter.rename('addEventListener', 'l', member=True, call=True)
+        rewriter.rename('parseInt', 'p_', member=False, call=True)
+        rewriter.rename('appendChildren', names.next())
+        if 'markdown' in sources:
+            sources['markdown'] = strip_markdown_debug(sources['markdown'], rem_log)
+
+        # Inline every enum that's safe to, in both the inner scope and consolelog
+        with profile('enums', file=includes[-1]):
+            enums = EnumInliner(sources)
+            enums.inline(rewriter)
+            enums.inline(log_rewriter)
+            enums.remove_definitions(sources)
+        g_enum_report.add(enums)
+
+    rules = rewriter.fingerprint()
+    def rewrite(include, source):
         if include == "markdown" and ultra:
             # Very hacky,  but minifiers aren't great at minifying classes/enums, but in
-            # this specific case we know it's okay to do so do some pre-minification
-            lines = preminify_markdown(lines, rem_log)
-        combined += '/* ' + include + '*/\n' + lines + '\n\n'
+            # this specific case we know it's okay to do so do some pre-minification.
+            # Its names start after the bundle-wide ones above, so they can't clash
+            return preminify_markdown(source, rem_log, rewriter, VarAllocator(names.last))
+        return rewriter.rewrite(source)
+
+    bundle = Bundle()
+    if 'consolelog' in includes:
+        # consolelog has functions that we want users to have access to, so it can't go in the inner scope
+        if ultra:
+            log_rewriter.rename('localStorage', 'l_', member=False)
+        def rewrite_consolelog(_, consolelog):
+            if not ultra:
+                return consolelog
+            test_all = consolelog.find('this.testConsolelog =')
+            consolelog = consolelog.replace(consolelog[test_all:consolelog.find('}', test_all) + 1], '')
+            class_entry = consolelog.find('{') + 2
+            return consolelog[:class_entry] + 'let l_ = localStorage; ' + log_rewriter.rewrite(consolelog[class_entry:])
+
+        consolelog, lines_map = g_preprocess.rewrite('consolelog', originals['consolelog'], sources['consolelog'], rem_log, ultra, log_rewriter.fingerprint(), rewrite_consolelog)
+        if len(consolelog) > 0:
+            bundle.append(INCLUDE_MARKER.format('consolelog'))
+            bundle.append(consolelog, 'consolelog', lines_map)
+            bundle.append(INCLUDE_MARKER.format('(bundle)'))
 
-    combined += '})();'
     if ultra:
-        combined = '(function(){ Element.prototype.a = Element.prototype.appendChild; ' +\
+        bundle.append('(function(){ Element.prototype.a = Element.prototype.appendChild; ' +\
             'Element.prototype.l = Element.prototype.addEventListener;\n' +\
             'window.l = window.addEventListener;\n' +\
             'document.l = document.addEventListener;\n' +\
-            'let p_ = parseInt;\n' +\
-            combined[12:]
-        combined = re.sub(r'\.appendChild\(', '.a(', combined)
-        combined = re.sub(r'\.addEventListener\(', '.l(', combined)
-        combined = re.sub(r'\bparseInt\(', 'p_(', combined)
-        combined = re.sub(r'\bappendChildren\b', next_var(), combined)
-        combined = minify_process_request(combined)
-        combined = minify_keycodes(combined)
-    if len(consolelog) > 0:
-        # prepend this outside of our scope
-        if ultra:
-            test_all = consolelog.find('this.testConsolelog =')
-            consolelog = consolelog.replace(consolelog[test_all:consolelog.find('}', test_all) + 1], '')
-            for i, level in enumerate(['Extreme', 'Tmi', 'Verbose', 'Info', 'Warn', 'Error', 'Critical']):
-                consolelog = consolelog.replace('Log.Level.' + level, str(i - 1))
+            'let p_ = parseInt;\n')
+    elif scoped:
+        bundle.append('(function(){')
+    bundle.append(prelude)
+    for include in includes:
+        if include == "consolelog":
+            continue
 
-            # I really hate this.
-            consolelog = consolelog.replace('e.g. Log.setLevel(1)', 'e.g. Log.setLevel(Log.Level.Verbose)')
-            class_entry = consolelog.find('{') + 2
-            consolelog = consolelog[:class_entry] + 'let l_ = localStorage; ' + consolelog[class_entry:].replace('localStorage', 'l_')
-            # consolelog = 'let l_ = localStorage; ' + consolelog.replace('localStorage', 'l_')
-        combined = consolelog + combined
+        lines, lines_map = g_preprocess.rewrite(include, originals[include], sources[include], rem_log, ultra, rules, rewrite)
+        bundle.append(INCLUDE_MARKER.format(include))
+        bundle.append(lines, include, lines_map)
+        bundle.append('\n\n')
+
+    bundle.append(epilogue)
+    if scoped:
+        bundle.append('})();')
+    return bundle
+
+
+class Bundle:
+    '''
+    A bundle that's assembled in memory as a list of chunks. For scripts, also keeps track of
+    the (include, line) (both 0-based) each line came from, or None for generated lines, which
+    is what source maps and warnings are mapped back through. Bundles are named after their
+    minified output, unless path has to be decided up front (see process_deferred_chunk)
+    '''
+
+    def __init__(self):
+        self.chunks = []
+        self.line_map = [None]
+        self.joined = None
+        self.path = None
+
+    def append(self, text, include=None, lines=None):
+        '''
+        Adds the given text to the bundle. If it's (part of) an include, lines is
+        the line of the include that each line of the given text came from
+        '''
+        self.chunks.append(text)
+        self.joined = None
+        if lines is None:
+            self.line_map += [None] * text.count('\n')
+            return
+        if self.line_map[-1] is None:
+            self.line_map[-1] = (include, lines[0])
+        self.line_map += [(include, line) for line in lines[1:]]
+
+    def text(self):
+        '''Returns the full contents of the bundle'''
+        if self.joined is None:
+            self.joined = ''.join(self.chunks)
+            self.chunks = [self.joined]
+        return self.joined
+
+
+class PreprocessCache:
+    '''
+    Remembers how each include was preprocessed (log stripping, -ultra rewrites, etc.), so a
+    script that's part of many bundles is read and rewritten once instead of once per page.
 
-    return combined
+    Entries are keyed on the include's contents, rem_log, ultra, and the rewrite rules themselves,
+    since with -ultra the rules depend on the enums found in the rest of the bundle. They're also
+    persisted in includes/cache/preprocess_cache.json, so unchanged scripts aren't reprocessed on
+    the next build either, and dropped once they haven't been used for a few builds.
+    '''
 
-# Minify the ProcessRequest enum via direct substitution
-def minify_process_request(combined):
+    PATH = 'includes/cache/preprocess_cache.json'
+    VERSION = 1
+    MAX_AGE = 10 # Builds
+
+    def __init__(self, persist):
+        self.persist = persist
+        self.lock = threading.Lock()
+        self.reads = {}
+        self.entries = {}
+        self.build = 0
+        self.dirty = False
+        if not persist:
+            return
+        try:
+            with open(PreprocessCache.PATH, encoding='utf-8') as cache_file:
+                cache = json.load(cache_file)
+            if cache.get('version') == PreprocessCache.VERSION:
+                self.build = cache['build'] + 1
+                self.entries = cache['entries']
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def read(self, path):
+        '''Returns the contents of the given script, only reading it again if it changed'''
+        file_hash = g_manifest.file_hash(path)
+        with self.lock:
+            cached = self.reads.get(path)
+        if cached is not None and cached[0] == file_hash:
+            return cached[1]
+
+        with profile('read', file=path):
+            source = get_lines(path)
+        with self.lock:
+            self.reads[path] = (file_hash, source)
+        return source
+
+    def rewrite(self, include, original, source, rem_log, ultra, rules, rewrite):
+        '''
+        Returns the preprocessed version of the given include's source, along with the line of the
+        original each of its lines came from (see map_rewritten_lines). If it isn't cached, it's
+        preprocessed by calling rewrite(include, source)
+        '''
+        digest = hashlib.md5(json.dumps([include, rem_log, ultra, rules]).encode('utf-8'))
+        digest.update(hashlib.md5(original.encode('utf-8')).digest())
+        digest.update(hashlib.md5(source.encode('utf-8')).digest())
+        key = digest.hexdigest()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[2] != self.build:
+                    entry[2] = self.build
+                    self.dirty = True
+                return entry[0], entry[1]
+
+        with profile('rewrite', file='script/' + include + '.js'):
+            lines = rewrite(include, source)
+            line_map = map_rewritten_lines(original, lines)
+        with self.lock:
+            self.entries[key] = [lines, line_map, self.build]
+            self.dirty = True
+        return lines, line_map
+
+    def save(self):
+        '''Atomically writes the cache if anything changed, dropping entries that haven't been used recently'''
+        if not self.persist or not self.dirty:
+            return
+        entries = { key : entry for key, entry in self.entries.items() if entry[2] > self.build - PreprocessCache.MAX_AGE }
+        tmp_path = PreprocessCache.PATH + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as cache_file:
+            json.dump({ 'version' : PreprocessCache.VERSION, 'build' : self.build, 'entries' : entries }, cache_file)
+        os.replace(tmp_path, PreprocessCache.PATH)
+        self.dirty = False
+
+g_preprocess = None
+
+
+def map_rewritten_lines(original, rewritten):
     '''
-    Removes the ProcessRequest enum from the given string using direct substitution
+    Returns the (0-based) line of the original script that each line of its rewritten version
+    came from. Rewrites mostly remove code (logging, unused declarations, enums) and otherwise
+    change lines in place, so the two are lined up with a diff, and lines that were changed are
+    attributed to the first line of the block they replaced
+    '''
+    if original == rewritten:
+        return list(range(original.count('\n') + 1))
+
+    old = original.split('\n')
+    new = rewritten.split('\n')
+    lines = [0] * len(new)
+    for _, i1, i2, j1, j2 in difflib.SequenceMatcher(None, old, new).get_opcodes():
+        for j in range(j1, j2):
+            lines[j] = min(i1 + min(j - j1, max(i2 - i1 - 1, 0)), len(old) - 1)
+    return lines
+
+
+class EnumInliner:
     '''
-    start = combined.find('\nconst ProcessRequest =')
-    if start == -1:
-        return combined
+    Finds enum-like objects in a bundle's scripts, i.e. objects whose values are all
+    number or string literals, defined either at the top level of a script:
+
+        const State = { None : 0, Div : 1 };
+
+    or as a member of a top-level singleton (e.g. Log.Level in consolelog.js):
 
-    end = combined.find('}', start)
-    definition = combined[start:end]
-    combined = combined[:start] + combined[end + 2:]
-    results = re.findall(r'(\w+) : (\d+)', definition)
-    for result in results:
-        combined = combined.replace('ProcessRequest.' + result[0], str(result[1]))
-    return combined
+        let Log = new function() { this.Level = { Tmi : 0 }; };
 
-# Minify the KEY enum via direct substitution
-def minify_keycodes(combined):
+    An enum can be inlined if every reference to it across the bundle is a read of one of its
+    members. Top-level enums are also removed entirely, which requires that they aren't used
+    in any other way (iterated, passed around, shadowed, etc.). Members of singletons are
+    left in place, since they're part of their owner's public interface.
     '''
-    Removes the KEY enum from the given string using direct substitution
+
+    # Tokens that, when preceding an identifier, indicate it's being declared
+    DECLARATIONS = { 'let', 'const', 'var', 'function', 'class' }
+
+    def __init__(self, sources):
+        # path -> { 'members', 'include', 'span', 'keep', 'references', 'safe' }
+        self.enums = {}
+        self.rejected = set()
+        self.tokens = {}
+        for include, source in sources.items():
+            tokens = tokenize_js(source)
+            self.tokens[include] = (tokens, [i for i, token in enumerate(tokens) if token[0] not in ('ws', 'comment')])
+            self.discover(include)
+        for include in self.tokens:
+            self.verify(include)
+
+    def discover(self, include):
+        '''Finds enum definitions in the given include'''
+        tokens, sig = self.tokens[include]
+        depth = 0
+        owner = None # Name of the top-level "new function()" singleton we're in, if any
+        owner_depth = -1
+        owner_index = -1
+        for j, index in enumerate(sig):
+            text = tokens[index][1]
+            if text == '{':
+                depth += 1
+            elif text == '}':
+                depth -= 1
+                if depth == owner_depth:
+                    owner = None
+
+            if depth == 0 and text in ('let', 'const', 'var') and self.texts(sig, tokens, j + 2, 3) == ['=', 'new', 'function']:
+                owner = tokens[sig[j + 1]][1]
+                owner_index = sig[j + 1]
+                owner_depth = 0
+                continue
+
+            path = None
+            start = j
+            if depth == 0 and text == 'const' and tokens[sig[j + 1]][0] == 'ident' and self.texts(sig, tokens, j + 2, 2) == ['=', '{']:
+                path = (tokens[sig[j + 1]][1],)
+                value = j + 3
+            elif depth == 1 and owner is not None and self.texts(sig, tokens, j, 2) == ['this', '.'] \
+                    and self.texts(sig, tokens, j + 3, 2) == ['=', '{'] and (j == 0 or tokens[sig[j - 1]][1] in (';', '{', '}')):
+                path = (owner, tokens[sig[j + 2]][1])
+                value = j + 4
+            if path is None:
+                continue
+
+            members, end = self.parse_members(tokens, sig, value)
+            if members is None:
+                continue
+
+            if path in self.enums or path in self.rejected:
+                # Same name defined in multiple places, don't guess which one is used where
+                self.enums.pop(path, None)
+                self.rejected.add(path)
+                continue
+
+            if end + 1 < len(sig) and tokens[sig[end + 1]][1] == ';':
+                end += 1
+            self.enums[path] = {
+                'members' : members,
+                'include' : include,
+                'span' : (sig[start], sig[end] + 1),
+                'keep' : len(path) != 1,
+                'owner' : owner_index if len(path) != 1 else -1,
+                'references' : 0,
+                'saved' : 0
+            }
+
+    def parse_members(self, tokens, sig, j):
+        '''
+        Parses the object literal starting at sig[j] ('{'). Returns a map of member names to
+        their literal values and the index of the closing brace, or (None, None) if it isn't enum-like
+        '''
+        members = {}
+        j += 1
+        while j < len(sig):
+            kind, text = tokens[sig[j]]
+            if text == '}':
+                return (members if len(members) != 0 else None, j)
+            if kind == 'string':
+                text = text[1:-1]
+            elif kind != 'ident' or j + 2 >= len(sig) or tokens[sig[j + 1]][1] != ':':
+                return (None, None)
+
+            value_kind, value = tokens[sig[j + 2]]
+            j += 3
+            if value == '-' and tokens[sig[j]][0] == 'number':
+                value = '(-' + tokens[sig[j]][1] + ')'
+                value_kind = 'number'
+                j += 1
+            if value_kind not in ('number', 'string') or not re.match(r'^\w+$', text):
+                return (None, None)
+
+            members[text] = value
+            if tokens[sig[j]][1] == ',':
+                j += 1
+            elif tokens[sig[j]][1] != '}':
+                return (None, None)
+        return (None, None)
+
+    def verify(self, include):
+        '''Checks every reference to each enum in the given include, rejecting any enum that isn't only ever read'''
+        tokens, sig = self.tokens[include]
+        roots = {}
+        for path in self.enums:
+            roots.setdefault(path[0], []).append(path)
+
+        for j, index in enumerate(sig):
+            kind, text = tokens[index]
+            if kind != 'ident' or text not in roots:
+                continue
+            previous = tokens[sig[j - 1]][1] if j > 0 else None
+            if previous == '.':
+                continue
+
+            for path in roots[text]:
+                enum = self.enums.get(path)
+                if enum is None or (enum['include'] == include and (enum['span'][0] <= index < enum['span'][1] or index == enum['owner'])):
+                    continue
+
+                if previous in EnumInliner.DECLARATIONS:
+                    # Something else with the same name, which we can't distinguish from the enum
+                    self.reject(path)
+                    continue
+
+                if len(path) == 1 and previous in ('{', ',') and self.texts(sig, tokens, j + 1, 1) == [':']:
+                    continue # Object key with the same name
+
+                end = j + 1
+                for part in path[1:]:
+                    if self.texts(sig, tokens, end, 2) != ['.', part]:
+                        end = -1
+                        break
+                    end += 2
+                if end == -1:
+                    continue # Some other member of the enum's owner
+
+                if self.texts(sig, tokens, end, 1) != ['.']:
+                    # Used as an object, e.g. Object.keys(Enum). That's only okay for enums we're not removing
+                    if not enum['keep'] or self.is_assignment(tokens, sig, end):
+                        self.reject(path)
+                    continue
+
+                member = tokens[sig[end + 1]][1] if end + 1 < len(sig) else None
+                if member not in enum['members'] or self.is_assignment(tokens, sig, end + 2) \
+                        or (j > 1 and self.texts(sig, tokens, j - 2, 2) in (['+', '+'], ['-', '-'])) or previous == 'delete' \
+                        or (self.texts(sig, tokens, end + 2, 1) == ['.'] and not enum['members'][member].startswith(('"', "'"))):
+                    self.reject(path)
+                    continue
+
+                enum['references'] += 1
+                enum['saved'] += len('.'.join(path) + '.' + member) - len(enum['members'][member])
+
+    def is_assignment(self, tokens, sig, j):
+        '''Returns whether the token at sig[j] starts an assignment (=, +=, ++, etc.)'''
+        following = self.texts(sig, tokens, j, 3)
+        if len(following) == 0:
+            return False
+        if following[0] == '=':
+            return following[1:2] != ['='] and following[1:2] != ['>']
+        if len(following) > 1 and following[0] in ('+', '-') and following[1] == following[0]:
+            return True
+        if len(following) > 1 and following[0] in ('+', '-', '*', '/', '%', '&', '|', '^') and following[1] == '=':
+            return True
+        return following[:3] in (['*', '*', '='], ['<', '<', '='], ['>', '>', '='], ['&', '&', '='], ['|', '|', '='], ['?', '?', '='])
+
+    def reject(self, path):
+        '''Marks the given enum as unsafe to inline'''
+        self.enums.pop(path, None)
+        self.rejected.add(path)
+
+    @staticmethod
+    def texts(sig, tokens, j, count):
+        '''Returns the text of up to count significant tokens starting at sig[j]'''
+        return [tokens[index][1] for index in sig[j:j + count]]
+
+    def inline(self, rewriter):
+        '''Adds rules to the given rewriter to replace every enum member reference with its value'''
+        for path, enum in self.enums.items():
+            for member, value in enum['members'].items():
+                rewriter.inline(path + (member,), value)
+
+    def remove_definitions(self, sources):
+        '''Removes the definitions of all inlined top-level enums from the given sources'''
+        by_include = {}
+        for path, enum in self.enums.items():
+            if not enum['keep']:
+                by_include.setdefault(enum['include'], []).append(enum)
+
+        for include, enums in by_include.items():
+            tokens = self.tokens[include][0]
+            removed = set()
+            for enum in enums:
+                start, end = enum['span']
+                enum['saved'] += sum(len(tokens[i][1]) for i in range(start, end))
+                removed.update(range(start, end))
+                if end < len(tokens) and tokens[end][0] == 'ws' and '\n' in tokens[end][1]:
+                    # Don't leave an empty line behind
+                    tokens[end] = ('ws', tokens[end][1][tokens[end][1].find('\n') + 1:])
+            sources[include] = ''.join(token[1] for i, token in enumerate(tokens) if i not in removed)
+
+
+class EnumReport:
+    '''Tracks the enums inlined across all bundles built during this run'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.enums = {}
+
+    def add(self, inliner):
+        '''Adds the enums inlined into a single bundle'''
+        with self.lock:
+            for path, enum in inliner.enums.items():
+                entry = self.enums.setdefault('.'.join(path), { 'members' : len(enum['members']), 'references' : 0, 'saved' : 0, 'bundles' : 0 })
+                entry['references'] += enum['references']
+                entry['saved'] += enum['saved']
+                entry['bundles'] += 1
+
+    def report(self, quiet):
+        '''Returns the lines describing the enums inlined since the last report, then resets'''
+        with self.lock:
+            if len(self.enums) == 0:
+                return []
+            saved = sum(entry['saved'] for entry in self.enums.values())
+            out = [f'Inlined {len(self.enums)} enum(s), saving {saved} bytes before minification']
+            if not quiet:
+                for name, entry in sorted(self.enums.items(), key=lambda item: -item[1]['saved']):
+                    out.append(f'  {name:<20}: {entry["members"]} members, {entry["references"]} references in {entry["bundles"]} bundle(s), {entry["saved"]} bytes')
+            self.enums = {}
+            return out
+
+g_enum_report = EnumReport()
+
+
+# Tokens that can't be followed by a regex literal, i.e. a '/' after them is division
+JS_DIVISION_PRECEDERS = { ')', ']', '}' }
+JS_KEYWORDS_BEFORE_EXPRESSION = {
+    'return', 'typeof', 'instanceof', 'in', 'of', 'new', 'delete', 'void', 'throw', 'case', 'do', 'else', 'yield', 'await'
+}
+JS_TOKEN_REGEX = re.compile(r'''
+     (?P<ws>\s+)
+    |(?P<comment>//[^\n]*|/\*.*?\*/)
+    |(?P<string>"(?:[^"\\\n]|\\.)*"|'(?:[^'\\\n]|\\.)*')
+    |(?P<ident>[A-Za-z_$][\w$]*)
+    |(?P<number>\.?\d[\w.]*)
+    |(?P<punct>\.\.\.|=>|[^\s\w])
+''', re.S | re.X)
+
+
+def tokenize_js(source):
+    '''
+    Splits javascript source into a list of (kind, text) tuples, where kind is one of
+    ws, comment, string, template, regex, ident, number, or punct. Joining the text of
+    every token gives back the original source.
+
+    This isn't a full parser, but knows enough to never mistake the contents of a string,
+    comment, template literal, or regex literal for code. Expressions embedded in
+    template literals are tokenized as code.
     '''
-    start = combined.find('\nconst KEY =')
-    if start == -1:
-        return combined
+    tokens = []
+    braces = [] # True for each '${' we're currently in, False for each regular '{'
+    last = None # Last non-whitespace, non-comment token
+    i = 0
+    length = len(source)
+    while i < length:
+        char = source[i]
+        if char == '`' or (char == '}' and len(braces) != 0 and braces[-1]):
+            # Start of a template literal, or the end of an expression embedded in one
+            if char == '}':
+                braces.pop()
+            start = i
+            i += 1
+            while i < length:
+                if source[i] == '\\':
+                    i += 2
+                elif source[i] == '`':
+                    i += 1
+                    break
+                elif source.startswith('${', i):
+                    i += 2
+                    braces.append(True)
+                    break
+                else:
+                    i += 1
+            last = ('template', source[start:i])
+            tokens.append(last)
+            continue
+
+        if char == '/' and not source.startswith('//', i) and not source.startswith('/*', i) and js_allows_regex(last):
+            start = i
+            i += 1
+            in_class = False
+            while i < length and source[i] != '\n':
+                if source[i] == '\\':
+                    i += 1
+                elif source[i] == '[':
+                    in_class = True
+                elif source[i] == ']':
+                    in_class = False
+                elif source[i] == '/' and not in_class:
+                    break
+                i += 1
+            i += 1
+            while i < length and (source[i].isalnum() or source[i] == '_'):
+                i += 1
+            last = ('regex', source[start:i])
+            tokens.append(last)
+            continue
 
-    end = combined.find('}', start)
-    definition = combined[start:end]
-    combined = combined[:start] + combined[end + 2:]
-    results = re.findall(r'([A-Z_]+) +: (\d+)', definition)
-    for result in results:
-        combined = re.sub(f'\\bKEY\\.{result[0]}\\b', str(result[1]), combined)
-    return combined
+        match = JS_TOKEN_REGEX.match(source, i)
+        kind = match.lastgroup
+        text = match.group()
+        if kind == 'punct' and text == '{':
+            braces.append(False)
+        elif kind == 'punct' and text == '}' and len(braces) != 0:
+            braces.pop()
 
+        tokens.append((kind, text))
+        if kind not in ('ws', 'comment'):
+            last = (kind, text)
+        i = match.end()
 
-def write_temp(file, combined, ext):
+    return tokens
+
+
+def js_allows_regex(last):
+    '''Returns whether a '/' following the given token starts a regex literal (instead of being division)'''
+    if last is None:
+        return True
+    kind, text = last
+    if kind == 'punct':
+        return text not in JS_DIVISION_PRECEDERS
+    return kind == 'ident' and text in JS_KEYWORDS_BEFORE_EXPRESSION
+
+
+class JsRewriter:
     '''
-    Writes the given combined contents to the given file name in a temporary directory
+    Applies a table of identifier renames, value inlining, and call removals to
+    javascript source in a single pass over its tokens, never touching strings,
+    comments, template literal text, or regex literals.
     '''
-    if not os.path.exists('tmp'):
-        os.makedirs('tmp')
-    with open('tmp/' + file[:file.rfind('.')] + '.tmp.' + ext, 'w+') as temp_file:
-        temp_file.write(combined)
 
+    def __init__(self):
+        self.renames = {} # name -> [(replacement, member, call)]
+        self.paths = {} # first identifier -> [(identifiers, replacement)], where None means "remove the call"
+
+    def rename(self, name, replacement, member=None, call=False):
+        '''
+        Renames the given identifier. If member is True, only renames it when accessed as a property
+        (x.name), if False, only when it isn't. If call is True, only renames it when it's called.
+        '''
+        self.renames.setdefault(name, []).append((replacement, member, call))
+
+    def inline(self, path, replacement):
+        '''Replaces the given dotted path (e.g. ('State', 'Bold')) with the given value'''
+        self.paths.setdefault(path[0], []).append((path, replacement))
+
+    def remove_call(self, *path):
+        '''Removes all standalone statements that call the given function, e.g. ('Log', 'tmi')'''
+        self.paths.setdefault(path[0], []).append((path, None))
+
+    def fingerprint(self):
+        '''Returns a digest of the current rules, which identifies the rewrites they'd make'''
+        rules = repr([sorted(self.renames.items()), sorted(self.paths.items())])
+        return hashlib.md5(rules.encode('utf-8')).hexdigest()
+
+    def rewrite(self, source):
+        '''Returns the rewritten source'''
+        if len(self.renames) == 0 and len(self.paths) == 0:
+            return source
+
+        tokens = tokenize_js(source)
+        out = []
+        i = 0
+        while i < len(tokens):
+            kind, text = tokens[i]
+            if kind != 'ident':
+                out.append(text)
+                i += 1
+                continue
+
+            previous = self.previous(out)
+            is_member = previous == '.'
+            if not is_member and text in self.paths:
+                consumed = self.rewrite_path(tokens, i, out)
+                if consumed != 0:
+                    i += consumed
+                    continue
+
+            replacement = text
+            for rule, member, call in self.renames.get(text, []):
+                if member is not None and member != is_member:
+                    continue
+                if call and self.next_significant(tokens, i + 1)[1] != '(':
+                    continue
+                replacement = rule
+                break
+            out.append(replacement)
+            i += 1
+
+        return ''.join(out)
+
+    def rewrite_path(self, tokens, i, out):
+        '''
+        Attempts to apply a dotted path rule starting at tokens[i]. Returns the
+        number of tokens consumed, or 0 if no rule applies.
+        '''
+        for path, replacement in self.paths[tokens[i][1]]:
+            end = i + 1
+            for part in path[1:]:
+                if end + 1 >= len(tokens) or tokens[end][1] != '.' or tokens[end + 1] != ('ident', part):
+                    end = -1
+                    break
+                end += 2
+
+            # Don't replace partial paths (e.g. State.Bold.length)
+            if end == -1 or (end < len(tokens) and tokens[end][1] == '.'):
+                continue
+
+            if replacement is not None:
+                out.append(replacement)
+                return end - i
+
+            removed = self.remove_statement(tokens, i, end, out)
+            if removed != 0:
+                return removed
+        return 0
+
+    def remove_statement(self, tokens, i, end, out):
+        '''
+        Removes the call starting at tokens[i] (whose callee ends at tokens[end]) if it's a standalone statement.
+        Returns the number of tokens consumed, or 0 if it can't be safely removed.
+        '''
+        if end >= len(tokens) or tokens[end][1] != '(':
+            return 0
+
+        # Find the matching parenthesis. Strings, comments, and templates are single tokens, so they can't throw this off
+        depth = 0
+        close = end
+        while close < len(tokens):
+            if tokens[close][1] == '(':
+                depth += 1
+            elif tokens[close][1] == ')':
+                depth -= 1
+                if depth == 0:
+                    break
+            close += 1
+        if close == len(tokens):
+            return 0
+
+        after = close + 1
+        following = self.next_significant(tokens, after)
+        if following[1] not in (';', '}', None):
+            # Without a semicolon, only remove it if automatic semicolon insertion would end the statement here
+            newline = any('\n' in text for _, text in tokens[after:following[0]])
+            if not newline or tokens[following[0]][0] not in ('ident', 'string', 'number', 'template'):
+                return 0
+
+        # Drop any /*@__PURE__*/ annotation and indentation before the call
+        trailing = len(out)
+        while trailing > 0 and (out[trailing - 1].isspace() or out[trailing - 1] == '/*@__PURE__*/'):
+            trailing -= 1
+        previous = self.previous(out[:trailing])
+        if previous not in (None, ';', '{', '}', ')', 'else', 'do'):
+            # Part of a larger expression
+            return 0
+
+        leading = out[trailing:]
+        del out[trailing:]
+        for token in leading:
+            if token.isspace() and '\n' in token:
+                out.append(token[:token.rfind('\n') + 1])
+
+        if previous in (')', 'else', 'do'):
+            # The body of an if/else/loop, which can't be empty
+            out.append(';')
+
+        if following[1] == ';':
+            after = following[0] + 1
+            if after < len(tokens) and tokens[after][0] == 'ws':
+                # Also take everything up to (and including) the end of the line
+                newline = tokens[after][1].find('\n')
+                if newline != -1 and len(out) != 0 and out[-1].endswith('\n'):
+                    tokens[after] = ('ws', tokens[after][1][newline + 1:])
+        return after - i
+
+    @staticmethod
+    def previous(out):
+        '''Returns the last significant token that was written out'''
+        for text in reversed(out):
+            if not text.isspace() and not text.startswith('//') and not text.startswith('/*'):
+                return text
+        return None
+
+    @staticmethod
+    def next_significant(tokens, i):
+        '''Returns the index and text of the next token at or after i that isn't whitespace or a comment'''
+        while i < len(tokens):
+            if tokens[i][0] not in ('ws', 'comment'):
+                return (i, tokens[i][1])
+            i += 1
+        return (i, None)
+
+
+SHAKE_ALLOWLIST = 'includes/shake_allowlist.json'
+
+def get_shake_allowlist(file):
+    '''
+    Returns the top-level names that must be kept in the given page's bundle even if nothing in
+    the bundle references them: the names in shake_allowlist.json (under "*" or the page's name),
+    and any function called from an inline event handler (onclick="foo()") in the page itself
+    '''
+    keep = set()
+    allowlist = get_lines(SHAKE_ALLOWLIST)
+    if len(allowlist) != 0:
+        allowlist = json.loads(allowlist)
+        keep.update(allowlist.get('*', []))
+        keep.update(allowlist.get(file[:file.rfind('.')], []))
+    keep.update(re.findall(r'\bon[a-z]+\s*=\s*["\']\s*(?:return\s+)?([A-Za-z_$][\w$]*)\s*\(', get_lines(file)))
+    return keep
 
-def get_modified_dates(filter):
-    '''return a dictionary of the last modified time for all files in script/'''
-    last_modified = {}
-    files = glob.glob(filter)
-    for file in files:
-        last_modified[file[file.find(os.sep) + 1:file.rfind('.')]] = os.stat(file).st_mtime
-    return last_modified
 
+def shake_tree(sources, page, keep):
+    '''
+    Removes top-level declarations that can't be reached from the given page's own script.
+    Everything in the page's script is a root, as is every top-level statement elsewhere that
+    isn't a declaration (e.g. window.addEventListener(...)), any declaration whose initializer
+    might have side effects, and the given names. Anything those reference (across includes)
+    is reachable, and so on.
+
+    Members of singletons (let Foo = new function() { this.bar = ... }) are also removed if
+    nothing reachable ever accesses a property with that name. consolelog is left alone,
+    since it's usable from the console.
 
-def preminify_markdown(lines, rem_log):
+    Modifies sources in place, and returns the names that were removed along with the number of bytes saved
     '''
-    We can save a few extra KBs by doing some targeted minification on
-    markdown.js that our minification tools would otherwise overlook
+    statements = []
+    declared = {}
+    waiting = {}
+    parsed = {}
+    for include, source in sources.items():
+        if include == 'consolelog':
+            continue
+        tokens = tokenize_js(source)
+        parsed[include] = tokens
+        for statement in split_top_level(tokens):
+            statement['include'] = include
+            statements.append(statement)
+            for name in statement['names']:
+                declared.setdefault(name, []).append(statement)
+            if statement['body'] is None:
+                continue
+
+            # The singleton itself only needs what its non-member statements need
+            statement['references'] = set()
+            statement['accesses'] = set()
+            for inner in split_top_level(tokens, *statement['body']):
+                member = singleton_member(tokens, inner)
+                if member is None or statement['include'] == page:
+                    statement['references'].update(inner['references'])
+                    statement['accesses'].update(inner['accesses'])
+                    continue
+                inner['include'] = include
+                inner['removable'] = True
+                inner['names'] = [statement['names'][0] + '.' + member]
+                statements.append(inner)
+                waiting.setdefault(member, []).append(inner)
+
+    reachable = set()
+    accessed = set()
+    pending = [statement for statement in statements if statement['include'] == page or not statement['removable']]
+    for name in keep:
+        pending += declared.get(name, [])
+    while len(pending) != 0:
+        statement = pending.pop()
+        if id(statement) in reachable:
+            continue
+        reachable.add(id(statement))
+        for name in statement['references']:
+            pending += declared.get(name, [])
+        for name in statement['accesses'] - accessed:
+            accessed.add(name)
+            pending += waiting.get(name, [])
+
+    removed = []
+    saved = 0
+    for include, tokens in parsed.items():
+        drop = set()
+        for statement in statements:
+            if statement['include'] != include or id(statement) in reachable or not statement['removable']:
+                continue
+            start, end = statement['start'], statement['end']
+            if start in drop:
+                continue # Member of a singleton that's being removed entirely
+
+            # Also take the comments directly above the declaration
+            while start > 0 and (tokens[start - 1][0] == 'comment' or (tokens[start - 1][0] == 'ws' and tokens[start - 1][1].count('\n') < 2)):
+                start -= 1
+            if tokens[start][0] == 'ws':
+                start += 1
+            if end < len(tokens) and tokens[end][0] == 'ws':
+                end += 1
+
+            removed += statement['names']
+            saved += sum(len(tokens[i][1]) for i in range(start, end) if i not in drop)
+            drop.update(range(start, end))
+        if len(drop) != 0:
+            sources[include] = ''.join(token[1] for i, token in enumerate(tokens) if i not in drop)
+
+    return removed, saved
+
+
+def singleton_member(tokens, statement):
+    '''
+    Returns NAME if the given statement from the body of a singleton is a
+    side effect free "this.NAME = ..." assignment, otherwise None
     '''
+    sig = [i for i in range(statement['start'], statement['end']) if tokens[i][0] not in ('ws', 'comment')]
+    if len(sig) < 5 or [tokens[i][1] for i in sig[:2]] != ['this', '.'] or tokens[sig[3]][1] != '=':
+        return None
+    if tokens[sig[2]][0] != 'ident' or not is_pure_initializer(tokens, sig[4:]):
+        return None
+    return tokens[sig[2]][1]
 
-    # start with direct replacement for the State enum
-    lines = minify_markdown_state_enum(lines)
 
-    # stateToStr takes up a lot of space when it probably doesn't have to for the minified version
-    # Save several hundred bytes by removing it
-    start = lines.find('const stateToStr')
-    if start != -1:
-        end = lines.find('}', lines.find('}', start) + 1) + 1
-        if end != -1:
-            lines = lines.replace(lines[start:end], 'let stateToStr = (state) => state;')
+def split_top_level(tokens, begin=0, stop=None):
+    '''
+    Splits the given tokens (or the range [begin, stop) of them) into top-level statements. Returns
+    a list of dictionaries with the token range of the statement, the names it declares, the
+    identifiers it references, the properties it accesses, whether it can be removed if nothing
+    references it, and the token range of its body if it declares a singleton
+    '''
+    statements = []
+    sig = [i for i in range(begin, len(tokens) if stop is None else stop) if tokens[i][0] not in ('ws', 'comment')]
+    j = 0
+    while j < len(sig):
+        first = tokens[sig[j]][1]
+        keyword = first
+        if first == 'async' and j + 1 < len(sig) and tokens[sig[j + 1]][1] == 'function':
+            keyword = 'function'
+
+        # Find the end of the statement. Functions and classes end with their body,
+        # everything else with a semicolon (or a '}' that's followed by a declaration)
+        depth = 0
+        entered = False
+        end = j
+        while end < len(sig):
+            text = tokens[sig[end]][1]
+            if text in ('(', '[', '{'):
+                depth += 1
+                entered = entered or (text == '{' and depth == 1)
+            elif text in (')', ']', '}'):
+                depth -= 1
+            if depth == 0:
+                if keyword in ('function', 'class') and entered and text == '}':
+                    break
+                if text == ';':
+                    break
+                if text == '}' and end + 1 < len(sig) and tokens[sig[end + 1]][1] in ('function', 'class', 'let', 'const', 'var', 'async'):
+                    break
+            end += 1
+        end = min(end, len(sig) - 1)
+
+        names = []
+        removable = False
+        body = None
+        if keyword in ('function', 'class'):
+            name = j + (2 if first == 'async' else 1)
+            if name < len(sig) and tokens[sig[name]][1] == '*':
+                name += 1
+            if name < len(sig) and tokens[sig[name]][0] == 'ident':
+                names.append(tokens[sig[name]][1])
+                removable = True
+        elif keyword in ('let', 'const', 'var') and j + 2 <= end and tokens[sig[j + 1]][0] == 'ident':
+            names.append(tokens[sig[j + 1]][1])
+            initializer = sig[j + 3:end + 1]
+            removable = tokens[sig[j + 2]][1] == ';' or (tokens[sig[j + 2]][1] == '=' and is_pure_initializer(tokens, initializer))
+            if removable and [tokens[i][1] for i in initializer[:5]] == ['new', 'function', '(', ')', '{']:
+                close = end - (1 if tokens[sig[end]][1] == ';' else 0)
+                if tokens[sig[close]][1] == ')' and tokens[sig[close - 1]][1] == '(':
+                    close -= 2
+                body = (initializer[4] + 1, sig[close])
+
+        references = set()
+        accesses = set()
+        for k in range(j, end + 1):
+            kind, text = tokens[sig[k]]
+            if kind == 'string' and re.match(r'^[A-Za-z_$][\w$]*$', text[1:-1]):
+                accesses.add(text[1:-1]) # Possibly obj["name"]
+            if kind != 'ident':
+                continue
+            if k > 0 and tokens[sig[k - 1]][1] == '.':
+                accesses.add(text)
+                continue
+            if k > 0 and tokens[sig[k - 1]][1] in ('{', ',') and k + 1 < len(sig) and tokens[sig[k + 1]][1] == ':':
+                continue # Object key
+            references.add(text)
+            accesses.add(text) # Could be destructuring (let { name } = obj)
+        references.difference_update(names)
+
+        statements.append({
+            'start' : sig[j],
+            'end' : sig[end] + 1,
+            'names' : names,
+            'references' : references,
+            'accesses' : accesses,
+            'removable' : removable,
+            'body' : body
+        })
+        j = end + 1
+
+    return statements
+
+
+def is_pure_initializer(tokens, sig):
+    '''
+    Returns whether the given initializer (the significant token indexes between '=' and the end of
+    the statement) can be dropped without side effects: a function, class, arrow function, or a
+    literal that doesn't call anything. Multiple declarators (let a = 1, b = 2) are never pure, to
+    avoid having to track which one is referenced.
+    '''
+    if len(sig) == 0:
+        return False
+    texts = [tokens[i][1] for i in sig]
+    if texts[-1] == ';':
+        texts = texts[:-1]
+    if len(texts) == 0:
+        return False
+
+    depth = 0
+    for text in texts:
+        if text in ('(', '[', '{'):
+            depth += 1
+        elif text in (')', ']', '}'):
+            depth -= 1
+        elif text == ',' and depth == 0:
+            return False
+
+    if texts[0] in ('function', 'class') or texts[:2] == ['async', 'function']:
+        return True
+    if len(texts) > 1 and tokens[sig[0]][0] == 'ident' and texts[1] == '=>':
+        return True
+    if texts[0] == '(':
+        # Arrow function: find the closing parenthesis and check for '=>'
+        depth = 0
+        for k, text in enumerate(texts):
+            depth += 1 if text == '(' else -1 if text == ')' else 0
+            if depth == 0:
+                return k + 1 < len(texts) and texts[k + 1] == '=>'
+        return False
+    if len(texts) == 1 and (tokens[sig[0]][0] in ('number', 'string', 'regex') or texts[0] in ('true', 'false', 'null', 'undefined')):
+        return True
+    if len(texts) == 1 and tokens[sig[0]][0] == 'template':
+        return '${' not in texts[0]
+    if texts[0] in ('{', '['):
+        # Object/array literals are fine as long as nothing is called or constructed while building them
+        return '(' not in texts and 'new' not in texts and '`' not in ''.join(texts)
+    if texts[:5] == ['new', 'function', '(', ')', '{'] and texts[-2:] == ['(', ')']:
+        texts = texts[:-2]
+    if texts[:5] == ['new', 'function', '(', ')', '{'] and texts[-1] == '}':
+        # Singletons (let Foo = new function() { ... }) are fine if all they do is define things
+        body = tokens[sig[4] + 1:sig[len(texts) - 1]]
+        for statement in split_top_level(body):
+            if statement['removable']:
+                continue
+            inner = [i for i in range(statement['start'], statement['end']) if body[i][0] not in ('ws', 'comment')]
+            if [body[i][1] for i in inner[:2]] != ['this', '.'] or len(inner) < 5 or body[inner[3]][1] != '=' \
+                    or not is_pure_initializer(body, inner[4:]):
+                return False
+        return True
+    return False
+
+
+class ShakeReport:
+    '''Tracks the declarations removed by -shake across all bundles built during this run'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pages = {}
+
+    def add(self, page, removed, saved):
+        '''Records the declarations removed from a single page's bundle'''
+        with self.lock:
+            self.pages[page] = (removed, saved)
+
+    def report(self, quiet):
+        '''Returns the lines describing the declarations removed since the last report, then resets'''
+        with self.lock:
+            if len(self.pages) == 0:
+                return []
+            saved = sum(entry[1] for entry in self.pages.values())
+            removed = sum(len(entry[0]) for entry in self.pages.values())
+            out = [f'Removed {removed} unused declaration(s) from {len(self.pages)} bundle(s), saving {saved} bytes before minification']
+            if not quiet:
+                for page, entry in sorted(self.pages.items(), key=lambda item: -item[1][1]):
+                    out.append(f'  {page:<20}: {len(entry[0])} declarations, {entry[1]} bytes')
+            self.pages = {}
+            return out
+
+g_shake_report = ShakeReport()
 
-    if rem_log != 0:
-        start = lines.find('const shouldLogTmi = ')
-        if start == -1:
-            print('WARN: could not find "shouldLogTmi" for removal')
-        else:
-            end = lines.find('}\n', start) + 2
-            lines = lines.replace(lines[start:end], '')
+
+# Script bundles that have been built, but not minified yet
+g_bundles = {}
+
+
+def preminify_markdown(lines, rem_log, rewriter, names):
+    '''
+    We can save a few extra KBs by doing some targeted minification on
+    markdown.js that our minification tools would otherwise overlook.
+    Adds markdown-specific rules on top of the given bundle-wide rules,
+    using the given VarAllocator for new names.
+    '''
+
+    rules = JsRewriter()
+    rules.renames = { name : list(renames) for name, renames in rewriter.renames.items() }
+    rules.paths = { name : list(paths) for name, paths in rewriter.paths.items() }
 
     # Check whether we should remove TMI logging. There is a
     # separate flag for markdown-specific removal, since it's especially noisy
     if rem_log == 4:
-        lines = re.sub(r'(\/\*@__PURE__\*\/)?\blogTmi\(.*\); *\n', '', lines)
+        rules.remove_call('Log', 'tmi')
+        rules.remove_call('logTmi')
 
     # currentRun is used quite a bit
-    lines = re.sub(r'\bthis\.currentRun\b', 'this.' + next_var(), lines)
+    rules.rename('currentRun', names.next(), member=True)
 
     # State of a run - Disabled because other classes use .state
-    # lines = re.sub(r'\.state\b', '.' + next_var(), lines)
+    # rules.rename('state', names.next(), member=True)
 
     # Inner runs
-    lines = re.sub(r'\binnerRuns\b', next_var(), lines)
+    rules.rename('innerRuns', names.next())
 
     # Run methods
-    lines = re.sub(r'\bstartContextLength\b', next_var(), lines)
-    lines = re.sub(r'\bendContextLength\b', next_var(), lines)
-    lines = re.sub(r'\btransform\b', next_var(), lines)
+    rules.rename('startContextLength', names.next())
+    rules.rename('endContextLength', names.next())
+    rules.rename('transform', names.next())
 
     # Now look for things that are very method-like.
     for match in re.finditer(r'\n    (_\w+)\(', lines):
-        cur_var = next_var()
+        cur_var = names.next()
         if cur_var == '':
-            return lines
-        lines = re.sub(r'\b' + match.group(1) + r'\b', cur_var, lines)
+            break
+        rules.rename(match.group(1), cur_var)
 
     # TODO: this.text is _very_ heavily used, but multiple classes
     # use this, so it breaks things.
 
     # Now getting real hacky. Modify String's prototype to save a hundred bytes or so
     # Some should already be done if 'ultra' is set, so don't do anything in that case
-    lines = re.sub(r'\.indexOf\(', '.i(', lines)
+    rules.rename('indexOf', 'i', member=True, call=True)
+    rules.rename('substring', 's', member=True, call=True)
+    lines = rules.rewrite(lines)
     lines = 'String.prototype.i = String.prototype.indexOf;\n' + lines
     lines = 'Array.prototype.i = Array.prototype.indexOf;\n' + lines
-
-    lines = re.sub(r'\.substring\(', '.s(', lines)
     lines = 'String.prototype.s = String.prototype.substring;\n' + lines
 
     return lines
 
 
-def minify_markdown_state_enum(lines):
+def strip_markdown_debug(lines, rem_log):
     '''
-    Uses direct substitution to remove the State enum from markdown.js
+    Removes markdown.js's debugging helpers. Done before looking for
+    enums, so references in the removed code aren't counted
     '''
 
-    start = lines.find('\nconst State =')
-    if start == -1:
-        print('Error pre-minifying markdown. Couldn\'t find State definition, did it change?')
-        return lines
+    # stateToStr takes up a lot of space when it probably doesn't have to for the minified version
+    # Save several hundred bytes by removing it
+    start = lines.find('const stateToStr')
+    if start != -1:
+        end = lines.find('}', lines.find('}', start) + 1) + 1
+        if end != -1:
+            lines = lines.replace(lines[start:end], 'let stateToStr = (state) => state;')
+
+    if rem_log != 0:
+        start = lines.find('const shouldLogTmi = ')
+        if start == -1:
+            print('WARN: could not find "shouldLogTmi" for removal')
+        else:
+            end = lines.find('}\n', start) + 2
+            lines = lines.replace(lines[start:end], '')
 
-    end = lines.find('}', start)
-    definition = lines[start:end]
-    lines = lines[:start] + lines[end + 2:]
-    results = re.findall(r'(\w+) : (\d+)', definition)
-    for result in results:
-        lines = re.sub(r'\bState\.' + result[0] + r'\b', str(result[1]), lines)
     return lines
 
 
-g_var_cur = 'a'
-def next_var():
+class VarAllocator:
     '''
-    Returns the next available minified variable, tracked globally
+    Hands out short names for -ultra's renames. Each module that needs names gets its own
+    allocator, so the names it's given (and therefore its preprocessed output) don't depend
+    on which other scripts happen to be in the bundle
     '''
 
-    global g_var_cur
-
-    # skip over i/j/k. Hopefully I remember not to have
-    # other single-letter variable name
-    base = g_var_cur[:len(g_var_cur) - 1]
-    cur = g_var_cur[len(g_var_cur) - 1]
-    if cur == 'h' and base == '':
-        cur = 'l'
-    elif cur == 'z':
-        cur = 'A'
-    elif cur == 'Z':
-        cur = 'a'
-        if base == '':
-            base = '_'
-        elif base == '_':
-            base = '_a'
-        elif base == '_z':
-            print('Why are there so many method names?! Things are broken, consider rewriting this mess')
-            return ''
+    def __init__(self, last='a'):
+        self.last = last
+
+    def next(self):
+        '''
+        Returns the next available minified variable
+        '''
+
+        # skip over i/j/k. Hopefully I remember not to have
+        # other single-letter variable name
+        base = self.last[:len(self.last) - 1]
+        cur = self.last[len(self.last) - 1]
+        if cur == 'h' and base == '':
+            cur = 'l'
+        elif cur == 'z':
+            cur = 'A'
+        elif cur == 'Z':
+            cur = 'a'
+            if base == '':
+                base = '_'
+            elif base == '_':
+                base = '_a'
+            elif base == '_z':
+                print('Why are there so many method names?! Things are broken, consider rewriting this mess')
+                return ''
+            else:
+                base = base[0] + chr(ord(base[1]) + 1)
         else:
-            base = base[0] + chr(ord(base[1]) + 1)
-    else:
-        cur = chr(ord(cur) + 1)
-    g_var_cur = base + cur
-    return g_var_cur
+            cur = chr(ord(cur) + 1)
+        self.last = base + cur
+        return self.last
+
 
-def reset_var():
-    global g_var_cur
-    g_var_cur = 'a'
+def finish_bundle(bundle, name, minified, minifier_map):
+    '''
+    Removes the include markers from the given minified bundle, recording its sizes and
+    building its source map (if possible) along the way, then writes it to a file named
+    by its contents. Returns the path it was written to
+    '''
+    stripped, removed = strip_include_markers(minified)
+    min_file = bundle.path or 'min/script/' + name + '.' + content_hash(stripped) + '.min.js'
+    record_bundle_sizes(bundle, min_file, minified, stripped)
+    with profile('source map', file=min_file):
+        source_map = build_source_map(bundle, min_file, minified, stripped, removed, minifier_map)
+    if source_map is not None:
+        with open(min_file + '.map', 'w', encoding='utf-8') as map_file:
+            json.dump(source_map, map_file, separators=(',', ':'))
+        stripped += '\n//# sourceMappingURL=' + source_map['file'] + '.map\n'
+    write_bundle(min_file, stripped)
+    return min_file
 
 
-def minify(babel, quiet):
-    '''Invoke terser to minify our build js files'''
-    if not os.path.exists('tmp'):
-        return
+def content_hash(text):
+    '''Returns the md5 hash of the given text, truncated to 10 digits, which outputs are named by'''
+    return hashlib.md5(text.encode('utf-8')).hexdigest()[:10]
+
 
+def write_bundle(min_file, contents):
+    '''Writes a finished bundle to the min directory. This is the only time it touches the disk'''
+    with profile('write', file=min_file):
+        with open(min_file, 'w', encoding='utf-8') as min_out:
+            min_out.write(contents)
+
+
+def build_source_map(bundle, min_file, minified, stripped, removed, minifier_map):
+    '''
+    Returns the source map for the given minified bundle, pointing back at the original scripts.
+    The minifier's map (minified bundle -> bundle) is chained with the bundle's line map
+    (bundle -> scripts), then adjusted for the include markers that were removed. Columns
+    are carried over from the bundle as-is, so they can be a bit off on lines that were
+    rewritten. Returns None if the minifier didn't write a map (e.g. babel)
+    '''
+    line_map = bundle.line_map
+    if minifier_map is not None:
+        minifier_map = json.loads(minifier_map)
+        names = minifier_map.get('names', [])
+        segments = decode_mappings(minifier_map['mappings'])
+    elif minified == bundle.text():
+        # Not minified (-dev), so every line maps to itself
+        names = []
+        segments = [[[0, 0, line, 0]] for line in range(minified.count('\n') + 1)]
+    else:
+        return None
+
+    starts = line_offsets(minified)
+    stripped_starts = line_offsets(stripped)
+    removed_starts = [start for start, _ in removed]
+    shifts = [0]
+    for start, end in removed:
+        shifts.append(shifts[-1] + end - start)
+
+    sources = {}
+    chained = [[] for _ in stripped_starts]
+    for line, line_segments in enumerate(segments[:len(starts)]):
+        for segment in line_segments:
+            if len(segment) < 4 or segment[2] >= len(line_map) or line_map[segment[2]] is None:
+                continue
+            offset = starts[line] + segment[0]
+            k = bisect.bisect_right(removed_starts, offset)
+            if k != 0 and offset < removed[k - 1][1]:
+                continue # Part of a marker
+            offset -= shifts[k]
+            stripped_line = bisect.bisect_right(stripped_starts, offset) - 1
+            include, source_line = line_map[segment[2]]
+            source = sources.setdefault('../../script/' + include + '.js', len(sources))
+            chained[stripped_line].append([offset - stripped_starts[stripped_line], source, source_line, segment[3]] + segment[4:5])
+
+    return {
+        'version' : 3,
+        'file' : os.path.basename(min_file),
+        'sources' : list(sources),
+        'names' : names,
+        'mappings' : encode_mappings(chained)
+    }
+
+
+def line_offsets(text):
+    '''Returns the offset of the start of each line in the given text'''
+    offsets = [0]
+    newline = text.find('\n')
+    while newline != -1:
+        offsets.append(newline + 1)
+        newline = text.find('\n', newline + 1)
+    return offsets
+
+
+BASE64_DIGITS = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/'
+
+def decode_mappings(mappings):
+    '''
+    Decodes the mappings of a source map into a list of segments for each generated line, where
+    each segment is [column, source, source line, source column, name] (all absolute, and only
+    the column is required)
+    '''
+    lines = []
+    state = [0, 0, 0, 0, 0]
+    for group in mappings.split(';'):
+        segments = []
+        state[0] = 0
+        for segment in group.split(','):
+            if len(segment) == 0:
+                continue
+            values = []
+            value = shift = 0
+            for char in segment:
+                digit = BASE64_DIGITS.index(char)
+                value += (digit & 31) << shift
+                shift += 5
+                if digit & 32 == 0:
+                    values.append(-(value >> 1) if value & 1 else value >> 1)
+                    value = shift = 0
+            for i, value in enumerate(values):
+                state[i] += value
+            segments.append(state[:len(values)])
+        lines.append(segments)
+    return lines
+
+
+def encode_mappings(lines):
+    '''Encodes a list of segments for each generated line (see decode_mappings) as source map mappings'''
+    groups = []
+    state = [0, 0, 0, 0, 0]
+    for segments in lines:
+        encoded = []
+        state[0] = 0
+        for segment in segments:
+            field = ''
+            for i, value in enumerate(segment):
+                delta = value - state[i]
+                state[i] = value
+                delta = (-delta << 1) | 1 if delta < 0 else delta << 1
+                while True:
+                    digit = delta & 31
+                    delta >>= 5
+                    field += BASE64_DIGITS[digit | (32 if delta != 0 else 0)]
+                    if delta == 0:
+                        break
+            encoded.append(field)
+        groups.append(','.join(encoded))
+    return ';'.join(groups)
+
+
+STACK_FRAME_REGEX = re.compile(r'(?:[\w:/.-]*/)?([\w.-]+\.min\.js):(\d+):(\d+)')
+
+def decode_stack_trace(trace):
+    '''
+    Maps each minified location in the given stack trace (e.g. index.0123456789.min.js:1:2345)
+    back to the original script, using the source maps written next to each bundle
+    '''
+    maps = {}
+    def resolve(match):
+        name = match.group(1)
+        if name not in maps:
+            maps[name] = None
+            try:
+                with open('min/script/' + name + '.map', encoding='utf-8') as map_file:
+                    source_map = json.load(map_file)
+                maps[name] = (source_map['sources'], decode_mappings(source_map['mappings']))
+            except (OSError, ValueError, KeyError):
+                pass
+        line, column = int(match.group(2)) - 1, int(match.group(3)) - 1
+        if maps[name] is None or line >= len(maps[name][1]):
+            return match.group(0)
+        segments = [segment for segment in maps[name][1][line] if segment[0] <= column and len(segment) >= 4]
+        if len(segments) == 0:
+            return match.group(0)
+        source = maps[name][0][segments[-1][1]]
+        if source.startswith('../../'):
+            source = source[6:]
+        return f'{source}:{segments[-1][2] + 1}:{segments[-1][3] + 1}'
+
+    return STACK_FRAME_REGEX.sub(resolve, trace)
+
+
+def minify_options(babel):
+    '''Returns the options script bundles are minified with, for terser or babel-minify'''
     options = [
         'booleans_as_integers',
         'ecma=8',
@@ -736,57 +4365,580 @@ def minify(babel, quiet):
         'undefinedToVoid'
     ]
 
-    files = glob.glob("tmp/*.js")
-    for file in files:
-        run_cmd(file, options_babel if babel else options, babel, quiet)
+    return options_babel if babel else options
 
 
-def run_cmd(file, options, babel, quiet):
-    '''Finally invoke the node command to minify the given file'''
-    base_file = file[file.find(os.sep) + 1:file.find('.')]
-    remove_existing(base_file)
-    file_hash = get_hash(file)
-    clean_file = base_file + '.' + file_hash + '.min.js'
-    print('Minifying', clean_file)
+def run_cmd(name, bundle, options, babel, quiet):
+    '''Finally invoke the node command to minify the given bundle, returning the lines to print'''
+    if g_dev:
+        min_file = finish_bundle(bundle, name, bundle.text(), None)
+        g_manifest.commit('script/' + name, min_file)
+        return ['Copying ' + os.path.basename(min_file) + ' (unminified)']
+
+    cache_key = artifact_key('babel' if babel else 'terser', options, bundle.text())
+    cached = fetch_artifact(cache_key)
+    if cached is not None:
+        minified, output, minifier_map = cached
+    else:
+        minified, output, minifier_map = minify_js(name, bundle.text(), options, babel)
+        store_artifact(cache_key, minified, output, minifier_map)
+
+    min_file = finish_bundle(bundle, name, minified, minifier_map)
+    g_manifest.commit('script/' + name, min_file)
+    out = ['Minifying ' + os.path.basename(min_file) + (' (cached)' if cached is not None else '')]
+    if not quiet:
+        out += process_output(output, name, bundle)
+        out.append('')
+    return out
+
+
+def minify_js(name, source, options, babel):
+    '''
+    Minifies the given bundle, streaming it to the minifier. Returns the minified
+    source, the minifier's output, and its source map (or None if it didn't write one)
+    '''
+    result = server_minify('babel' if babel else 'terser', source, name + '.js', babel_options(options) if babel else terser_options(options))
+    if result is not None:
+        return result
+
     system = platform.system()
     if system == 'Windows':
         if babel:
             cmd_params = ' --' + ' --'.join(options)
-            cmd = 'node.exe ' + os.environ['APPDATA'] + r'\npm\node_modules\babel-minify\bin\minify.js '
-            cmd += file + cmd_params + ' --o min\\script\\' + clean_file
+            cmd = 'node.exe ' + os.environ['APPDATA'] + r'\npm\node_modules\babel-minify\bin\minify.js' + cmd_params
         else:
-            cmd_params = ' -c ' + ','.join(options) + ' -m'
-            cmd = 'node.exe ' + os.environ['APPDATA'] + r'\npm\node_modules\terser\bin\terser '
-            cmd += file + ' -o min\\script\\' + clean_file + cmd_params
+            cmd_params = ' -c ' + ','.join(options) + ' -m --source-map "url=inline"'
+            cmd = 'node.exe ' + os.environ['APPDATA'] + r'\npm\node_modules\terser\bin\terser' + cmd_params
     elif system == 'Linux':
-        cmd = ['terser', file, '-o', 'min/script/' + clean_file, '-c', ','.join(options), '-m']
+        cmd = ['terser', '-c', ','.join(options), '-m', '--source-map', 'url=inline']
     else:
-        print('Unsupported OS:', os)
-    output = subprocess.check_output(cmd, stderr=subprocess.STDOUT).decode('utf-8')
-    if not quiet:
-        process_output(output)
+        raise RuntimeError('Unsupported OS: ' + system)
+    minified, output = run_tool(cmd, 'babel' if babel else 'terser', name, source)
+    minified, source_map = split_inline_source_map(minified)
+    return minified, output, source_map
+
+
+INLINE_SOURCE_MAP_REGEX = re.compile(r'\n?//# sourceMappingURL=data:application/json;(?:charset=utf-8;)?base64,([A-Za-z0-9+/=]+)\s*$')
+
+def split_inline_source_map(minified):
+    '''Returns the given minified source without its inline source map, and the map itself (or None if there isn't one)'''
+    match = INLINE_SOURCE_MAP_REGEX.search(minified)
+    if match is None:
+        return minified, None
+    return minified[:match.start()], base64.b64decode(match.group(1)).decode('utf-8')
+
+
+class ArtifactCache:
+    '''
+    Content-addressed store of minified outputs, so that bundles we've minified before
+    (on another branch, in another worktree, or on another CI run sharing the same
+    directory) are copied instead of re-minified.
+
+    Entries are keyed on a digest of the unminified bundle, the minifier and its version,
+    and the minification options. Each entry is a single JSON file holding the output,
+    the minifier's warnings, and its source map (if any). Writes are atomic, so multiple builds can share a cache
+    directory. Hits bump the entry's mtime, and once the cache grows beyond its size cap
+    the least recently used entries are evicted.
+    '''
+
+    VERSION = 2
+    DEFAULT_SIZE_MB = 256
+
+    def __init__(self, path, max_size_mb):
+        self.path = path
+        self.max_size = max_size_mb * 1024 * 1024
+        self.modified = False
+
+    @staticmethod
+    def default_path():
+        '''The cache directory, which can be shared between worktrees by setting PLEXWEB_BUILD_CACHE'''
+        return os.environ.get('PLEXWEB_BUILD_CACHE', 'includes' + os.sep + 'cache' + os.sep + 'artifacts')
+
+    def entry_path(self, key):
+        return os.path.join(self.path, key[:2], key + '.json')
+
+    def get(self, key):
+        '''Returns the (output, warnings, source map) stored for the given key, or None if it isn't cached'''
+        path = self.entry_path(key)
+        try:
+            with open(path, encoding='utf-8') as entry_file:
+                entry = json.load(entry_file)
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return (entry['output'], entry['warnings'], entry.get('map'))
+
+    def put(self, key, output, warnings, source_map=None):
+        '''Stores the given output, warnings, and source map under the given key'''
+        path = self.entry_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Unique temp name per process/thread so concurrent builds never write the same file
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as entry_file:
+            json.dump({ 'output' : output, 'warnings' : warnings, 'map' : source_map }, entry_file)
+        os.replace(tmp_path, path)
+        self.modified = True
+
+    def evict(self):
+        '''Removes the least recently used entries until the cache is under its size cap'''
+        if not self.modified:
+            return
+
+        entries = []
+        total = 0
+        for root, _, names in os.walk(self.path):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue # Removed by a concurrent build
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+        self.modified = False
+
+
+g_artifacts = None
+
+
+def artifact_key(tool, options, source):
+    '''Returns the artifact cache key for minifying the given source with the given tool and options'''
+    if g_artifacts is None:
+        return None
+    state = json.dumps([ArtifactCache.VERSION, tool, tool_version(tool), options, minify_server_mode()])
+    digest = hashlib.sha256(state.encode('utf-8') + b'\0')
+    digest.update(source.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def fetch_artifact(key):
+    '''
+    Returns the cached output, minifier output, and source map for the given key,
+    or None if there's no cached copy
+    '''
+    if key is None:
+        return None
+    return g_artifacts.get(key)
+
+
+def store_artifact(key, output, warnings, source_map=None):
+    '''Adds freshly minified output (and its source map, if any) to the artifact cache'''
+    if key is None:
+        return
+    g_artifacts.put(key, output, warnings, source_map)
+
+
+def terser_options(options):
+    '''Converts terser command line compress options into the equivalent minify() API options'''
+    compress = {}
+    for option in options:
+        key, _, value = option.partition('=')
+        if value == '' or value == 'true':
+            compress[key] = True
+        elif value == 'false':
+            compress[key] = False
+        else:
+            compress[key] = int(value) if value.isdigit() else value
+    return { 'compress' : compress, 'mangle' : True, 'sourceMap' : True }
+
+
+def babel_options(options):
+    '''Converts babel-minify command line flags into the equivalent API options'''
+    return { option : True for option in options }
+
+
+g_minify_server = None
+g_dev = False
+def minify_server_mode():
+    '''Returns how minification is being done, which is part of each output's build state'''
+    if g_dev:
+        return 'unminified'
+    if g_minify_server is None:
+        return 'none'
+    return 'echo' if g_minify_server.echo else 'node'
+
+
+def start_minify_server(jobs, echo):
+    '''
+    Starts the persistent node minification helper, falling back to spawning
+    a process per file if it isn't available
+    '''
+    global g_minify_server
+    pool = MinifyServerPool(jobs, echo)
+    if not pool.start():
+        print('WARN: Could not start the node minification helper, falling back to one process per file')
+        return
+    g_minify_server = pool
+    atexit.register(stop_minify_server)
+
+
+def stop_minify_server():
+    '''Shuts down the node minification helper, if it's running'''
+    global g_minify_server
+    if g_minify_server is not None:
+        g_minify_server.stop()
+        g_minify_server = None
+
+
+def server_minify(tool, source, path, options=None):
+    '''
+    Minifies the given source using the node helper. Returns the minified source,
+    any warnings as a newline-separated string, and the source map (if any), or None if
+    the helper isn't running or couldn't process the file, in which case the caller
+    should spawn the minifier itself
+    '''
+    if g_minify_server is None:
+        return None
+
+    with profile(tool + ' (daemon)', 'subprocess', file=path):
+        result = g_minify_server.minify(tool, source, options, path)
+    if result is None:
+        return None
+
+    # Match the CLI's output so process_output can handle both
+    code, warnings, source_map = result
+    return code, '\n'.join(w if w.startswith('WARN: ') else 'WARN: ' + w for w in warnings), source_map
+
+
+class MinifyServer:
+    '''
+    A single long-lived node process running includes/minify_server.js, which
+    minifies sources sent to it as newline-delimited JSON over stdin/stdout
+    '''
+
+    def __init__(self, echo):
+        self.echo = echo
+        self.process = None
+        self.next_id = 0
+
+    def start(self):
+        '''Starts the helper, returning whether it's ready to accept work'''
+        node = shutil.which('node.exe' if platform.system() == 'Windows' else 'node')
+        script = 'includes' + os.sep + 'minify_server.js'
+        if node is None or not os.path.exists(script):
+            return False
+
+        cmd = [node, script] + (['--echo'] if self.echo else [])
+        try:
+            self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, encoding='utf-8')
+            ready = json.loads(self.process.stdout.readline())
+        except (OSError, ValueError):
+            self.stop()
+            return False
+        return ready.get('ready', False)
+
+    def minify(self, tool, source, options, path):
+        '''
+        Minifies the given source, returning a (code, warnings, source map) tuple, or None if the request failed
+        '''
+        if self.process is None or self.process.poll() is not None:
+            return None
+
+        self.next_id += 1
+        request = { 'id' : self.next_id, 'tool' : tool, 'source' : source, 'options' : options, 'path' : path }
+        try:
+            self.process.stdin.write(json.dumps(request) + '\n')
+            self.process.stdin.flush()
+            response = json.loads(self.process.stdout.readline())
+        except (OSError, ValueError):
+            # The helper went away. Let the caller fall back to the command line tools
+            self.stop()
+            return None
+
+        # Errors (missing tool, syntax errors, etc.) are left to the command line
+        # tools, which will either succeed or report the failure in a familiar format
+        if 'error' in response or response.get('id') != self.next_id:
+            return None
+        return (response['code'], response.get('warnings', []), response.get('map'))
+
+    def stop(self):
+        '''Shuts down the helper by closing its input'''
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=5)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+        self.process = None
+
+
+class MinifyServerPool:
+    '''
+    Hands out MinifyServers to minification jobs, starting up to max_servers of them on
+    demand so that parallel jobs (-j) aren't serialized behind a single node process
+    '''
+
+    def __init__(self, max_servers, echo):
+        self.max_servers = max_servers
+        self.echo = echo
+        self.servers = []
+        self.idle = queue.Queue()
+        self.lock = threading.Lock()
+
+    def start(self):
+        '''Starts the first helper, returning whether the helper is usable at all'''
+        server = MinifyServer(self.echo)
+        if not server.start():
+            return False
+        self.servers.append(server)
+        self.idle.put(server)
+        return True
+
+    def minify(self, tool, source, options, path):
+        '''Minifies the given source on the next available helper. See MinifyServer.minify'''
+        server = self.acquire()
+        try:
+            return server.minify(tool, source, options, path)
+        finally:
+            self.idle.put(server)
+
+    def acquire(self):
+        '''Returns an idle helper, starting a new one if all are busy and we're below our limit'''
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self.lock:
+            if len(self.servers) < self.max_servers:
+                server = MinifyServer(self.echo)
+                if server.start():
+                    self.servers.append(server)
+                    return server
+        return self.idle.get()
+
+    def stop(self):
+        '''Shuts down all helpers'''
+        for server in self.servers:
+            server.stop()
+
+
+def remove_existing(key, current):
+    '''Remove all previous builds of the given output from the min directory'''
+    kind, base = key.split('/', 1)
+    directory = 'min/' + kind
+    if kind == 'asset':
+        prefix, suffix = static_asset_name(base)
+        prefix += '.'
+    elif kind == 'variant':
+        # Icons pre-rendered in another color live in a folder for that color
+        color, icon = base.split('/')
+        directory, prefix, suffix = 'min/icon/' + color, icon + '.', ASSET_SUFFIXES['icon']
+    else:
+        prefix, suffix = base + '.', ASSET_SUFFIXES[kind]
+    for file in g_index.find(directory, prefix, suffix):
+        if file != current:
+            remove_file(file)
+
+
+def remove_file(file):
+    '''Deletes the given file, its precompressed siblings, and its source map, if they still exist'''
+    for path in [file, file + '.map'] + [file + suffix for suffix in COMPRESSED_SUFFIXES.values()]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        g_index.remove(path)
+
+
+# Suffix of each kind of hashed output in the min directory
+ASSET_SUFFIXES = { 'script' : '.min.js', 'style' : '.min.css', 'icon' : '.svg' }
+
+g_stale_files = []
+g_removed_outputs = []
+def publish_assets():
+    '''
+    Points the site at the newly built files, then removes the files they replace, along
+    with every build of the outputs that are no longer produced.
+
+    New outputs are always written under new (hashed) names, so by the time we get here
+    both the old and new versions of every output exist. We write the asset manifest the
+    PHP side reads (see asset_path in common.php) atomically, and only then delete the old
+    versions, so a page is never pointed at a file that doesn't exist. Precompressed
+    versions are written before the manifest for the same reason.
+    '''
+    outputs = g_manifest.current_outputs()
+    if g_compressor is not None:
+        g_compressor.compress(outputs)
+    g_manifest.prune_bundle_sizes(set(outputs.values()))
+    write_asset_manifest(outputs)
+    for key, output in outputs.items():
+        remove_existing(key, output)
+    for key in g_removed_outputs:
+        remove_existing(key, None)
+    g_removed_outputs.clear()
+    for file in g_stale_files:
+        remove_file(file)
+    g_stale_files.clear()
+
+
+# Suffix of each kind of precompressed sibling written next to published files
+COMPRESSED_SUFFIXES = { 'gzip' : '.gz', 'brotli' : '.br' }
+
+g_compressor = None
+class Compressor:
+    '''
+    Writes maximum-level gzip and brotli versions of each published file next to it (e.g.
+    min/script/index.abc123.min.js.gz), so the web server can serve them directly instead of
+    compressing the same immutable files on every request (see .htaccess). Outputs are content
+    hashed, so each one usually only needs to be compressed once. The resulting sizes are kept in
+    the build manifest along with the (size, mtime) of the file that was compressed, so a file
+    that's rewritten in place is recompressed instead of keeping stale compressed versions. The
+    manifest also remembers when compression didn't make a file any smaller.
+    '''
+
+    def __init__(self, jobs, quiet):
+        self.jobs = jobs
+        self.quiet = quiet
+        self.formats = { 'gzip' : lambda data: gzip.compress(data, 9, mtime=0) }
+        if brotli is not None:
+            self.formats['brotli'] = lambda data: brotli.compress(data, quality=11)
+        elif shutil.which('brotli') is not None:
+            self.formats['brotli'] = lambda data: subprocess.run(['brotli', '-q', '11', '-c'], input=data, stdout=subprocess.PIPE, check=True).stdout
+
+    def compress(self, outputs):
+        '''Compresses any of the given outputs that haven't been already, then prints a summary if anything changed'''
+        # Images other than svgs are already compressed, and .htaccess only serves precompressed text
+        paths = [path for path in outputs.values() if path.endswith(('.js', '.css', '.svg')) and self.needs_compression(path)]
+        if len(paths) != 0:
+            run_jobs([lambda path=path: self.compress_file(path) for path in paths], self.jobs)
+        g_manifest.prune_compressed(set(outputs.values()))
+        if len(paths) != 0 and not self.quiet:
+            self.report(outputs)
+
+    def needs_compression(self, path):
+        '''Returns whether the given output changed since it was compressed, or is missing any of its compressed versions'''
+        sizes = g_manifest.compressed_sizes(path)
+        if sizes is None or sizes.get('stat') != list(g_index.stat(path) or []):
+            return True
+        for kind, suffix in COMPRESSED_SUFFIXES.items():
+            if kind in self.formats and kind not in sizes:
+                return True
+            if sizes.get(kind) is not None and not os.path.exists(path + suffix):
+                return True
+        return False
+
+    def compress_file(self, path):
+        '''
+        Writes each compressed version of the given file, unless it isn't any smaller
+        than the original, in which case any existing version is removed
+        '''
+        with open(path, 'rb') as raw:
+            stat = os.fstat(raw.fileno())
+            data = raw.read()
+        sizes = { 'raw' : len(data), 'stat' : [stat.st_size, stat.st_mtime_ns] }
+        for kind, compress in self.formats.items():
+            out_file = path + COMPRESSED_SUFFIXES[kind]
+            with profile(kind, file=path):
+                compressed = compress(data)
+            if len(compressed) >= len(data):
+                sizes[kind] = None
+                if os.path.exists(out_file):
+                    os.remove(out_file)
+                continue
+
+            with open(out_file + '.tmp', 'wb') as out:
+                out.write(compressed)
+            os.replace(out_file + '.tmp', out_file)
+            sizes[kind] = len(compressed)
+        g_manifest.set_compressed_sizes(path, sizes)
+        return []
+
+    def report(self, outputs):
+        '''Prints the raw and compressed size of each page's script, style, and shared chunks'''
+        pages = {}
+        for key, output in outputs.items():
+            kind, base = key.split('/', 1)
+            if kind in ('icon', 'variant', 'asset'):
+                continue
+            files = [output]
+            if kind == 'script':
+                files += [outputs[f'script/{chunk}'] for chunk in g_manifest.state(key)['flags'].get('chunks', []) if f'script/{chunk}' in outputs]
+            totals = pages.setdefault(base, { 'raw' : 0, 'gzip' : 0, 'brotli' : 0 })
+            for file in files:
+                sizes = g_manifest.compressed_sizes(file) or {}
+                raw = sizes.get('raw', 0)
+                totals['raw'] += raw
+                for compressed in ('gzip', 'brotli'):
+                    # Files that don't compress are served as-is
+                    totals[compressed] += raw if sizes.get(compressed) is None else sizes[compressed]
+
+        print()
+        print(f'{"Page":<20} {"Raw":>9} {"Gzip":>9} {"Brotli":>9}')
+        for page in sorted(pages):
+            totals = pages[page]
+            brotli_size = totals['brotli'] if 'brotli' in self.formats else '-'
+            print(f'{page:<20} {totals["raw"]:>9} {totals["gzip"]:>9} {brotli_size:>9}')
         print()
 
 
-def remove_existing(base):
-    '''Remove all minified files from the min directory'''
-    for file in glob.glob('min/script' + os.sep + base + '.*.min.js'):
-        os.remove(file)
+def write_asset_manifest(outputs):
+    '''
+    Writes includes/cache/assets.php, a PHP array mapping each page's script/style, each
+    icon, and each static asset to its current hashed path, along with the shared chunks each page needs. Being plain PHP, it's held by opcache, so
+    pages no longer glob the min directory on every request. Pre-rendered icon variants are listed by color/icon
+    '''
+    assets = { 'script' : {}, 'style' : {}, 'icon' : {}, 'variant' : {}, 'asset' : {}, 'chunks' : {} }
+    for key, output in outputs.items():
+        kind, base = key.split('/', 1)
+        # Icons are requested in lowercase (see iconMap.js)
+        assets[kind][base.lower() if kind == 'icon' else base] = output
+        if kind == 'script':
+            chunks = g_manifest.state(key)['flags'].get('chunks', [])
+            if len(chunks) != 0:
+                assets['chunks'][base] = chunks
+
+    php = '<?php\n// Generated by includes/build.py. Do not edit.\nreturn [\n'
+    for kind in assets:
+        php += f"    '{kind}' => [\n"
+        for name in sorted(assets[kind]):
+            value = assets[kind][name]
+            if isinstance(value, list):
+                value = '[' + ', '.join(f"'{item}'" for item in value) + ']'
+            else:
+                value = f"'{value}'"
+            php += f"        '{name}' => {value},\n"
+        php += '    ],\n'
+    php += '];\n'
+
+    path = 'includes' + os.sep + 'cache' + os.sep + 'assets.php'
+    try:
+        with open(path) as current:
+            if current.read() == php:
+                return
+    except OSError:
+        pass
 
+    with open(path + '.tmp', 'w') as manifest_file:
+        manifest_file.write(php)
+    os.replace(path + '.tmp', path)
 
-def get_hash(file):
-    '''Returns the md5 hash of the given file, truncated to the last 10 digits'''
-    with open(file, 'rb') as filebytes:
-        # Just return the last 10 digits. Likelihood of overlap is still miniscule
-        return hashlib.md5(filebytes.read()).hexdigest()[:10]
 
+# The [file:line,col] location at the end of a minifier warning
+WARNING_LOCATION_REGEX = re.compile(r'\[([^\[\]]*):(\d+),(\d+)\]')
 
-def process_output(output):
+def process_output(output, name, bundle):
     '''
-    Processes and filters minification output to reduce noise
+    Processes and filters minification output to reduce noise, returning the lines to print.
+    Warnings point at the bundle that was minified, so they're mapped back to the
+    script they came from using the bundle's line map. Lines without a location are
+    passed through as-is
     '''
     lines = output.split('\n')
+    out = []
     pure = 0
+    sources = {}
     for line in lines:
         if (len(line) == 0):
             continue
@@ -796,24 +4948,37 @@ def process_output(output):
             pure += 1
             continue
 
-        # Other errors might be more interesting. Since it's parsing temporary
-        # files, print out the line in question so we can get more context
-        file = line[line.rfind('[') + 1:line.rfind(':')]
-        fileLine = int(line[line.rfind(':') + 1:line.rfind(',')])
-
-        print(line)
-        print('    >', get_lines(file).split('\n')[fileLine - 1].strip())
+        location = None
+        for location in WARNING_LOCATION_REGEX.finditer(line):
+            pass
+        if location is None:
+            out.append(line)
+            continue
 
+        # Other errors might be more interesting, so print out the line in question for more context
+        fileLine = int(location.group(2))
+        if 0 < fileLine <= len(bundle.line_map) and bundle.line_map[fileLine - 1] is not None:
+            include, source_line = bundle.line_map[fileLine - 1]
+            file = 'script/' + include + '.js'
+            fileLine = source_line + 1
+            line = line[:location.start(1)] + file + ':' + str(fileLine) + line[location.end(2):]
+            if file not in sources:
+                sources[file] = get_lines(file).split('\n')
+        else:
+            # Generated code that doesn't come from a script, so point at the bundle itself
+            file = name
+            if file not in sources:
+                sources[file] = bundle.text().split('\n')
 
+        out.append(line)
+        if 0 < fileLine <= len(sources[file]):
+            out.append('    > ' + sources[file][fileLine - 1].strip())
 
     if pure != 0:
-        print('Dropped', pure, 'pure calls')
+        out.append('Dropped ' + str(pure) + ' pure calls')
+    return out
 
 
-def clean_tmp():
-    if os.path.exists('tmp'):
-        shutil.rmtree('tmp')
-
 def print_help():
     print()
     print('build.py - builds plexweb sources')
@@ -827,7 +4992,7 @@ def print_help():
     print()
     print('Options:')
     print('  -?        : Print this help menu')
-    print('  -f[orce]  : Ignore modified timestamps and update everything')
+    print('  -f[orce]  : Ignore the build manifest and update everything')
     print('  -b[abel]  : Use babel for minification instead of terser')
     print('  -u[ltra]  : Do some extra potentially unsafe custom minifications')
     print('  -q[uiet]  : Don\'t show warnings/extra info when building')
@@ -836,11 +5001,53 @@ def print_help():
     print('  -nocss    : Don\'t process CSS (trumps cssonly)')
     print('  -cssonly  : Only process CSS')
     print('  -cleancss : Use cleancss instead of csso')
-    print('  -cmp      : If -u[ltra] is specified, compares file sizes')
+    print('  -prune    : Remove CSS rules that need a class, id, or tag that never appears in')
+    print('              the page\'s templates or scripts. Names built at runtime must be listed')
+    print('              in includes/css_safelist.json (a trailing * matches any suffix)')
+    print('  -report [file.json] : Print the size of each page\'s scripts, the includes that take up')
+    print('              the most space, and how much -u[ltra], -notmi, and -nolog save, and write')
+    print('              the full report as JSON (default includes/cache/size_report.json)')
+    print('  -cmp      : Deprecated alias for -report')
+    print('  -stack [file] : Map the minified locations in a stack trace (read from the given file,')
+    print('              or stdin) back to the original scripts, using the .map written next to')
+    print('              each bundle')
+    print('  -checklong N : Print the identifiers of at least N letters that take up the most')
+    print('              space across all script bundles')
     print('  -s file   : Only process the given php file')
+    print('  -j N      : Run up to N build tasks (bundling, minifying, etc.) at once (defaults to the number of CPUs)')
+    print('  -dev      : Don\'t minify anything, just bundle, and skip the size budgets. Useful with -watch')
+    print('  -watch    : After building, watch for changes to scripts, styles, icons, and')
+    print('              deps.json, and rebuild only the affected bundles')
+    print('  -serve [port] : Instead of building everything, serve min/ on the given port')
+    print('              (default 8000), building each bundle when it\'s requested')
+    print('  -shared N : Move scripts used by at least N pages into shared chunks that are')
+    print('              cached across pages. Not compatible with -u[ltra]')
+    print('  -shake    : Remove top-level functions/classes/constants that the page never')
+    print('              uses. Names only used from PHP (other than inline event handlers)')
+    print('              must be listed in includes/shake_allowlist.json')
+    print('  -sprite [page|global] : Combine icons into sprite sheets, either one per color for')
+    print('              the whole site (the default), or one per color for each page')
+    print('  -inlineicons N : Embed icon variants no larger than N bytes as data URIs')
+    print('  -cache dir  : Directory to cache minified outputs in. Defaults to $PLEXWEB_BUILD_CACHE,')
+    print('                or includes/cache/artifacts if not set')
+    print('  -cachesize MB : Maximum size of the output cache (default 256)')
+    print('  -nocache  : Don\'t read or write the output cache, or the cache of preprocessed scripts')
+    print('  -nocompress : Don\'t write precompressed .gz/.br versions of published files.')
+    print('                Brotli requires the brotli python module or CLI')
+    print('  -profile [file.json] : Record how long each stage and file takes, print a summary,')
+    print('              and write a Chrome trace (default includes/cache/build_trace.json)')
+    print('  -daemon   : Minify in long-lived node processes instead of one process per file.')
+    print('              Falls back to one process per file if node or the minifiers are unavailable')
+    print('  -daemonecho : Like -daemon, but the helper returns sources unchanged (for testing)')
     print('  -notmi    : Discard all Log.tmi logging')
     print('  -nolog    : Discard all logging')
     print('  -nomdtmi  : Discard Log.tmi logging, but only from the Markdown parser')
+    print()
+    print('Size budgets:')
+    print('  Pages whose up-front scripts are larger than the minified ("min") or gzipped ("gzip")')
+    print('  byte limits in includes/size_budgets.json fail the build. Budgets can be set for all')
+    print('  pages ("*") or individual pages, and aren\'t checked with -dev')
 
 
-process()
\ No newline at end of file
+if __name__ == '__main__':
+    process()
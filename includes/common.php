@@ -225,7 +225,18 @@ function build_js()
     $file = pathinfo($_SERVER['PHP_SELF'])['filename'];
     if (try_get("nomin"))
     {
+        // Unminified, deferred scripts are loaded up front (right before the page's own script),
+        // so loadDeferred has nothing to do
         $includes = get_includes($file);
+        $deferred = get_deferred_includes($file, $includes);
+        if (sizeof($deferred) != 0)
+        {
+            echo "<script>\nfunction loadDeferred() { return Promise.resolve(); }\n</script>\n\n";
+            $page = array_pop($includes);
+            array_push($includes, ...$deferred);
+            array_push($includes, $page);
+        }
+
         foreach ($includes as $include)
         {
             echo "<script>\n" . include_js($include) . "</script>\n\n";
@@ -233,89 +244,166 @@ function build_js()
     }
     else
     {
-        // When minified, we add the md5 hash of the script to the filename, so
-        // do a fuzzy glob match and use the first result. Combining the md5 hash
+        // When minified, we add the md5 hash of the script to the filename, which
+        // build.py records in the asset manifest. Combining the md5 hash
         // with a large max-age cache-control setting in httpd.conf results in the
         // best of both worlds: clients get the latest bits as soon as they available,
         // and when the content doesn't change, clients can use the cached version
         // without pinging us.
-        echo '<script src="' . glob("min/script/$file.*.min.js")[0] . '"></script>';
+        //
+        // Scripts shared by multiple pages may live in separate chunks (see -shared
+        // in build.py), which must be loaded before the page's own bundle.
+        foreach (asset_manifest()["chunks"][$file] ?? [] as $chunk)
+        {
+            echo '<script src="' . asset_path("script", $chunk) . '"></script>';
+        }
+
+        echo '<script src="' . asset_path("script", $file) . '"></script>';
     }
 }
 
 /// <summary>
-/// Parses the deps json to determine what js files should be included
+/// Returns the asset manifest written by build.py (includes/cache/assets.php), which
+/// maps scripts, styles, icons, and pre-rendered icon variants to their current hashed paths. Being a PHP file,
+/// opcache keeps it in memory, so we don't have to scan the min directory on every request.
 /// </summary>
-function get_includes($file)
+function asset_manifest()
 {
-    $deps = json_decode(file_get_contents('includes/deps.json'));
-    $result = [];
-    get_includes_core($file, $deps, 0, $result);
-    $flattened = flatten_includes($result);
-    array_push($flattened, $file);
+    static $assets = NULL;
+    if ($assets === NULL)
+    {
+        $assets = @include "includes/cache/assets.php";
+        if (!is_array($assets))
+        {
+            $assets = [];
+        }
+    }
+
+    return $assets;
+}
 
-    $has_consolelog = array_search("consolelog", $flattened);
-    
-    if ($has_consolelog != FALSE)
+/// <summary>
+/// Returns the path to the current build of the given asset ("script", "style", "icon",
+/// "variant" for an icon pre-rendered in another color (e.g. "c1c1c1/edit"), or "asset"
+/// for static files like favicon.svg), or FALSE if it doesn't exist.
+///
+/// If the asset manifest doesn't exist or doesn't know about the asset, fall back to
+/// the old fuzzy glob match.
+/// </summary>
+function asset_path($type, $name)
+{
+    $assets = asset_manifest();
+    $key = $type == "icon" ? strtolower($name) : $name;
+    if (isset($assets[$type][$key]))
     {
-        array_splice($flattened, $has_consolelog, 1);
-        array_splice($flattened, 0, 0, "consolelog");
+        return $assets[$type][$key];
     }
 
-    $has_common = array_search("common", $flattened);
-    if ($has_common !== FALSE && $has_common != ($has_consolelog === FALSE ? 0 : 1))
+    switch ($type)
     {
-        array_splice($flattened, $has_common, 1);
-        array_splice($flattened, $has_consolelog === FALSE ? 0 : 1, 0, "common");
+        case "script":
+            $gl = glob("min/script/$name.*.min.js");
+            break;
+        case "style":
+            $gl = glob("min/style/$name.*.min.css");
+            break;
+        case "icon":
+            $gl = glob("min/icon/$name.*.svg");
+            break;
+        default:
+            return FALSE;
     }
 
-    return $flattened;
+    return sizeof($gl) == 0 ? FALSE : $gl[0];
 }
 
 /// <summary>
-/// Recursively add dependencies to the result list
+/// Returns the scripts to load for the given page, in the same order build.py bundles them:
+/// consolelog and common first, then everything else in dependency order, and the page's own
+/// script last. Returns an empty list if the page isn't in deps.json
 /// </summary>
-function get_includes_core($dep, $deps, $depth, &$result)
+function get_includes($file)
 {
-    if (!array_key_exists($depth, $result))
+    $deps = json_decode(file_get_contents('includes/deps.json'));
+    if (!isset($deps->$file))
     {
-        $result[$depth] = [];
+        return [];
     }
-    foreach ($deps->$dep->js as $include)
+
+    $order = get_script_order($file, $deps);
+    $result = array_values(array_intersect(["consolelog", "common"], $order));
+    foreach ($order as $include)
     {
-        if (!in_array($include, $result[$depth]))
+        if (!in_array($include, $result) && $include != $file)
         {
-            array_unshift($result[$depth], $include);
-            get_includes_core($include, $deps, $depth + 1, $result);
+            array_push($result, $include);
         }
-        else
+    }
+
+    if (!in_array($file, $result))
+    {
+        array_push($result, $file);
+    }
+
+    return $result;
+}
+
+/// <summary>
+/// Returns the scripts the given page loads lazily (its "defer" entries in deps.json,
+/// along with their dependencies) that aren't already part of the given includes
+/// </summary>
+function get_deferred_includes($file, $includes)
+{
+    $deps = json_decode(file_get_contents('includes/deps.json'));
+    $result = [];
+    foreach ($deps->$file->defer ?? [] as $deferred)
+    {
+        foreach (get_script_order($deferred, $deps) as $include)
         {
-            array_splice($result[$depth], array_search($include, $result[$depth]), 1);
-            array_unshift($result[$depth], $include);
+            if (!in_array($include, $includes) && !in_array($include, $result))
+            {
+                array_push($result, $include);
+            }
         }
     }
+
+    return $result;
 }
 
 /// <summary>
-/// Given a list of dependencies bucketed by dependency
-/// depth, return a flattened list in order of deepest to
-/// shallowest dependency depth
+/// Returns the given script and everything it (transitively) depends on, ordered such that
+/// each script comes after all of its dependencies, with the given script last. This is the
+/// same ordering as DependencyGraph.scripts in build.py. Orderings are memoized, and cycles
+/// (which build.py reports) are cut off instead of recursing forever
 /// </summary>
-function flatten_includes($includes)
+function get_script_order($name, $deps)
 {
-    $flattened = [];
-    for ($i = count($includes) - 1; $i >= 0; --$i)
+    static $orders = [];
+    if (isset($orders[$name]))
+    {
+        return $orders[$name];
+    }
+
+    $orders[$name] = [$name];
+    $order = [];
+    foreach ($deps->$name->js ?? [] as $dep)
     {
-        foreach ($includes[$i] as $dep)
+        foreach (get_script_order($dep, $deps) as $include)
         {
-            if (!in_array($dep, $flattened))
+            if (!in_array($include, $order))
             {
-                array_push($flattened, $dep);
+                array_push($order, $include);
             }
         }
     }
 
-    return $flattened;
+    if (!in_array($name, $order))
+    {
+        array_push($order, $name);
+    }
+
+    $orders[$name] = $order;
+    return $order;
 }
 
 /// <summary>
@@ -337,12 +425,15 @@ function build_css()
     }
     else
     {
-        echo '<link rel="stylesheet" href="' . glob("min/style/$self.*.min.css")[0] . '">';
+        echo '<link rel="stylesheet" href="' . asset_path("style", $self) . '">';
     }
 }
 
 /// <summary>
-/// Builds up a list of CSS dependencies for the given file
+/// Builds up a list of CSS dependencies for the given file, in the same order build.py bundles
+/// them: "style" first, then the base stylesheets, then any other stylesheets required by the
+/// page's scripts (including deferred ones) in dependency order, then the page's own stylesheets,
+/// with the one named after the page last
 /// </summary>
 function get_css_includes($file)
 {
@@ -353,15 +444,37 @@ function get_css_includes($file)
         return $result;
     }
 
+    // Deferred scripts are loaded lazily, but their styles are still part of the page's stylesheet
+    $scripts = array_slice(get_script_order($file, $deps), 0, -1);
+    foreach ($deps->$file->defer ?? [] as $deferred)
+    {
+        foreach (get_script_order($deferred, $deps) as $script)
+        {
+            if (!in_array($script, $scripts))
+            {
+                array_push($scripts, $script);
+            }
+        }
+    }
+
+    $implicit = [];
+    foreach ($scripts as $script)
+    {
+        foreach ($deps->$script->css ?? [] as $css)
+        {
+            if (!in_array($css, $implicit))
+            {
+                array_push($implicit, $css);
+            }
+        }
+    }
+
     $includes = $deps->$file->css;
     if (in_array("style", $includes))
     {
         array_push($result, "style");
     }
 
-    $implicit = [];
-    get_css_deps_from_js($file, $deps, $implicit);
-
     // Some "base" css files should go first to allow overriding by subsequent files
     $base = ["overlay", "nav", "table", "tooltip"];
     foreach ($base as $css)
@@ -382,7 +495,7 @@ function get_css_includes($file)
 
     foreach ($includes as $include)
     {
-        if ($include != "style" && $include != $file)
+        if ($include != "style" && $include != $file && !in_array($include, $result))
         {
             array_push($result, $include);
         }
@@ -395,7 +508,7 @@ function get_css_includes($file)
         {
             array_splice($result, $idx, 1);
         }
-        
+
         array_push($result, $file);
     }
 
@@ -403,53 +516,37 @@ function get_css_includes($file)
 }
 
 /// <summary>
-/// Iterates through the dependency tree for both JS and CSS,
-/// adding required CSS files to the result
-/// <summary>
-function get_css_deps_from_js($dep, $deps, &$result)
+/// Gets the content-hashed copy of the given static file (e.g. "favicon.svg"),
+/// or the file itself if it hasn't been built
+/// </summary>
+function asset($name)
 {
-    if (!isset($deps->$dep))
-    {
-        return;
-    }
-
-    foreach ($deps->$dep->js as $include)
-    {
-        if (!isset($deps->$include))
-        {
-            continue;
-        }
-
-        foreach ($deps->$include->css as $css)
-        {
-            if (!in_array($css, $result))
-            {
-                array_push($result, $css);
-                get_css_deps_from_js($css, $deps, $result);
-            }
-        }
-
-        if (!in_array($include, $result))
-        {
-            get_css_deps_from_js($include, $deps, $result);
-        }
-    }
+    $path = asset_path("asset", $name);
+    echo $path === FALSE ? $name : $path;
 }
 
 /// <summary>
-/// Gets the stamped icon svg with the given name
+/// Gets the stamped icon svg with the given name, in the default color. The build pre-renders
+/// the default color of every icon and lists it in the asset manifest, so svg.php is only
+/// needed if that variant hasn't been built
 /// </summary>
 function icon($name)
 {
-    $gl = glob("min/icon/$name.*.svg");
-    if (sizeof($gl) == 0)
+    $path = asset_path("icon", $name);
+    if ($path === FALSE)
     {
         echo 'min/icon/blank.svg';
         return;
     }
 
-    $icon = substr($gl[0], strrpos($gl[0], "/") + 1);
-    $icon = explode(".", $icon);
+    $variant = asset_path("variant", "c1c1c1/" . strtolower($name));
+    if ($variant !== FALSE)
+    {
+        echo $variant;
+        return;
+    }
+
+    $icon = explode(".", substr($path, strrpos($path, "/") + 1));
     echo "i/c1c1c1/" . $icon[0] . "." . $icon[1] . ".svg";
 }
 
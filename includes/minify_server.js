@@ -0,0 +1,230 @@
+/// <summary>
+/// Long-lived minification helper for build.py. Instead of spawning a new node
+/// process (and cold-loading terser/svgo/csso) for every file, build.py starts this
+/// once and sends it one JSON request per line over stdin:
+///
+///     { "id" : 1, "tool" : "terser", "source" : "...", "options" : {}, "path" : "x.js" }
+///
+/// and receives one JSON response per line over stdout:
+///
+///     { "id" : 1, "code" : "...", "warnings" : [], "map" : "..." }   or   { "id" : 1, "error" : "..." }
+///
+/// Pass --echo to return every source unchanged, which is enough to exercise the
+/// protocol in environments that don't have the minifiers installed.
+/// </summary>
+
+/* eslint-env node */
+/* eslint-disable no-console */
+
+const path = require("path");
+const readline = require("readline");
+
+const echo = process.argv.includes("--echo");
+
+/// <summary>
+/// Map of tool names to their npm package, loaded on first use
+/// </summary>
+const packages =
+{
+    terser : "terser",
+    babel : "babel-minify",
+    csso : "csso",
+    cleancss : "clean-css",
+    svgo : "svgo"
+};
+
+const loaded = {};
+
+/// <summary>
+/// Returns the global node_modules directory, which is where build.py
+/// expects the minifiers to be installed (via npm install -g)
+/// </summary>
+function globalModules()
+{
+    if (process.platform == "win32")
+    {
+        return path.join(process.env.APPDATA || "", "npm", "node_modules");
+    }
+
+    return path.join(path.dirname(path.dirname(process.execPath)), "lib", "node_modules");
+}
+
+/// <summary>
+/// Loads the given tool, first from the regular module path, then from the global modules directory
+/// </summary>
+function load(tool)
+{
+    if (loaded[tool])
+    {
+        return loaded[tool];
+    }
+
+    const name = packages[tool];
+    if (!name)
+    {
+        throw new Error(`Unknown tool '${tool}'`);
+    }
+
+    let module;
+    let version;
+    try
+    {
+        module = require(name);
+        version = require(`${name}/package.json`).version;
+    }
+    catch (ex)
+    {
+        module = require(path.join(globalModules(), name));
+        version = require(path.join(globalModules(), name, "package.json")).version;
+    }
+
+    loaded[tool] = { module : module, version : version };
+    return loaded[tool];
+}
+
+/// <summary>
+/// Runs terser. Warnings are only available in terser 4, which also expects
+/// them to be requested at the top level instead of in the compress options
+/// </summary>
+async function runTerser(request)
+{
+    const terser = load("terser");
+    const options = Object.assign({}, request.options);
+    const major = parseInt(terser.version);
+    if (options.compress && "warnings" in options.compress)
+    {
+        delete options.compress.warnings;
+        if (major < 5)
+        {
+            options.warnings = "verbose";
+        }
+    }
+
+    const input = {};
+    input[request.path || "input.js"] = request.source;
+    const result = await Promise.resolve(terser.module.minify(input, options));
+    if (result.error)
+    {
+        throw result.error;
+    }
+
+    // build.py asks for a source map, which it chains with the bundle's own line map
+    return { code : result.code, warnings : result.warnings || [], map : result.map };
+}
+
+/// <summary>
+/// Runs babel-minify
+/// </summary>
+function runBabel(request)
+{
+    const babel = load("babel").module;
+    return { code : babel(request.source, request.options || {}).code, warnings : [] };
+}
+
+/// <summary>
+/// Runs csso
+/// </summary>
+function runCsso(request)
+{
+    const csso = load("csso").module;
+    return { code : csso.minify(request.source, request.options || {}).css, warnings : [] };
+}
+
+/// <summary>
+/// Runs clean-css, defaulting to level 2 optimizations to match the CLI's -O2
+/// </summary>
+function runCleanCss(request)
+{
+    const CleanCss = load("cleancss").module;
+    const result = new CleanCss(request.options || { level : 2 }).minify(request.source);
+    if (result.errors.length != 0)
+    {
+        throw new Error(result.errors.join("\n"));
+    }
+
+    return { code : result.styles, warnings : result.warnings };
+}
+
+/// <summary>
+/// Runs svgo, supporting both the class-based (1.x) and functional (2.x+) APIs
+/// </summary>
+async function runSvgo(request)
+{
+    const svgo = load("svgo").module;
+    if (svgo.optimize)
+    {
+        return { code : svgo.optimize(request.source, { path : request.path }).data, warnings : [] };
+    }
+
+    const result = await new svgo(request.options || {}).optimize(request.source, { path : request.path });
+    return { code : result.data, warnings : [] };
+}
+
+const runners =
+{
+    terser : runTerser,
+    babel : runBabel,
+    csso : runCsso,
+    cleancss : runCleanCss,
+    svgo : runSvgo
+};
+
+/// <summary>
+/// Processes a single request, returning the response object
+/// </summary>
+async function handle(request)
+{
+    if (echo)
+    {
+        return { id : request.id, code : request.source, warnings : [] };
+    }
+
+    const runner = runners[request.tool];
+    if (!runner)
+    {
+        return { id : request.id, error : `Unknown tool '${request.tool}'` };
+    }
+
+    try
+    {
+        const result = await runner(request);
+        result.id = request.id;
+        return result;
+    }
+    catch (ex)
+    {
+        return { id : request.id, error : ex.message || String(ex) };
+    }
+}
+
+const rl = readline.createInterface({ input : process.stdin, terminal : false });
+
+// Requests are handled strictly in order, so responses can be matched up by position
+let queue = Promise.resolve();
+rl.on("line", (line) =>
+{
+    if (line.length == 0)
+    {
+        return;
+    }
+
+    queue = queue.then(async () =>
+    {
+        let request;
+        try
+        {
+            request = JSON.parse(line);
+        }
+        catch (ex)
+        {
+            process.stdout.write(JSON.stringify({ id : null, error : "Malformed request" }) + "\n");
+            return;
+        }
+
+        process.stdout.write(JSON.stringify(await handle(request)) + "\n");
+    });
+});
+
+rl.on("close", () => { queue.then(() => process.exit(0)); });
+
+process.stdout.write(JSON.stringify({ ready : true, echo : echo }) + "\n");
@@ -150,8 +150,8 @@ function get_library_map()
 <html lang="en-us">
 <head>
     <meta charset="utf-8">
-    <link rel="icon" type="image/svg+xml" href="favicon.svg">
-    <link rel="alternate icon" href="favicon.png">
+    <link rel="icon" type="image/svg+xml" href="<?php asset("favicon.svg") ?>">
+    <link rel="alternate icon" href="<?php asset("favicon.png") ?>">
     <link rel="apple-touch-icon" href="apple-touch-icon.png">
     <link rel="apple-touch-icon" sizes="152x152" href="apple-touch-icon-ipad.png">
     <link rel="apple-touch-icon" sizes="180x180" href="apple-touch-icon-iphone-retina.png">
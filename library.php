@@ -18,8 +18,8 @@ if (!UserLevel::is_admin())
 <html lang="en-us">
 <head>
     <meta charset="utf-8">
-    <link rel="icon" type="image/svg+xml" href="favicon.svg">
-    <link rel="alternate icon" href="favicon.png">
+    <link rel="icon" type="image/svg+xml" href="<?php asset("favicon.svg") ?>">
+    <link rel="alternate icon" href="<?php asset("favicon.png") ?>">
     <meta name="viewport" content="width=device-width, initial-scale=1">
     <meta name="theme-color" content="#3C5260" />
     <title>Library Management</title>
@@ -10,7 +10,7 @@ session_start();
 <html lang="en-us">
 <head>
     <meta charset="utf-8">
-    <link rel="icon" type="image/svg+xml" href="mdfav.svg">
+    <link rel="icon" type="image/svg+xml" href="<?php asset("mdfav.svg") ?>">
     <meta name="viewport" content="width=device-width, initial-scale=1">
     <meta name="theme-color" content="#3C5260" />
     <meta name="Description" content="A place to test the Markdown parser used for danrahn.com" />
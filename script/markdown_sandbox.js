@@ -1,6 +1,7 @@
 // Markdown files are the only ones that prefer single-quotes over double.
 /* eslint quotes: ["error", "single", { "avoidEscape" : true, "allowTemplateLiterals" : true }] */
-let md = new Markdown();
+// Set once the markdown parser is loaded
+let md;
 
 function forceParseMarkdown() { parseMarkdownCore(true); }
 function parseMarkdown() { parseMarkdownCore(false); }
@@ -37,17 +38,7 @@ function parseShortcuts(e)
     }
 }
 
-$('#markdownSubmit').addEventListener('click', forceParseMarkdown);
-$('#query').addEventListener('change', parseMarkdown);
-$('#query').addEventListener('keyup', parseMarkdown);
-
-$('#query').addEventListener('keydown', parseShortcuts);
-MarkdownEditor.addTabHandler($('#query'));
-MarkdownEditor.addAutoCompleteHandler($('#query'));
-MarkdownEditor.addFormatHandler($('#query'));
-$('#query').parentNode.insertBefore(MarkdownEditor.getToolbar($('#query')), $('#query'));
-
-$('#markdownTestSuite').addEventListener('click', function()
+function runTestSuite()
 {
     let testCache = $('#testcache').checked;
     let testResults = new MarkdownTestSuite().runSuite(testCache);
@@ -55,13 +46,30 @@ $('#markdownTestSuite').addEventListener('click', function()
     let passRate = ((testResults.passed / totalTests) * 100).toFixed(2);
     let auxText = (totalTests == testResults.passed ? '. Yay!' : '') + '\n\nSee the console (F12) for more details';
     alert(`Test Results${testCache ? ' (with cache)' : ''}: Passed ${testResults.passed} of ${totalTests} tests (${passRate}%)${auxText}`);
-});
+}
 
-MarkdownHelp.getHelp(function(response)
+// The markdown parser, editor, and tests are loaded separately, after everything else
+loadDeferred().then(function()
 {
-    $('#query').value = response.data;
-    parseMarkdown();
-}, true /*raw*/);
+    md = new Markdown();
+    $('#markdownSubmit').addEventListener('click', forceParseMarkdown);
+    $('#query').addEventListener('change', parseMarkdown);
+    $('#query').addEventListener('keyup', parseMarkdown);
+
+    $('#query').addEventListener('keydown', parseShortcuts);
+    MarkdownEditor.addTabHandler($('#query'));
+    MarkdownEditor.addAutoCompleteHandler($('#query'));
+    MarkdownEditor.addFormatHandler($('#query'));
+    $('#query').parentNode.insertBefore(MarkdownEditor.getToolbar($('#query')), $('#query'));
+
+    $('#markdownTestSuite').addEventListener('click', runTestSuite);
+
+    MarkdownHelp.getHelp(function(response)
+    {
+        $('#query').value = response.data;
+        parseMarkdown();
+    }, true /*raw*/);
+});
 
 window.addEventListener('resize', checkWindowSize);
 
@@ -41,8 +41,12 @@ window.addEventListener("load", function()
             }
         });
 
-        setupMarkdown();
-        setupMarkdownHelpers();
+        // The markdown parser and editor are loaded separately, after everything else
+        loadDeferred().then(function()
+        {
+            setupMarkdown();
+            setupMarkdownHelpers();
+        });
 
         $("#newCommentButton").addEventListener("click", addComment);
         addNavListener();
@@ -99,12 +103,17 @@ function reqId()
 /// </summary>
 function setupMarkdown()
 {
+    mdPreview = new Markdown();
+    mdEdit = new Markdown();
     let comment = $("#newComment");
     comment.addEventListener("change", parseMarkdown);
     comment.addEventListener("keyup", parseMarkdown);
     MarkdownEditor.addTabHandler(comment);
     MarkdownEditor.addAutoCompleteHandler(comment);
     MarkdownEditor.addFormatHandler(comment);
+
+    // Catch up on anything typed while the parser was loading
+    parseMarkdown();
 }
 
 /// <summary>
@@ -115,8 +124,8 @@ function setupMarkdownHelpers()
     $("#newCommentHolder").insertBefore(MarkdownEditor.getToolbar($("#newComment")) ,$("#newComment"));
 }
 
-// Global markdown object so we can cache parsed markdown
-let mdPreview = new Markdown();
+// Global markdown object so we can cache parsed markdown. Set once the parser is loaded
+let mdPreview;
 
 /// <summary>
 /// Parse the user's new comment text. If any markdown elements
@@ -1062,7 +1071,7 @@ function getComments()
     let successFunc = function(response)
     {
         Log.info(response, "Comments");
-        buildComments(response);
+        loadDeferred().then(() => buildComments(response));
     };
     let failureFunc = function(response)
     {
@@ -1358,6 +1367,9 @@ async function addComment()
 
     let params = { type : ProcessRequest.AddComment, req_id : reqId(), content : text };
 
+    // The preview won't have seen this text if it was typed before the parser loaded
+    await loadDeferred();
+    mdPreview.parse(text);
     if (mdPreview.markdownPresent)
     {
         params.md = await inlineCssIfNeeded(text);
@@ -1495,8 +1507,8 @@ function editComment()
     editor.focus();
 }
 
-// Cached markdown object for editing comments
-let mdEdit = new Markdown();
+// Cached markdown object for editing comments. Set once the parser is loaded
+let mdEdit;
 
 // ID of the last comment we parsed
 let editCur = "";
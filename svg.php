@@ -46,15 +46,18 @@ if (!preg_match("/^[a-fA-F0-9]+$/", $color))
     bad_request();
 }
 
-$gl = glob("min/icon/$icon.$hash.svg");
-if (sizeof($gl) == 0)
+// Icons are requested in lowercase, so ask the asset manifest for the actual file name
+$filename = asset_path("icon", $icon);
+if ($filename === FALSE || substr($filename, -strlen(".$hash.svg")) != ".$hash.svg")
 {
-    header("HTTP/1.0 404 Not Found");
-    die();
+    $filename = "min/icon/$icon.$hash.svg";
+    if (!file_exists($filename))
+    {
+        header("HTTP/1.0 404 Not Found");
+        die();
+    }
 }
 
-$filename = $gl[0];
-
 $headers = apache_request_headers();
 $file_time = filemtime($filename);
 header('Cache-Control: max-age=31536000, immutable');